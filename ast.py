@@ -1,143 +1,453 @@
 """
 This file contains the Ast class, which represents an abstract syntax tree which can be evaluated.
 """
-import copy
-from typing import Dict
+from typing import Callable, Dict, Iterator, Set, Tuple
 
 from common import RuleMatch, remove, left_assoc, Token, precedence
-from rules import rule_value_map, rule_value_operation_map
-from vartypes import TupleValue
+from rules import rule_value_map, rule_value_operation_map, binary_operation, unary_operation
+from vartypes import NumberValue, TupleValue, Value, is_vector
 
+# Leaves which are cheaper to evaluate again than to look up, so identical ones aren't memoized.
+leaves = ('num', 'var', 'cst')
+
+# Rows become part of the matrix built from them, so identical rows must not be the same list.
+unshared = leaves + ('mrw',)
+
+# Trees deeper than this are evaluated by Ast#_evaluate instead of being compiled into closures.
+max_compile_depth = 100
+
+# Markers for the parentheses in Ast#_infix.
+open_parenthesis = object()
+close_parenthesis = object()
+
+
+def depth(root: RuleMatch) -> int:
+    deepest = 0
+    stack = [(root, 1)]
+
+    while stack:
+        node, level = stack.pop()
+        deepest = max(deepest, level)
+        stack.extend((child, level + 1) for child in node.matched if isinstance(child, RuleMatch))
+
+    return deepest
+
+
+def _constant(value: Value) -> RuleMatch:
+    node = RuleMatch('cst', [])
+    node.value = value
+    return node
 
-class Ast:
-    def __init__(self, root: RuleMatch):
-        self.root = self._fixed(root)
 
-    def _fixed(self, node):
-        # print('**_fixed ast', ast)
+class Ast:
+    def __init__(self, root: RuleMatch, fixed=False):
+        # A root which is already fixed (like one built by InfixParser) is used as is.
+        self.root = root if fixed else self._fixed(root)
+        self._compiled = None
+        self._evaluated = False
+
+    def _fixed(self, root):
+        # The tree is fixed from the top down with an explicit stack, so deep trees don't hit the recursion limit. Each
+        # entry is a list and an index into it, which is where the fixed node is stored.
+        holder = [root]
+        stack = [(holder, 0)]
+
+        while stack:
+            parent, i = stack.pop()
+            node = self._fixed_node(parent[i])
+            parent[i] = node
+
+            # This fixes the matched nodes.
+            if isinstance(node, RuleMatch):
+                for j in range(len(node.matched)):
+                    if isinstance(node.matched[j], RuleMatch):
+                        stack.append((node.matched, j))
+
+        return holder[0]
+
+    def _fixed_node(self, node):
+        # Rewrites a single node until none of the rules apply. Its children are fixed afterwards by _fixed.
+        while isinstance(node, RuleMatch):
+            # This removes extraneous symbols from the tree.
+            for i in range(len(node.matched) - 1, -1, -1):
+                if node.matched[i].name in remove:
+                    del node.matched[i]
+
+            # This flattens rules with a single matched rule.
+            if len(node.matched) == 1 and isinstance(node.matched[0], RuleMatch) and node.name not in ('mbd', 'mrw', 'opb', 'asb'):  # The last condition fixes small matrices like [1], [1,2], and [1|2].
+                node = node.matched[0]
+                continue
+
+            # This makes left-associative operations left-associative.
+            for token_name, rule in left_assoc.items():
+                if len(node.matched) == 3 and node.matched[1].name == token_name and isinstance(node.matched[2], RuleMatch) and len(node.matched[2].matched) == 3 and node.matched[2].matched[1].name == token_name:
+                    node.matched[0] = RuleMatch(rule, [node.matched[0], node.matched[1], node.matched[2].matched[0]])
+                    node.matched[1] = node.matched[2].matched[1]
+                    node.matched[2] = node.matched[2].matched[2]
+                    break
 
-        if not isinstance(node, RuleMatch):
-            return node
+            else:
+                # This converts implicit multiplication to regular multiplication.
+                if node.name == 'mui':
+                    node = RuleMatch('mul', [node.matched[0], Token('MUL', '*'), node.matched[1]])
+                    continue
 
-        # This removes extraneous symbols from the tree.
-        for i in range(len(node.matched) - 1, -1, -1):
-            if node.matched[i].name in remove:
-                del node.matched[i]
+                # This flattens nested nodes into their parents if their parents are of the same type.
+                if self._flatten_nested(node):
+                    continue
 
-        # This flattens rules with a single matched rule.
-        if len(node.matched) is 1 and isinstance(node.matched[0], RuleMatch) and node.name not in ('mbd', 'mrw', 'opb', 'asb'):  # The last condition fixes small matrices like [1], [1,2], and [1|2].
-            return self._fixed(node.matched[0])
+                break
 
-        # This makes left-associative operations left-associative.
-        for token_name, rule in left_assoc.items():
-            if len(node.matched) == 3 and node.matched[1].name == token_name and isinstance(node.matched[2], RuleMatch) and len(node.matched[2].matched) == 3 and node.matched[2].matched[1].name == token_name:
-                node.matched[0] = RuleMatch(rule, [node.matched[0], node.matched[1], node.matched[2].matched[0]])
-                node.matched[1] = node.matched[2].matched[1]
-                node.matched[2] = node.matched[2].matched[2]
-                return self._fixed(node)
+        # This moves operators to the front of matched. Identifiers in a, b, c = ... are not operators.
+        if isinstance(node, RuleMatch) and len(node.matched) == 3 and isinstance(node.matched[1], Token) and node.name != 'asb':
+            node.matched = [node.matched[1]] + [node.matched[0]] + node.matched[2:]
 
-        # This converts implicit multiplication to regular multiplication.
-        if node.name == 'mui':
-            return self._fixed(RuleMatch('mul', [node.matched[0], Token('MUL', '*'), node.matched[1]]))
+        return node
 
-        # This flattens nested nodes into their parents if their parents are of the same type.
+    @staticmethod
+    def _flatten_nested(node: RuleMatch) -> bool:
         for tpe in ('mrw', 'mbd', 'opb', 'asb'):
             if node.name == tpe:
                 for i in range(len(node.matched) - 1, -1, -1):
                     if node.matched[i].name == tpe:
                         node.matched[i:] = node.matched[i].matched
-                        return self._fixed(node)
+                        return True
 
-        # This moves operators to the front of matched.
-        if len(node.matched) == 3 and isinstance(node.matched[1], Token):
-            node.matched = [node.matched[1]] + [node.matched[0]] + node.matched[2:]
+        return False
 
-        # This fixes the matched nodes.
-        if isinstance(node, RuleMatch):
-            for i in range(len(node.matched)):
-                node.matched[i] = self._fixed(node.matched[i])
+    def evaluate(self, vrs: Dict[str, RuleMatch], record=False):
+        """
+        Evaluates the tree without modifying it, so a tree can be evaluated many times. When record is True, the value of
+        every node is stored on the node so that it shows up in str(ast).
+        """
+        return self._evaluate(self.root, vrs, record)
 
-        return node
+    def _evaluate(self, node, vrs: Dict[str, RuleMatch], record=False):
+        # A post-order walk with an explicit stack. Each node is visited twice: once to queue its children and once,
+        # after they have been evaluated, to combine their values.
+        results = []
+        stack = [(node, False)]
 
-    def evaluate(self, vrs: Dict[str, RuleMatch]):
-        return self._evaluate(self.root, vrs)
+        while stack:
+            node, visited = stack.pop()
 
-    def _evaluate(self, node, vrs: Dict[str, RuleMatch]):
-        if node.name == 'asn':
-            return {idt.value: (i, node.matched[1]) for i, idt in enumerate(node.matched[0].matched)}
+            if node.name == 'cst':
+                results.append(node.value)
+                continue
 
-        for token in node.matched:
-            if isinstance(token, RuleMatch) and not token.value:
-                token.value = self._evaluate(token, vrs)
+            if node.name == 'asn':
+                results.append({idt.value: (i, node.matched[1]) for i, idt in enumerate(node.matched[0].matched)})
+                continue
 
-        values = [token.value for token in node.matched if isinstance(token, RuleMatch) and token.value]
-        tokens = [token for token in node.matched if not isinstance(token, RuleMatch)]
+            if node.matched and node.matched[0].name == 'IDT':
+                results.append(self._variable(node.matched[0].value, vrs))
+                continue
+
+            children = [child for child in node.matched if isinstance(child, RuleMatch)]
+
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(children))
+                continue
+
+            values = results[len(results) - len(children):]
+            del results[len(results) - len(children):]
+            tokens = [token for token in node.matched if not isinstance(token, RuleMatch)]
+
+            if record:
+                for child, value in zip(children, values):
+                    child.value = value
+
+            if node.name in rule_value_map:
+                results.append(rule_value_map[node.name](values, tokens))
+
+            else:
+                results.append(rule_value_operation_map[node.name](values, tokens[0] if len(tokens) > 0 else None))  # This extra rule is part of the num hotfix.
+
+        return results[0]
+
+    def _variable(self, name: str, vrs: Dict[str, RuleMatch]):
+        # Variables are usually (index, rule) pairs from an assignment, but plain Values and numbers can be bound too.
+        entry = vrs[name]
+
+        if isinstance(entry, Value):
+            return entry
+
+        if isinstance(entry, (int, float)):
+            return NumberValue(float(entry))
+
+        i, rule = entry
+        result = self._evaluate(rule, vrs)
+
+        if isinstance(result, TupleValue):
+            return result.value[i]
+
+        return result
+
+    def run(self, vrs: Dict[str, RuleMatch]):
+        """
+        Evaluates the tree like evaluate the first time, and through compile after that. Compiling costs more than a
+        single evaluation, so it only pays off for trees which are evaluated again, like the ones in the cache.
+        """
+        if self._compiled is None and not self._evaluated:
+            self._evaluated = True
+            return self._evaluate(self.root, vrs)
+
+        return self.compile()(vrs)
+
+    def compile(self) -> Callable[[Dict[str, RuleMatch]], Value]:
+        """
+        Lowers the tree into nested closures so that evaluating it again doesn't walk the tree. The returned function
+        takes the variables, just like evaluate, and returns the same result. Constant subtrees are evaluated once here,
+        and identical subtrees once per call.
+        """
+        if self._compiled is None:
+            root, shared = self._optimized()
+
+            if depth(root) > max_compile_depth:
+                # Every level of closures is a Python call, so a tree this deep is evaluated by walking it instead.
+                evaluate = self._evaluate
+                self._compiled = lambda vrs: evaluate(root, vrs)
+                return self._compiled
+
+            compiled = self._compile(root, shared, {})
+
+            if shared:
+                self._compiled = lambda vrs: compiled(vrs, {})
+
+            else:
+                self._compiled = lambda vrs: compiled(vrs, None)
+
+        return self._compiled
+
+    def _optimized(self) -> Tuple[RuleMatch, Set[int]]:
+        """
+        Returns a copy of the tree for compile, in which every subtree without variables that evaluates to a number is
+        folded into a 'cst' leaf holding the NumberValue, and identical subtrees are merged into the same RuleMatch.
+        Also returns the ids of the merged subtrees which are used more than once. The tree itself is left alone, since
+        it may be cached and rendered.
+        """
+        # The right side of an assignment is compiled by the Assignment which evaluates it.
+        if self.root.name == 'asn':
+            return self.root, set()
+
+        merged = {}
+        uses = {}
+        # A post-order walk like _evaluate, where each result is the optimized node and its value if it's constant (or
+        # None). Merged children are the same RuleMatch, so a node's key can refer to its children by id.
+        results = []
+        stack = [(self.root, False)]
+
+        while stack:
+            node, visited = stack.pop()
+            children = [child for child in node.matched if isinstance(child, RuleMatch)]
+
+            if not visited:
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(children))
+                continue
+
+            visited_children = iter(results[len(results) - len(children):])
+            del results[len(results) - len(children):]
+            matched = []
+            # The node with its children replaced by their values, so a constant node is evaluated without evaluating
+            # its subtree again. Constants which don't fold, like matrices, would otherwise be evaluated again at every
+            # ancestor.
+            probe = []
+            key = [node.name]
+            constant = True
+
+            for child in node.matched:
+                if isinstance(child, RuleMatch):
+                    child, value = next(visited_children)
+                    constant = constant and value is not None
+                    key.append(id(child))
+                    probe.append(_constant(value) if value is not None else child)
+
+                else:
+                    constant = constant and child.name != 'IDT'
+                    key.append((child.name, child.value))
+                    probe.append(child)
+
+                matched.append(child)
+
+            key = tuple(key)
+
+            if key in merged:
+                results.append(merged[key])
+                continue
+
+            optimized = RuleMatch(node.name, matched)
+            value = None
+
+            if node.name == 'cst':
+                value = node.value
+
+            elif constant:
+                try:
+                    value = self._evaluate(RuleMatch(node.name, probe), {})
+
+                except Exception:
+                    # Let the error happen when the tree is evaluated, like it would without folding.
+                    value = None
+
+                if node.name not in leaves and isinstance(value, NumberValue) and not is_vector(value.value):
+                    optimized = _constant(value)
+
+            for child in optimized.matched:
+                if isinstance(child, RuleMatch):
+                    uses[id(child)] = uses.get(id(child), 0) + 1
+
+            merged[key] = (optimized, value)
+            results.append(merged[key])
+
+        root = results[0][0]
+        shared = {id(node) for node, _ in merged.values() if uses.get(id(node), 0) > 1 and node.name not in unshared}
+
+        return root, shared
+
+    def _compile(self, node: RuleMatch, shared: Set[int], compiled: Dict[int, Callable]) -> Callable[[Dict[str, RuleMatch], Dict], Value]:
+        # Each closure takes the variables and a memo of the shared subtrees evaluated so far in this call.
+        if id(node) in compiled:
+            return compiled[id(node)]
+
+        evaluate = self._compile_node(node, shared, compiled)
+
+        if id(node) in shared:
+            unshared = evaluate
+            key = id(node)
+
+            def evaluate(vrs, memo):
+                if key not in memo:
+                    memo[key] = unshared(vrs, memo)
+
+                return memo[key]
+
+        compiled[id(node)] = evaluate
+        return evaluate
+
+    def _compile_node(self, node: RuleMatch, shared: Set[int], compiled: Dict[int, Callable]) -> Callable[[Dict[str, RuleMatch], Dict], Value]:
+        if node.name == 'cst':
+            value = node.value
+            return lambda vrs, memo: value
+
+        if node.name == 'asn':
+            rule = node.matched[1]
+            idts = [idt.value for idt in node.matched[0].matched]
+            return lambda vrs, memo: {idt: (i, rule) for i, idt in enumerate(idts)}
 
         if node.matched[0].name == 'IDT':
-            i, rule = vrs[node.matched[0].value]
-            result = self._evaluate(copy.deepcopy(rule), vrs)
+            name = node.matched[0].value
+            variable = self._variable
+            return lambda vrs, memo: variable(name, vrs)
+
+        if node.name == 'num':
+            value = rule_value_map['num']([], node.matched)
+            return lambda vrs, memo: value
+
+        children = [self._compile(child, shared, compiled) for child in node.matched if isinstance(child, RuleMatch)]
+        tokens = [token for token in node.matched if not isinstance(token, RuleMatch)]
 
-            if isinstance(result, TupleValue):
-                return result.value[i]
+        if node.name in rule_value_map:
+            build = rule_value_map[node.name]
+            return lambda vrs, memo: build([child(vrs, memo) for child in children], tokens)
 
-            return result
+        elif node.name == 'neg':
+            symbol = tokens[0].value
+            operand, = children
+            return lambda vrs, memo: unary_operation(symbol, operand(vrs, memo))
 
-        elif node.name in rule_value_map:
-            return rule_value_map[node.name](values, tokens)
+        elif node.name == 'opr':
+            # The arguments are compiled individually instead of being collected into a TupleValue first.
+            operation = tokens[0].value
+            first, *rest = [self._compile(arg, shared, compiled) for arg in node.matched[1].matched]
+            return lambda vrs, memo: getattr(first(vrs, memo), operation)(*[arg(vrs, memo) for arg in rest])
 
-        else:
-            return rule_value_operation_map[node.name](values, tokens[0] if len(tokens) > 0 else None)  # This extra rule is part of the num hotfix.
+        symbol = tokens[0].value
+        left, right = children
+        return lambda vrs, memo: binary_operation(symbol, left(vrs, memo), right(vrs, memo))
 
     def infix(self) -> str:
         return self._infix(self.root)
 
     def _infix(self, node: RuleMatch) -> str:
         # TODO: Add missing tokens.
-        s = ''
+        # The tokens are written out in order by walking the tree with an explicit stack, and joined once at the end.
+        pieces = []
+        opened = ''
+        stack = [node]
+
+        while stack:
+            item = stack.pop()
+
+            if item is open_parenthesis:
+                opened += '('
 
-        if len(node.matched) == 1:
-            s += node.matched[0].value
+            elif item is close_parenthesis:
+                pieces[-1] += ')'
 
-        else:
-            for c in [node.matched[1]] + [node.matched[0]] + node.matched[2:]:
-                if isinstance(c, RuleMatch):
-                    if c.name in precedence and node.name in precedence and precedence.index(c.name) > precedence.index(node.name):
-                        s += '(' + self._infix(c) + ') '
+            elif not isinstance(item, RuleMatch):
+                pieces.append(opened + item.value)
+                opened = ''
+
+            elif len(item.matched) == 1:
+                stack.append(item.matched[0])
+
+            else:
+                for c in reversed([item.matched[1]] + [item.matched[0]] + item.matched[2:]):
+                    if isinstance(c, RuleMatch) and c.name in precedence and item.name in precedence and precedence.index(c.name) > precedence.index(item.name):
+                        stack.extend((close_parenthesis, c, open_parenthesis))
 
                     else:
-                        s += self._infix(c) + ' '
-                else:
-                    s += c.value + ' '
+                        stack.append(c)
 
-        return s.strip()
+        return ' '.join(pieces)
 
     def prefix(self) -> str:
         return self._prefix(self.root)
 
     def _prefix(self, node: RuleMatch) -> str:
-        s = ''
-
-        for c in node.matched:
-            if isinstance(c, RuleMatch):
-                s += self._prefix(c) + ' '
-            else:
-                s += c.value + ' '
-
-        return s.strip()
+        return ' '.join(token.value for token in self._tokens(node, lambda matched: matched))
 
     def postfix(self) -> str:
         return self._postfix(self.root)
 
     def _postfix(self, node: RuleMatch) -> str:
-        s = ''
+        return ' '.join(token.value for token in self._tokens(node, lambda matched: matched[1:] + [matched[0]]))
 
-        for c in node.matched[1:] + [node.matched[0]]:
-            if isinstance(c, RuleMatch):
-                s += self._postfix(c) + ' '
-            else:
-                s += c.value + ' '
+    @staticmethod
+    def _tokens(node: RuleMatch, order: Callable[[list], list]) -> Iterator[Token]:
+        # Yields the tokens of the tree depth first, visiting the matched of each node in the given order.
+        stack = [node]
+
+        while stack:
+            item = stack.pop()
 
-        return s.strip()
+            if isinstance(item, RuleMatch):
+                stack.extend(reversed(order(item.matched)))
+
+            else:
+                yield item
+
+    def copy(self) -> 'Ast':
+        """
+        Returns an Ast with a copy of the tree, so that values can be recorded on it. Tokens are immutable, so they are
+        shared.
+        """
+        root = RuleMatch(self.root.name, list(self.root.matched))
+        stack = [root]
+
+        while stack:
+            node = stack.pop()
+
+            for i, child in enumerate(node.matched):
+                if isinstance(child, RuleMatch):
+                    node.matched[i] = RuleMatch(child.name, list(child.matched))
+                    node.matched[i].value = child.value
+                    stack.append(node.matched[i])
+
+        root.value = self.root.value
+        return Ast(root, fixed=True)
 
     def __str__(self):
         return str(self.root)  # + '\n>> ' + self.infix()
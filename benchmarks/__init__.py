@@ -0,0 +1,3 @@
+"""
+Microbenchmarks for the calculator. See benchmarks.run.
+"""
@@ -0,0 +1,190 @@
+"""
+A load test for server.py. Each connection sends its requests with up to --pipeline of them waiting at a time, and the
+throughput and latencies of the responses are printed. Run it from the repository root:
+
+    python -m benchmarks.loadtest                                starts a server in this process and tests it
+    python -m benchmarks.loadtest --port 7878 -c 16 -n 5000      tests a server which is already running
+    python -m benchmarks.loadtest --mix matrix --matrix-size 32  sends only matrix requests
+"""
+from typing import Dict, List, Tuple
+
+import argparse
+import json
+import math
+import random
+import socket
+import sys
+import threading
+import time
+
+from benchmarks.run import expression, matrix
+
+mixes = ('scalar', 'matrix', 'mixed')
+
+
+def requests(mix: str, n: int, matrix_size: int, seed=0) -> Tuple[List[str], List[str]]:
+    """
+    The equations a connection sends before it is timed, which define its variables, and the n equations it sends while
+    it is timed. In the mixed load, one request in ten uses the matrix.
+    """
+    rng = random.Random(seed)
+    rows = matrix(matrix_size, matrix_size, seed)
+    setup = ['M = [{}]'.format(' | '.join(', '.join(repr(cell) for cell in row) for row in rows)), 'a = 2; b = a + 1']
+    eqtns = []
+
+    for i in range(n):
+        if mix == 'matrix' or mix == 'mixed' and i % 10 == 9:
+            eqtns.append(rng.choice(('det(M)', 'inv(M)', 'det(M * M) + a')))
+
+        else:
+            eqtns.append('{} + a * b'.format(expression(rng.randint(2, 20), rng.random())))
+
+    return setup, eqtns
+
+
+def connection(address, session, setup: List[str], eqtns: List[str], pipeline: int, latencies: List[float], errors: List[str]):
+    # Responses come back in the order the requests were sent, so the oldest request waiting is the one answered.
+    with socket.create_connection(address) if isinstance(address, tuple) else _unix(address) as sock:
+        if sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        lines = sock.makefile('rb')
+
+        def request(eqtn):
+            return (json.dumps({'eqtn': eqtn} if session is None else {'eqtn': eqtn, 'session': session}) + '\n').encode()
+
+        for eqtn in setup:
+            sock.sendall(request(eqtn))
+            error = json.loads(lines.readline())['error']
+
+            if error is not None:
+                raise ValueError('Cannot set up the connection: {}'.format(error))
+
+        sent = []
+        i = 0
+
+        while i < len(eqtns) or sent:
+            if i < len(eqtns) and len(sent) < pipeline:
+                # Everything that fits in the pipeline is sent at once.
+                batch = eqtns[i:i + pipeline - len(sent)]
+                now = time.perf_counter()
+                sock.sendall(b''.join(request(eqtn) for eqtn in batch))
+                sent.extend([now] * len(batch))
+                i += len(batch)
+
+            line = lines.readline()
+
+            if not line:
+                raise ConnectionError('The server closed the connection')
+
+            latencies.append(time.perf_counter() - sent.pop(0))
+            error = json.loads(line)['error']
+
+            if error is not None:
+                errors.append(error)
+
+
+def _unix(path: str) -> socket.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    return sock
+
+
+def percentile(times: List[float], q: float) -> float:
+    # The nearest-rank percentile of sorted times.
+    return times[max(0, math.ceil(q / 100 * len(times)) - 1)] if times else 0.0
+
+
+def run(address, connections: int, n: int, pipeline: int, mix: str, matrix_size: int, shared=False) -> Dict:
+    """
+    Sends n requests on each of the connections at once and returns the throughput in requests per second, and the
+    latencies in seconds. With shared, every connection uses the same named session instead of its own.
+    """
+    latencies = [[] for _ in range(connections)]
+    errors = []
+    failures = []
+    threads = []
+
+    def target(i):
+        setup, eqtns = requests(mix, n, matrix_size, i)
+
+        try:
+            connection(address, 'loadtest' if shared else None, setup, eqtns, pipeline, latencies[i], errors)
+
+        except Exception as e:
+            failures.append(e)
+
+    start = time.perf_counter()
+
+    for i in range(connections):
+        threads.append(threading.Thread(target=target, args=(i,)))
+        threads[-1].start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    if failures:
+        raise failures[0]
+
+    times = sorted(t for connection_times in latencies for t in connection_times)
+    return {
+        'requests': len(times),
+        'errors': len(errors),
+        'seconds': elapsed,
+        'throughput': len(times) / elapsed,
+        'mean': sum(times) / len(times) if times else 0.0,
+        'p50': percentile(times, 50),
+        'p99': percentile(times, 99),
+        'max': times[-1] if times else 0.0,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadtest', description='Measures the throughput and latency of server.py.')
+    parser.add_argument('--host', default='127.0.0.1', help='the address of the server')
+    parser.add_argument('-p', '--port', type=int, help='the port of a running server; without it or --unix, a server is started in this process')
+    parser.add_argument('-u', '--unix', help='the Unix socket of a running server')
+    parser.add_argument('-c', '--connections', type=int, default=8, help='the number of connections sending at once')
+    parser.add_argument('-n', '--requests', type=int, default=2000, help='the number of requests each connection sends')
+    parser.add_argument('--pipeline', type=int, default=16, help='the number of requests each connection has waiting at a time')
+    parser.add_argument('--mix', choices=mixes, default='mixed', help='the kinds of equations sent')
+    parser.add_argument('--matrix-size', type=int, default=16, help='the number of rows and columns of the matrix')
+    parser.add_argument('--shared', action='store_true', help='send every request to one named session')
+    parser.add_argument('-w', '--workers', type=int, help='the number of worker processes of the server started here')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    server = None
+
+    if args.port is None and args.unix is None:
+        from server import EvaluationServer
+        server = EvaluationServer(workers=args.workers)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.wait_started()
+        address = server.address
+
+    else:
+        address = args.unix or (args.host, args.port)
+
+    try:
+        results = run(address, args.connections, args.requests, args.pipeline, args.mix, args.matrix_size, args.shared)
+
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    else:
+        print('{} requests on {} connections in {:.2f} s, {} errors'.format(results['requests'], args.connections, results['seconds'], results['errors']))
+        print('throughput {:.0f} requests/s'.format(results['throughput']))
+        print('latency    mean {:.2f} ms, p50 {:.2f} ms, p99 {:.2f} ms, max {:.2f} ms'.format(*(results[key] * 1e3 for key in ('mean', 'p50', 'p99', 'max'))))
+
+    return 1 if results['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,337 @@
+"""
+Microbenchmarks for the tokenizer, the parsers, evaluation and the matrix kernels. Run them from the repository root:
+
+    python -m benchmarks.run                                runs every benchmark and prints the times
+    python -m benchmarks.run -k matrix/det -k parse         runs the benchmarks whose names contain matrix/det or parse
+    python -m benchmarks.run -o benchmarks/baseline.json    stores the times as the baseline
+    python -m benchmarks.run --threshold 0.1                fails if a benchmark is more than 10% slower than the baseline
+
+The times are compared against benchmarks/baseline.json when it exists, or the file given with --baseline.
+"""
+from collections import OrderedDict
+from typing import Callable, Dict, List, Tuple
+
+import argparse
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from cache import ExpressionCache
+from calculator import Calculator
+import vartypes
+
+# Bumped whenever the results file changes, so old baselines aren't compared against new results.
+version = 1
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Every benchmark by name. A benchmark is a function which sets up its inputs and returns the function to time.
+benchmarks = OrderedDict()
+
+expression_sizes = (10, 100, 1000)
+chain_sizes = (10, 30, 100)
+matrix_sizes = (4, 16, 64)
+
+
+def expression(terms: int, seed=0) -> str:
+    # An infix equation with the given number of terms. The operators don't overflow or divide by zero.
+    rng = random.Random(seed)
+    parts = [str(rng.randint(1, 9))]
+
+    for _ in range(terms - 1):
+        parts.append(rng.choice(('+', '-', '*', '/')))
+        parts.append(str(rng.randint(1, 9)))
+
+    return ' '.join(parts)
+
+
+def matrix(rows: int, cols: int, seed=0) -> List[List[float]]:
+    # A random matrix. Square ones are diagonally dominant, so they are well conditioned and never singular.
+    rng = random.Random(seed)
+    return [[rng.uniform(-1, 1) + (cols if row == col else 0) for col in range(cols)] for row in range(rows)]
+
+
+def variable(i: int) -> str:
+    # Identifiers can only contain letters and underscores, so variable i is named in base 26.
+    name = ''
+
+    while True:
+        name = chr(ord('a') + i % 26) + name
+        i //= 26
+
+        if not i:
+            return 'v_' + name
+
+
+def tokenize(terms: int) -> Callable:
+    calc = Calculator()
+    eqtn = expression(terms)
+    return lambda: calc._tokenize(eqtn)
+
+
+def parse(terms: int, reference: bool) -> Callable:
+    calc = Calculator(reference=reference)
+    tokens = calc._tokenize(expression(terms))
+    return lambda: calc._parse(tokens, 'infix')
+
+
+def evaluate(terms: int, tpe: str, cached: bool) -> Callable:
+    # Uncached equations are tokenized and parsed on every call; cached ones are evaluated from their compiled tree.
+    eqtn = Calculator(cache=None)._compile(expression(terms), 'infix')
+    eqtn = eqtn.infix() if tpe == 'infix' else eqtn.prefix() if tpe == 'prefix' else eqtn.postfix()
+    calc = Calculator(cache=ExpressionCache() if cached else None)
+    calc.evaluate(eqtn, tpe, False)
+    return lambda: calc.evaluate(eqtn, tpe, False)
+
+
+def chain(n: int) -> Callable:
+    # n variables which each depend on the one before. Assigning the first one again recomputes all of them.
+    calc = Calculator()
+    calc.evaluate('; '.join(['{} = 1'.format(variable(0))] + ['{} = {} + 1'.format(variable(i), variable(i - 1)) for i in range(1, n)]), 'infix', False)
+    eqtn = '{} = 2; {}'.format(variable(0), variable(n - 1))
+    return lambda: calc.evaluate(eqtn, 'infix', False)
+
+
+def matrix_operation(op: str, n: int) -> Callable:
+    a = vartypes.MatrixValue(matrix(n, n))
+
+    if op == 'mul':
+        b = vartypes.MatrixValue(matrix(n, n, 1))
+        return lambda: a.mul(b)
+
+    if op == 'rref':
+        # MatrixValue caches its reduced form, so each call starts without it.
+        def rref():
+            a._rref_cache = None
+            return a.rref()
+
+        return rref
+
+    if op == 'solve':
+        answer = vartypes.MatrixValue([[row[0] for row in matrix(n, 1, 1)]])
+        return lambda: a.solve(answer)
+
+    if op == 'ls':
+        tall = vartypes.MatrixValue(matrix(2 * n, n))
+        b = vartypes.MatrixValue(matrix(2 * n, 1, 1))
+        return lambda: tall.ls(b)
+
+    return getattr(a, op)
+
+
+def construct() -> Callable:
+    # A Value is built for every node evaluated, so how fast they are built and how much memory each one takes matter.
+    return lambda: vartypes.NumberValue(1.5)
+
+
+for size in expression_sizes:
+    benchmarks['tokenize/{}'.format(size)] = lambda size=size: tokenize(size)
+
+for size in expression_sizes:
+    benchmarks['parse/infix/{}'.format(size)] = lambda size=size: parse(size, False)
+    benchmarks['parse/reference/{}'.format(size)] = lambda size=size: parse(size, True)
+
+for size in expression_sizes:
+    for notation in ('infix', 'prefix', 'postfix'):
+        benchmarks['evaluate/{}/{}'.format(notation, size)] = lambda size=size, notation=notation: evaluate(size, notation, False)
+
+    benchmarks['evaluate/cached/{}'.format(size)] = lambda size=size: evaluate(size, 'infix', True)
+
+for size in chain_sizes:
+    benchmarks['variables/chain/{}'.format(size)] = lambda size=size: chain(size)
+
+for operation in ('mul', 'det', 'inv', 'cof', 'rref', 'solve', 'ls', 'qr'):
+    for size in matrix_sizes:
+        benchmarks['matrix/{}/{}'.format(operation, size)] = lambda operation=operation, size=size: matrix_operation(operation, size)
+
+benchmarks['values/construct'] = construct
+
+# The benchmarks whose functions build an object, which also record the bytes each object takes.
+memory_benchmarks = ('values/construct',)
+
+
+def measure(f: Callable, min_time=0.05, repeat=5, clock=time.perf_counter) -> Dict:
+    """
+    Times f like timeit: the number of calls per run is raised until a run takes at least min_time, and the fastest of
+    repeat runs gives the time per call, in seconds. The median is kept to show how noisy the runs were. clock can be
+    time.process_time to leave out the time other processes get the CPU for.
+    """
+    number = 1
+
+    while True:
+        elapsed = _run(f, number, clock)
+
+        if elapsed >= min_time:
+            break
+
+        number = max(number + 1, int(number * min_time / max(elapsed, 1e-9) * 1.2))
+
+    times = [elapsed / number] + [_run(f, number, clock) / number for _ in range(repeat - 1)]
+    return {'seconds': min(times), 'median': statistics.median(times), 'number': number, 'repeat': repeat}
+
+
+def _run(f: Callable, number: int, clock=time.perf_counter) -> float:
+    # Garbage collection is paused while timing, like timeit, so it doesn't land on a random benchmark.
+    enabled = gc.isenabled()
+    gc.disable()
+
+    try:
+        start = clock()
+
+        for _ in range(number):
+            f()
+
+        return clock() - start
+
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def allocated(f: Callable, number=10000) -> float:
+    """
+    The bytes taken by each object f returns, from the memory tracemalloc sees allocated while number of them are built
+    and kept alive.
+    """
+    # The list is allocated before measuring, so only the objects themselves are counted.
+    objects = [None] * number
+    gc.collect()
+    tracemalloc.start()
+
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+
+        for i in range(number):
+            objects[i] = f()
+
+        return (tracemalloc.get_traced_memory()[0] - before) / number
+
+    finally:
+        tracemalloc.stop()
+
+
+def run(names: List[str], min_time=0.05, repeat=5, out=None) -> Dict:
+    """
+    Runs the named benchmarks and returns the results file as a dict. Each result is written to out as it finishes.
+    """
+    results = OrderedDict()
+
+    for name in names:
+        f = benchmarks[name]()
+        results[name] = measure(f, min_time, repeat)
+        line = '{:<28}{:>14}'.format(name, _format(results[name]['seconds']))
+
+        if name in memory_benchmarks:
+            results[name]['bytes'] = allocated(f)
+            line += '{:>16,.0f} objects/s{:>8.0f} bytes/object'.format(1 / results[name]['seconds'], results[name]['bytes'])
+
+        if out is not None:
+            out.write(line + '\n')
+            out.flush()
+
+    return {
+        'version': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'backend': vartypes.matrix_backend.name,
+        'results': results,
+    }
+
+
+def compare(results: Dict, baseline: Dict) -> List[Tuple[str, float, float, float]]:
+    """
+    Returns (name, baseline seconds, seconds, ratio) for every benchmark in both results, in order. A benchmark has
+    regressed when its ratio is more than 1 + threshold; see regressions. Benchmarks which record the bytes of their
+    objects are followed by a row for the bytes, named like values/construct bytes.
+    """
+    if baseline.get('version') != version:
+        raise ValueError('The baseline is from version {} of the benchmarks, not {}'.format(baseline.get('version'), version))
+
+    comparison = []
+
+    for name, result in results['results'].items():
+        if name in baseline['results']:
+            before = baseline['results'][name]['seconds']
+            comparison.append((name, before, result['seconds'], result['seconds'] / before if before else float('inf')))
+
+            if 'bytes' in result and 'bytes' in baseline['results'][name]:
+                before = baseline['results'][name]['bytes']
+                comparison.append((name + ' bytes', before, result['bytes'], result['bytes'] / before if before else float('inf')))
+
+    return comparison
+
+
+def regressions(comparison: List[Tuple[str, float, float, float]], threshold: float) -> List[Tuple[str, float, float, float]]:
+    return [row for row in comparison if row[3] > 1 + threshold]
+
+
+def _format_row(name: str, value: float) -> str:
+    return '{:.0f} B'.format(value) if name.endswith(' bytes') else _format(value)
+
+
+def _format(seconds: float) -> str:
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '{:.3f} {}'.format(seconds / scale, unit)
+
+    return '{:.1f} ns'.format(seconds / 1e-9)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description='Times the tokenizer, the parsers, evaluation and the matrix kernels.')
+    parser.add_argument('-k', '--filter', action='append', default=[], help='only run the benchmarks whose names contain this; can be repeated')
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-b', '--baseline', help='compare against this results file instead of benchmarks/baseline.json')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25, help='the slowdown over the baseline which counts as a regression (0.25 is 25%%)')
+    parser.add_argument('--min-time', type=float, default=0.05, help='the shortest time in seconds each run of a benchmark takes')
+    parser.add_argument('--repeat', type=int, default=5, help='the number of runs of each benchmark')
+    parser.add_argument('--backend', choices=('python', 'numpy'), default='python', help='the matrix kernels to use')
+    parser.add_argument('-l', '--list', action='store_true', help='list the benchmarks instead of running them')
+    args = parser.parse_args(argv)
+
+    vartypes.set_matrix_backend(args.backend)
+    names = [name for name in benchmarks if not args.filter or any(pattern in name for pattern in args.filter)]
+
+    if args.list:
+        print('\n'.join(names))
+        return 0
+
+    # The baseline is read before anything runs, so that -o can replace it.
+    baseline_path = args.baseline or default_baseline
+    baseline = None
+
+    if args.baseline or os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    results = run(names, args.min_time, args.repeat, sys.stdout)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is None:
+        return 0
+
+    comparison = compare(results, baseline)
+    slower = regressions(comparison, args.threshold)
+    print('\nCompared with {}:'.format(baseline_path))
+
+    for name, before, after, ratio in comparison:
+        print('{:<28}{:>14}{:>14}{:>+9.1%}{}'.format(name, _format_row(name, before), _format_row(name, after), ratio - 1, '  REGRESSION' if ratio > 1 + args.threshold else ''))
+
+    if slower:
+        print('\n{} of {} benchmarks are more than {:.0%} slower than the baseline.'.format(len(slower), len(comparison), args.threshold))
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
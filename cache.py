@@ -0,0 +1,81 @@
+"""
+This file contains the ExpressionCache class, which keeps the most recently used parsed equations so they aren't parsed again.
+"""
+from collections import OrderedDict, namedtuple
+
+CacheInfo = namedtuple('CacheInfo', ('hits', 'misses', 'evictions', 'maxsize', 'currsize'))
+
+
+class ExpressionCache:
+    """
+    A bounded LRU mapping from (normalized equation, notation) to a fixed Ast. The cached trees are shared, so they
+    must never be modified; Ast#evaluate leaves them alone unless asked to record values. A maxsize of 0 disables the
+    cache.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = _checked(maxsize)
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(eqtn: str, tpe: str):
+        # Runs of whitespace are never significant beyond separating tokens, so they are collapsed to a single space.
+        return ' '.join(eqtn.split()), tpe
+
+    def get(self, key):
+        ast = self._data.get(key)
+
+        if ast is None:
+            self.misses += 1
+
+        else:
+            self.hits += 1
+            self._data.move_to_end(key)
+
+        return ast
+
+    def put(self, key, ast):
+        if not self.maxsize:
+            return
+
+        self._data[key] = ast
+        self._data.move_to_end(key)
+        self._evict()
+
+    def resize(self, maxsize):
+        self.maxsize = _checked(maxsize)
+        self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+
+def _checked(maxsize: int) -> int:
+    if maxsize < 0:
+        raise ValueError('The maxsize of a cache cannot be negative, but was {}'.format(maxsize))
+
+    return maxsize
+
+
+# The cache shared by every Calculator which isn't given its own.
+expression_cache = ExpressionCache()
@@ -1,112 +1,416 @@
 """
 This file contains the Calculator class, which accept an equation and generates an AST, and also keeps track of variables.
 """
-from typing import List
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Tuple
 
+import contextlib
+import itertools
+import math
 import re
+import time
 
 from ast import Ast
-from common import Token, token_map, rules_map, RuleMatch, ImmutableIndexedDict
-from vartypes import Value
+from cache import ExpressionCache, expression_cache
+from common import EvaluationException, Token, token_map, rules_map, RuleMatch, ImmutableIndexedDict, import_numpy
+from infix import InfixParser
+from notation import prefix, postfix
+from stats import Stats
+from variables import Variables
+from vartypes import NumberValue, Value
+import vartypes
+
+# The tokenizer is compiled once. Each token pattern gets its own named group so that a match resolves to its token
+# name in O(1), and anything that is neither a token nor whitespace falls through to the ILLEGAL group.
+token_names = {'T{}'.format(i): name for i, name in enumerate(token_map.values())}
+token_regex = re.compile('|'.join('(?P<T{}>{})'.format(i, pattern) for i, pattern in enumerate(token_map.keys())) + r'|(?P<SKIP>\s+)|(?P<ILLEGAL>.)', re.DOTALL)
+
+stack_machines = {
+    'prefix': prefix,
+    'postfix': postfix,
+}
+
+# The outcome of one equation in Calculator#evaluate_many. Exactly one of value and error is set, unless the equation
+# only assigns variables, in which case both are None.
+BatchResult = namedtuple('BatchResult', ('value', 'error'))
 
 
 class Calculator:
-    def __init__(self):
-        self.vrs = {}
+    def __init__(self, reference=False, cache=expression_cache, store=None, instrumented=False):
+        self.vrs = Variables()
+        # When True, equations go through the original _match and Ast#_fixed path instead of InfixParser and the stack
+        # machines. The results are the same, so this is used to test them.
+        self.reference = reference
+        # Parsed equations are shared through the cache, so reference calculators don't use one. None disables it.
+        self.cache = None if reference else cache
+        # An ExpressionStore of trees parsed ahead of time, which is checked before an equation is parsed.
+        self.store = None if reference else store
+        # While instrumented, every phase of evaluate is timed into stats(). Otherwise nothing is recorded.
+        self.instrumented = False
+        self._stats = Stats()
+        # A function of the equation and its notation which returns a context manager that every evaluate call runs in,
+        # like stats.profile_calls. None disables it.
+        self.profile = None
+
+        if instrumented:
+            self.instrument()
+
+    def instrument(self, enabled=True):
+        """
+        Starts (or stops) recording the time of every phase of evaluate, and the tokens, parser backtracks and Values
+        built, into stats(). Values are counted across the whole process while any calculator is instrumented. Equations
+        evaluated by worker processes are not recorded.
+        """
+        if enabled != self.instrumented:
+            self.instrumented = enabled
+            vartypes.track_allocations(enabled)
+
+    def stats(self) -> Stats:
+        return self._stats
 
     def evaluate(self, eqtn: str, tpe: str, verbose=True) -> Value:
-        for e in eqtn.split(';'):
-            tokens = self._tokenize(e)
-
-            # Because postfix is not conducive to recursive descent, we must convert it to prefix first.
-            if tpe == 'postfix':
-                stack = []
+        if not self.instrumented and self.profile is None:
+            return self._evaluate(eqtn, tpe, verbose)
 
-                for token in tokens:
-                    if token.name == 'NUM':
-                        stack.append(token)
+        with self.profile(eqtn, tpe) if self.profile else contextlib.nullcontext():
+            if not self.instrumented:
+                return self._evaluate(eqtn, tpe, verbose)
 
-                    else:
-                        a = stack.pop()
+            allocations = vartypes.allocations
+            start = time.perf_counter()
 
-                        if isinstance(a, Token):
-                            a = a.value
+            try:
+                return self._evaluate(eqtn, tpe, verbose)
 
-                        b = stack.pop()
+            finally:
+                self._stats.record('total', time.perf_counter() - start)
+                self._stats.count('calls')
+                self._stats.count('values', vartypes.allocations - allocations)
 
-                        if isinstance(b, Token):
-                            b = b.value
+    def _evaluate(self, eqtn: str, tpe: str, verbose: bool) -> Value:
+        for e in eqtn.split(';'):
+            # Without a cache, prefix and postfix expressions are evaluated straight from the tokens unless a tree is needed.
+            if self.cache is None and tpe in stack_machines and not self.reference and not verbose:
+                tokens = self._tokenize(e)
 
-                        stack.append('{} {} {}'.format(token.value, b, a))
+                if not tokens or tokens[0].name != 'EQL':
+                    return self._timed('evaluate', stack_machines[tpe].evaluate, tokens, self.vrs)
 
-                tpe = 'prefix'
-                tokens = self._tokenize(stack[0])
+                ast = self._parse(tokens, tpe)
 
-            root, remaining_tokens = self._match(tokens, 'asn', rules_map[tpe])
+            else:
+                ast = self._compile(e, tpe)
 
-            if remaining_tokens:
-                raise Exception('Invalid equation (bad format)')
+            if verbose:
+                # The tree may be shared with the cache, so the values are recorded on a copy of it.
+                ast = ast.copy()
+                res = self._timed('evaluate', ast.evaluate, self.vrs, True)
 
-            ast = Ast(root)
-            res = ast.evaluate(self.vrs)
+            else:
+                res = self._timed('evaluate', ast.run, self.vrs)
 
             if isinstance(res, Value):
-                ast.root.value = res
-
                 if verbose:
-                    print(ast)
-                    print('Infix: ' + ast.infix())
-                    print('Prefix: ' + ast.prefix())
-                    print('Postfix: ' + ast.postfix())
+                    ast.root.value = res
+                    self._timed('render', self._render, ast)
 
                 return res
 
             elif isinstance(res, dict):
-                print(ast)
+                if verbose:
+                    self._timed('render', print, ast)
+
                 self.vrs.update(res)
 
-    def _tokenize(self, eqtn: str) -> List[Token]:
-        tokens = []
+    @staticmethod
+    def _render(ast: Ast):
+        print(ast)
+        print('Infix: ' + ast.infix())
+        print('Prefix: ' + ast.prefix())
+        print('Postfix: ' + ast.postfix())
+
+    def _timed(self, phase: str, f: Callable, *args):
+        # Calls f, and records how long it took as phase while the calculator is instrumented.
+        if not self.instrumented:
+            return f(*args)
+
+        start = time.perf_counter()
+
+        try:
+            return f(*args)
+
+        finally:
+            self._stats.record(phase, time.perf_counter() - start)
+
+    def evaluate_many(self, eqtns: Iterable[str], tpe: str, workers=None, chunksize=None) -> List[BatchResult]:
+        """
+        Evaluates independent equations and returns a BatchResult for each one, in order. Every equation sees the
+        variables of this calculator, but assignments made by one equation are not seen by the others.
+        With workers, the equations are split into chunks of chunksize which a pool of processes evaluates.
+        """
+        eqtns = list(eqtns)
+
+        if not workers or workers <= 1:
+            return _evaluate_chunk(self, eqtns, tpe)
+
+        if not chunksize:
+            chunksize = max(1, math.ceil(len(eqtns) / (workers * 4)))
+
+        chunks = [eqtns[i:i + chunksize] for i in range(0, len(eqtns), chunksize)]
+        results = []
+
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self.vrs.entries(), self.reference, self.store and self.store.path)) as pool:
+            for chunk_results in pool.map(_evaluate_worker_chunk, chunks, itertools.repeat(tpe)):
+                results.extend(chunk_results)
+
+        return results
+
+    def evaluate_stream(self, eqtns: Iterable[str], tpe: str, workers=None, chunksize=256) -> Iterator[BatchResult]:
+        """
+        The same as evaluate_many, but the equations are read lazily and each BatchResult is yielded in order as soon as
+        it is ready, so any number of equations can be evaluated in constant memory. With workers, at most two chunks
+        per worker are waiting to be evaluated or collected at a time.
+        """
+        chunks = _chunks(eqtns, chunksize)
+
+        if not workers or workers <= 1:
+            for chunk in chunks:
+                yield from _evaluate_chunk(self, chunk, tpe)
+
+            return
+
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(self.vrs.entries(), self.reference, self.store and self.store.path)) as pool:
+            pending = deque()
+
+            for chunk in chunks:
+                pending.append(pool.submit(_evaluate_worker_chunk, chunk, tpe))
+
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+
+            while pending:
+                yield from pending.popleft().result()
+
+    def evaluate_vectorized(self, eqtn: str, tpe: str, columns: Dict[str, object]):
+        """
+        Evaluates eqtn once for a whole table of inputs. Each column binds a variable to a sequence of numbers, so
+        evaluate_vectorized('pi * r ^ 2', 'infix', {'r': radii}) returns an array with the area for every radius.
+        The columns must broadcast against each other, and the result must be a number. This requires NumPy.
+        """
+        numpy = import_numpy()
+
+        columns = {name: numpy.asarray(column, dtype=float) for name, column in columns.items()}
+
+        try:
+            shape = numpy.broadcast_shapes(*(column.shape for column in columns.values()))
+
+        except ValueError:
+            raise EvaluationException('Cannot broadcast columns of shapes {}'.format(', '.join(str(column.shape) for column in columns.values())))
+
+        # The columns are bound on a copy of the variables, so that variables which depend on them are recomputed.
+        vrs = self.vrs
+        self.vrs = vrs.copy()
+        self.vrs.update({name: NumberValue(column) for name, column in columns.items()})
+
+        try:
+            res = self.evaluate(eqtn, tpe, False)
+
+        finally:
+            self.vrs = vrs
+
+        if not isinstance(res, NumberValue):
+            raise EvaluationException('Vectorized equations must evaluate to a number, not a {}'.format(res.type if res else None))
+
+        return numpy.broadcast_to(numpy.asarray(res.value, dtype=float), shape)
+
+    def compile(self, eqtn: str, tpe: str) -> Callable[[Dict], Value]:
+        """
+        Compiles a single equation into a function which takes the variables and returns the result. Variables can be
+        bound to Values or numbers, like compile('pi * r ^ 2', 'infix')({'pi': 3.14159, 'r': 2}).
+        """
+        return self._compile(eqtn, tpe).compile()
+
+    def _compile(self, eqtn: str, tpe: str) -> Ast:
+        if self.cache is None:
+            return self._load(eqtn, tpe)
+
+        key = self.cache.key(eqtn, tpe)
+        ast = self.cache.get(key)
+
+        if ast is None:
+            ast = self._load(eqtn, tpe)
+            self.cache.put(key, ast)
+
+        return ast
+
+    def _load(self, eqtn: str, tpe: str) -> Ast:
+        if self.store is not None:
+            ast = self._timed('load', self.store.get, ExpressionCache.key(eqtn, tpe))
+
+            if ast is not None:
+                return ast
+
+        return self._parse(self._tokenize(eqtn), tpe)
 
-        if re.sub('(' + ')|('.join(token_map.keys()) + ')', '', 'eqtn').strip():
-            raise Exception('Invalid equation (illegal tokens)')
+    def _parse(self, tokens: List[Token], tpe: str) -> Ast:
+        if not self.reference:
+            if tpe == 'infix':
+                return Ast(self._timed('parse', InfixParser(tokens).parse), fixed=True)
 
-        for match in re.findall('(' + ')|('.join(token_map.keys()) + ')', eqtn):
-            entry = next(filter(lambda entry: entry[1] != '', enumerate(match)), None)
-            tokens.append(Token(list(token_map.values())[entry[0]], entry[1]))
+            return Ast(self._timed('parse', stack_machines[tpe].tree, tokens), fixed=True)
+
+        # Because postfix is not conducive to recursive descent, we must convert it to prefix first.
+        if tpe == 'postfix':
+            tokens = self._postfix_to_prefix(tokens)
+            tpe = 'prefix'
+
+        root, remaining_tokens = self._timed('parse', self._match, tokens, 'asn', rules_map[tpe])
+
+        if root is None or remaining_tokens:
+            raise Exception('Invalid equation (bad format)')
+
+        return self._timed('fix', Ast, root)
+
+    def _postfix_to_prefix(self, tokens: List[Token]) -> List[Token]:
+        stack = []
+
+        for token in tokens:
+            if token.name == 'NUM':
+                stack.append(token)
+
+            else:
+                a = stack.pop()
+
+                if isinstance(a, Token):
+                    a = a.value
+
+                b = stack.pop()
+
+                if isinstance(b, Token):
+                    b = b.value
+
+                stack.append('{} {} {}'.format(token.value, b, a))
+
+        return self._tokenize(stack[0])
+
+    def _tokenize(self, eqtn: str) -> List[Token]:
+        tokens = self._timed('tokenize', list, self._itokenize(eqtn))
+
+        if self.instrumented:
+            self._stats.count('tokens', len(tokens))
 
         return tokens
 
+    @staticmethod
+    def _itokenize(eqtn: str) -> Iterator[Token]:
+        # Tokens are validated as they are scanned, so this yields lazily and raises on the first illegal character.
+        for match in token_regex.finditer(eqtn):
+            group = match.lastgroup
+
+            if group == 'SKIP':
+                continue
+
+            if group == 'ILLEGAL':
+                raise Exception('Invalid equation (illegal tokens)')
+
+            yield Token(token_names[group], match.group())
+
     def _match(self, tokens: List[Token], target_rule: str, rules_map: ImmutableIndexedDict):
-        # print('match', tokens, target_rule)
+        match, pos = self._match_at(tokens, 0, target_rule, rules_map, {})
+
+        if match is None:
+            return None, None
 
+        return match, tokens[pos:]
+
+    def _match_at(self, tokens: List[Token], pos: int, target_rule: str, rules_map: ImmutableIndexedDict, memo: Dict[Tuple[str, int], Tuple]):
+        """
+        Matches target_rule against tokens starting at index pos and returns the match and the index after it.
+        Results are memoized by (rule, pos), so an alternative that fails never causes a span to be parsed twice.
+        """
         if target_rule.isupper():  # This is a token, not a rule.
-            if tokens and tokens[0].name == target_rule:
-                return tokens[0], tokens[1:]
+            if pos < len(tokens) and tokens[pos].name == target_rule:
+                return tokens[pos], pos + 1
 
             return None, None
 
-        for pattern in rules_map[target_rule]:
-            # print('trying pattern', pattern)
+        key = (target_rule, pos)
+
+        if key in memo:
+            return memo[key]
 
-            remaining_tokens = tokens
+        for pattern in rules_map.patterns(target_rule):
+            cursor = pos
             matched = []
 
-            for pattern_token in pattern.split():
-                # print('checking pattern_token', pattern_token)
-                m, remaining_tokens = self._match(remaining_tokens, pattern_token, rules_map)
+            for pattern_token in pattern:
+                m, cursor = self._match_at(tokens, cursor, pattern_token, rules_map, memo)
 
                 if not m:
-                    # print('failed pattern match')
+                    if matched and self.instrumented:
+                        self._stats.count('backtracks')
+
                     break
 
                 matched.append(m)
             else:
                 # Success!
-                return RuleMatch(target_rule, matched), remaining_tokens
+                memo[key] = RuleMatch(target_rule, matched), cursor
+                return memo[key]
 
         idx = rules_map.index(target_rule)
         if idx is not None and idx + 1 < len(rules_map):
-            return self._match(tokens, rules_map.key_at(idx + 1), rules_map)
+            memo[key] = self._match_at(tokens, pos, rules_map.key_at(idx + 1), rules_map, memo)
+
+        else:
+            memo[key] = None, None
+
+        return memo[key]
+
+
+def _chunks(eqtns: Iterable[str], chunksize: int) -> Iterator[List[str]]:
+    eqtns = iter(eqtns)
+    chunk = list(itertools.islice(eqtns, chunksize))
+
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(eqtns, chunksize))
+
+
+def _evaluate_chunk(calc: Calculator, eqtns: List[str], tpe: str) -> List[BatchResult]:
+    results = []
+    vrs = calc.vrs
+
+    for eqtn in eqtns:
+        # Only an equation with an assignment can change the variables, so only those get their own copy.
+        calc.vrs = vrs.copy() if '=' in eqtn else vrs
+
+        try:
+            results.append(BatchResult(calc.evaluate(eqtn, tpe, False), None))
+
+        except Exception as e:
+            results.append(BatchResult(None, e))
+
+    calc.vrs = vrs
+    return results
+
+
+# The calculator of each worker process in Calculator#evaluate_many.
+_worker_calculator = None
+
+
+def _init_worker(entries: Dict[str, object], reference: bool, store_path: str):
+    global _worker_calculator
+    _worker_calculator = Calculator(reference)
+
+    # Every worker maps the store itself; the pages are shared with the other processes through the page cache.
+    if store_path is not None:
+        from store import ExpressionStore
+        _worker_calculator.store = ExpressionStore(store_path)
+
+    _worker_calculator.vrs.update(entries)
+
 
-        return None, None
+def _evaluate_worker_chunk(eqtns: List[str], tpe: str) -> List[BatchResult]:
+    return _evaluate_chunk(_worker_calculator, eqtns, tpe)
@@ -5,6 +5,10 @@ This file contains important information for the calculator.
 from collections import OrderedDict, namedtuple
 from typing import List
 
+import importlib.util
+import os
+import sys
+
 Token = namedtuple('Token', ('name', 'value'))
 
 
@@ -21,16 +25,22 @@ class RuleMatch:
         return str(self)
 
     def _str(self, node, depth=0) -> str:
-        output = (('\t' * depth) + node.name + ' = ' + str(node.value.value if node.value else None)) + '\n'
+        # Nodes are written depth first with an explicit stack, so deep trees don't hit the recursion limit.
+        root = node
+        lines = []
+        stack = [(node, depth)]
+
+        while stack:
+            matched, depth = stack.pop()
 
-        for matched in node.matched:
-            if isinstance(matched, RuleMatch) and matched.matched:
-                output += self._str(matched, depth + 1)
+            if matched is root or isinstance(matched, RuleMatch) and matched.matched:
+                lines.append(('\t' * depth) + matched.name + ' = ' + str(matched.value.value if matched.value else None))
+                stack.extend((child, depth + 1) for child in reversed(matched.matched))
 
             else:
-                output += (('\t' * (depth + 1)) + matched.name + ': ' + matched.value) + '\n'
+                lines.append(('\t' * depth) + matched.name + ': ' + matched.value)
 
-        return output
+        return ''.join(line + '\n' for line in lines)
 
 
 token_map = OrderedDict((
@@ -73,6 +83,7 @@ class ImmutableIndexedDict:
     def __init__(self, data):
         self._keys = tuple(item[0] for item in data if not item[0].startswith('^'))
         self._data = {key.lstrip('^'): values for key, values in data}
+        self._patterns = {key: tuple(tuple(pattern.split()) for pattern in values) for key, values in self._data.items()}
 
         # Caching indices cuts down on runtime.
         idx = 0
@@ -91,6 +102,13 @@ class ImmutableIndexedDict:
     def __len__(self):
         return self._len
 
+    def items(self):
+        return self._data.items()
+
+    def patterns(self, key):
+        # The same as self[key], but with every pattern already split into its parts.
+        return self._patterns[key]
+
     def index(self, key):
         return self._key_indices.get(key, None)
 
@@ -146,3 +164,39 @@ operations = ('pos', 'neg', 'add', 'sub', 'mul', 'div', 'mod', 'pow', 'sqrt', 'e
 
 class EvaluationException(Exception):
     pass
+
+
+def import_numpy():
+    """
+    Imports NumPy, which is optional. NumPy imports inspect, which needs the standard library's ast module, but this
+    repository's ast.py takes its place whenever the repository is on sys.path, as it is for main.py, the benchmarks and
+    any script run from here. The standard library's ast is put in place while NumPy is imported, and ours after.
+    """
+    if 'numpy' in sys.modules:
+        return sys.modules['numpy']
+
+    ours = sys.modules.get('ast')
+    sys.modules['ast'] = _stdlib_ast()
+
+    try:
+        import numpy
+        return numpy
+
+    finally:
+        if ours is None:
+            del sys.modules['ast']
+
+        else:
+            sys.modules['ast'] = ours
+
+
+def _stdlib_ast():
+    module = sys.modules.get('ast')
+
+    if module is not None and hasattr(module, 'NodeVisitor'):
+        return module
+
+    spec = importlib.util.spec_from_file_location('ast', os.path.join(os.path.dirname(os.__file__), 'ast.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,178 @@
+"""
+This file contains the InfixParser class, which parses infix tokens directly into a fixed tree with operator precedence.
+"""
+from typing import List
+
+from common import Token, RuleMatch
+
+# The tokens which can begin an operand of implicit multiplication, like the (1 + 1) in 2 (1 + 1).
+implicit_mul_start = ('NUM', 'IDT', 'OPR', 'LPA', 'LBR')
+
+# How tightly each operator binds. A negation applies to the operand right after it, so -2 ^ 2 is (-2) ^ 2.
+precedence = {'ADD': 1, 'MUL': 2, 'POW': 3, 'neg': 4}
+
+# The tokens which separate the items of a bracket, or close it, by the token which opened it.
+closing = {'LPA': ('RPA',), 'OPR': ('CMA', 'RPA'), 'LBR': ('CMA', 'PPE', 'RBR')}
+
+
+class InfixParser:
+    """
+    This class builds the same tree that Ast#_fixed produces from an infix RuleMatch tree, but in a single pass.
+    Operators are placed first, left-associative operators are nested to the left and punctuation is dropped.
+    """
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def parse(self) -> RuleMatch:
+        if self._is_assignment():
+            node = self._asn()
+
+        else:
+            node = self._expression()
+
+        if self.pos != len(self.tokens):
+            raise Exception('Invalid equation (bad format)')
+
+        return node
+
+    def _peek(self) -> str:
+        return self.tokens[self.pos].name if self.pos < len(self.tokens) else None
+
+    def _next(self) -> Token:
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def _expect(self, name: str) -> Token:
+        if self._peek() != name:
+            raise Exception('Invalid equation (bad format)')
+
+        return self._next()
+
+    def _is_assignment(self) -> bool:
+        # An assignment is a comma-separated list of identifiers followed by an equals sign.
+        i = 0
+
+        while i < len(self.tokens) and self.tokens[i].name == 'IDT':
+            if i + 1 < len(self.tokens) and self.tokens[i + 1].name == 'CMA':
+                i += 2
+
+            else:
+                return i + 1 < len(self.tokens) and self.tokens[i + 1].name == 'EQL'
+
+        return False
+
+    def _asn(self) -> RuleMatch:
+        idts = [self._next()]
+
+        while self._peek() == 'CMA':
+            self._next()
+            idts.append(self._expect('IDT'))
+
+        self._expect('EQL')
+        return RuleMatch('asn', [RuleMatch('asb', idts), self._expression()])
+
+    def _expression(self) -> RuleMatch:
+        # The operands and the operators waiting for them are kept on explicit stacks instead of the call stack, so
+        # deeply nested equations don't hit the recursion limit. Each open bracket pushes a None onto the operators, which
+        # stops _reduce, and a frame holding what it has parsed so far.
+        operands = []
+        operators = []
+        frames = []
+        # The number of multiplications in the current term of the innermost bracket. The grammar only allows implicit
+        # multiplication directly after the first factor of a term (2 x * y is fine, but 2 * x y and 2 x y are not).
+        term = 0
+        expect_operand = True
+
+        while True:
+            name = self._peek()
+
+            if expect_operand:
+                if name == 'NUM' or name == 'IDT':
+                    operands.append(RuleMatch('num' if name == 'NUM' else 'var', [self._next()]))
+                    expect_operand = False
+
+                elif name == 'ADD':
+                    operators.append((precedence['neg'], 'neg', self._next()))
+
+                elif name == 'LPA' or name == 'OPR' or name == 'LBR':
+                    operator = self._next()
+
+                    if name == 'OPR':
+                        self._expect('LPA')
+
+                    # A function collects its arguments and a matrix collects its rows, the last of which is open.
+                    frames.append((name, operator, [[]] if name == 'LBR' else [], term))
+                    operators.append(None)
+                    term = 0
+
+                else:
+                    raise Exception('Invalid equation (bad format)')
+
+            elif name in precedence:
+                # Powers are right-associative, so a power doesn't apply the powers before it.
+                _reduce(operands, operators, precedence[name] + (name == 'POW'))
+                operators.append((precedence[name], name.lower(), self._next()))
+                term = 0 if name == 'ADD' else term + (name == 'MUL')
+                expect_operand = True
+
+            elif name in implicit_mul_start:
+                if term:
+                    raise Exception('Invalid equation (bad format)')
+
+                _reduce(operands, operators, precedence['MUL'])
+                operators.append((precedence['MUL'], 'mul', Token('MUL', '*')))
+                term = 1
+                expect_operand = True
+
+            elif frames and name in closing[frames[-1][0]]:
+                kind, operator, items, outer_term = frames[-1]
+                _reduce(operands, operators, precedence['ADD'])
+                self._next()
+
+                # A parenthesized operand stays where it is, but arguments and cells are moved into their bracket.
+                if kind == 'OPR':
+                    items.append(operands.pop())
+
+                elif kind == 'LBR':
+                    items[-1].append(operands.pop())
+
+                if name == 'CMA' or name == 'PPE':
+                    if name == 'PPE':
+                        items.append([])
+
+                    term = 0
+                    expect_operand = True
+                    continue
+
+                frames.pop()
+                operators.pop()
+                term = outer_term
+
+                if kind == 'OPR':
+                    operands.append(RuleMatch('opr', [operator, RuleMatch('opb', items)]))
+
+                elif kind == 'LBR':
+                    operands.append(RuleMatch('mbd', [RuleMatch('mrw', row) for row in items]))
+
+            elif frames:
+                raise Exception('Invalid equation (bad format)')
+
+            else:
+                _reduce(operands, operators, precedence['ADD'])
+                return operands.pop()
+
+
+def _reduce(operands: List[RuleMatch], operators: List, level: int):
+    # Applies the operators on top of the stack which bind at least as tightly as level, up to the innermost bracket.
+    while operators and operators[-1] is not None and operators[-1][0] >= level:
+        _, name, operator = operators.pop()
+
+        if name == 'neg':
+            operands.append(RuleMatch('neg', [operator, operands.pop()]))
+
+        else:
+            right = operands.pop()
+            operands.append(RuleMatch(name, [operator, operands.pop(), right]))
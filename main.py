@@ -1,21 +1,137 @@
 """
 A calculator implemented with an Abstract Syntax Tree (AST).
+
+    python main.py infix 1 + 2                           evaluates one equation and shows its tree
+    python main.py                                       evaluates equations typed in one at a time
+    python main.py infix -i expressions.txt -j 4         evaluates every line of a file (or - for stdin), in order
+
+Each line of --input is evaluated on its own: a variable assigned on one line is not defined on the lines after it,
+whatever the number of jobs. Use ; to assign and use a variable on one line, like a = 2; 3 * a + 1.
 """
+from numbers import Integral, Real
 
-from calculator import Calculator
+import argparse
+import json
+import math
 import sys
 
-if __name__ == '__main__':
+from calculator import Calculator
+from vartypes import MatrixValue, NumberValue, TupleValue
+
+
+def plain(value):
+    """
+    A form of value that json can write: numbers stay numbers, matrices become lists of rows rounded like
+    MatrixValue#__str__, and anything else (like complex numbers and dynamic vectors) becomes its string.
+    """
+    if value is None:
+        return None
+
+    if isinstance(value, MatrixValue):
+        return [[_number(round(cell, 5)) for cell in row] for row in value.value]
+
+    if isinstance(value, TupleValue):
+        return [plain(item) for item in value.value]
+
+    if isinstance(value, NumberValue):
+        return _number(value.value)
+
+    return str(value)
+
+
+def _number(n):
+    if isinstance(n, Integral):
+        return int(n)
+
+    if isinstance(n, Real) and math.isfinite(n):
+        return float(n)
+
+    return str(n)
+
+
+def format_result(result, fmt: str) -> str:
+    # One line for every equation. In text, an equation which only assigns variables gets an empty line.
+    if fmt == 'jsonl':
+        return json.dumps({'value': plain(result.value), 'error': None if result.error is None else str(result.error)})
+
+    if result.error is not None:
+        return 'error: {}'.format(result.error)
+
+    value = plain(result.value)
+
+    if value is None:
+        return ''
+
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def stream(calc: Calculator, tpe: str, lines, out, fmt='text', jobs=None, chunksize=256):
+    """
+    Evaluates every line as its own equation, like Calculator#evaluate_many, and writes one result per line to out
+    without rendering any trees. Every line sees the variables of calc, but not the ones assigned on other lines, so the
+    results are the same for any number of jobs.
+    """
+    eqtns = (line.rstrip('\r\n') for line in lines)
+    batch = []
+
+    for result in calc.evaluate_stream(eqtns, tpe, jobs, chunksize):
+        batch.append(format_result(result, fmt) + '\n')
+
+        # Writing in batches keeps the number of writes down on large inputs.
+        if len(batch) >= chunksize:
+            out.writelines(batch)
+            batch.clear()
+
+    out.writelines(batch)
+    out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluates prefix, postfix or infix equations.')
+    parser.add_argument('tpe', nargs='?', choices=('prefix', 'postfix', 'infix'), help='the notation of the equations')
+    parser.add_argument('eqtn', nargs='*', help='equations separated by ;')
+    parser.add_argument('-i', '--input', help='evaluate every line of this file, or of stdin if it is -, each on its own (variables assigned on one line are not defined on the next)')
+    parser.add_argument('-o', '--output', help='write the results of --input to this file instead of stdout')
+    parser.add_argument('-f', '--format', choices=('text', 'jsonl'), default='text', help='how the results of --input are written')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='the number of processes evaluating --input')
+    parser.add_argument('--chunksize', type=int, default=256, help='the number of lines each process evaluates at a time')
+    parser.add_argument('--store', help='an ExpressionStore file of equations parsed ahead of time')
+    parser.add_argument('-q', '--quiet', action='store_true', help='print only the results, not the trees')
+    args = parser.parse_intermixed_args(argv)
+
     calc = Calculator()
 
-    if len(sys.argv) > 2:
-        tpe = sys.argv[1]
+    if args.store:
+        from store import ExpressionStore
+        calc.store = ExpressionStore(args.store)
+
+    if args.input:
+        if args.tpe is None:
+            parser.error('the notation is required with --input')
+
+        source = sys.stdin if args.input == '-' else open(args.input)
+        out = sys.stdout if args.output is None else open(args.output, 'w')
+
+        try:
+            stream(calc, args.tpe, source, out, args.format, args.jobs, args.chunksize)
+
+        finally:
+            if source is not sys.stdin:
+                source.close()
 
-        for line in ' '.join(sys.argv[2:]).split(';'):
-            print(calc.evaluate(line, tpe))
+            if out is not sys.stdout:
+                out.close()
+
+    elif args.eqtn:
+        for line in ' '.join(args.eqtn).split(';'):
+            print(calc.evaluate(line, args.tpe, not args.quiet))
 
     else:
-        tpe = input('What type of expressions will you be inputting? Enter prefix, postfix, or infix: ')
+        tpe = args.tpe or input('What type of expressions will you be inputting? Enter prefix, postfix, or infix: ')
 
         while True:
-            print(calc.evaluate(input('>> '), tpe))
+            print(calc.evaluate(input('>> '), tpe, not args.quiet))
+
+
+if __name__ == '__main__':
+    main()
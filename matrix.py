@@ -1,7 +1,11 @@
 import copy
+import math
+import operator
 from collections import OrderedDict
 from typing import List, Tuple
 
+from common import EvaluationException
+
 
 class DynamicVector:
     """
@@ -38,154 +42,597 @@ class DynamicVector:
 
 MatrixTyping = List[List[float]]
 
+# Pivots smaller than this, relative to the largest entry of the matrix (or of their row, in an LU decomposition), are
+# treated as zero.
+tolerance = 1e-12
+
+# Products whose dimensions are all at least this large are split with Strassen's algorithm.
+strassen_threshold = 128
+
+# The number of columns of the right matrix that are multiplied against every row before moving on to the next ones.
+block_size = 64
+
 
 class MatrixTransformer:
     """
-    This class is in charge of calculating rref and transformation matrices for a given matrix.
+    This class is in charge of calculating rref and transformation matrices for a given matrix. It updates the matrix
+    in place.
     """
 
-    def __init__(self, matrix):
+    def __init__(self, matrix, zero_tolerance: float = None):
         self.matrix = matrix
-        self.transformation = self.identity
+        self.transformation = [[float(cell) for cell in row] for row in self.identity]
         self.answer = None
+        # Cells smaller than this, relative to the largest entry of the matrix, are treated as zero.
+        self.zero_tolerance = tolerance if zero_tolerance is None else zero_tolerance
 
     def rref(self, answer=None) -> Tuple[MatrixTyping, MatrixTyping, DynamicVector]:
+        # Gauss-Jordan elimination with partial pivoting. Each pivot clears its column above and below at once, so one
+        # pass from left to right leaves the matrix in rref.
         self.answer = answer or [0] * len(self.matrix)
+        matrix = self.matrix
+        eps = self.zero_tolerance * max((abs(cell) for row in matrix for cell in row), default=0)
         row = 0
-        col = 0
 
-        self._arrange_by_leading_zeroes()
+        for col in range(len(matrix[0]) if matrix else 0):
+            if row == len(matrix):
+                break
+
+            pivot = max(range(row, len(matrix)), key=lambda r: abs(matrix[r][col]))
+
+            # There is no pivot in this column, so move over but remain on the same row.
+            if abs(matrix[pivot][col]) <= eps:
+                for r in range(row, len(matrix)):
+                    matrix[r][col] = 0.0
 
-        while row < len(self.matrix) and col < len(self.matrix[row]):
-            # If there is a leading 0, move column over but remain on the same row.
-            if self.matrix[row][col] == 0:
-                col += 1
                 continue
 
-            # Divide each cell in the row by the first cell to ensure that the row starts with a 1.
+            if pivot != row:
+                self._swap_rows(row, pivot)
+
+            # Divide the row by its first cell so that it starts with a 1, then clear the rest of the column with it.
             self._divide_row(row, col)
 
-            # Multiply all lower rows as needed.
-            for i in range(row + 1, len(self.matrix)):
-                self._add_rows(row, i, col)
+            for i in range(len(matrix)):
+                if i != row and matrix[i][col] != 0:
+                    self._add_rows(row, i, col)
 
             row += 1
-            col += 1
 
-            if self._arrange_by_leading_zeroes():
-                row = 0
-                col = 0
+        # Replace round-off and negative zeroes with positive zeroes.
+        for cells in matrix:
+            for col in range(len(cells)):
+                if abs(cells[col]) <= eps:
+                    cells[col] = 0.0
 
-        row = len(self.matrix) - 1
-        col = len(self.matrix[row]) - 1
+        for cells in self.transformation:
+            for col in range(len(cells)):
+                cells[col] += 0.0
 
-        while row > 0:
-            # The whole row is zeroes, ignore the row.
-            if self._count_leading_zeroes(row) == len(self.matrix[row]):
-                row -= 1
-                continue
+        for cell in range(len(self.answer)):
+            self.answer[cell] += 0.0
+
+        return matrix, self.transformation, dynamic_vector(matrix, self.answer)
+
+    @property
+    def identity(self) -> MatrixTyping:
+        # Returns a new identity matrix of the same size as self.matrix.
+        return [[1 if col is row else 0 for col in range(len(self.matrix))] for row in range(len(self.matrix))]
+
+    def _swap_rows(self, a, b):
+        self.matrix[a], self.matrix[b] = self.matrix[b], self.matrix[a]
+        self.transformation[a], self.transformation[b] = self.transformation[b], self.transformation[a]
+        self.answer[a], self.answer[b] = self.answer[b], self.answer[a]
+
+    def _divide_row(self, row, col):
+        # The cells before col are already zero.
+        divisor = self.matrix[row][col]
+        pivot_row = self.matrix[row]
+        transformation_row = self.transformation[row]
+
+        for c in range(col, len(pivot_row)):
+            pivot_row[c] /= divisor
+
+        for c in range(len(transformation_row)):
+            transformation_row[c] /= divisor
+
+        pivot_row[col] = 1.0
+        self.answer[row] /= divisor
+
+    def _add_rows(self, row_to_use, row_to_change, col):
+        # Subtracts a multiple of row_to_use, whose pivot is in col, so that row_to_change has a zero in col.
+        multiplier = self.matrix[row_to_change][col] / self.matrix[row_to_use][col]
+        source = self.matrix[row_to_use]
+        target = self.matrix[row_to_change]
+        source_transformation = self.transformation[row_to_use]
+        target_transformation = self.transformation[row_to_change]
+
+        for c in range(col + 1, len(target)):
+            target[c] -= multiplier * source[c]
+
+        for c in range(len(target_transformation)):
+            target_transformation[c] -= multiplier * source_transformation[c]
+
+        target[col] = 0.0
+        self.answer[row_to_change] -= multiplier * self.answer[row_to_use]
+
+
+def snap(x: float, ulps=8) -> float:
+    # Substitution leaves round-off like -3.9999999999999987 for -4, which DynamicVector would print as is. A value
+    # within a few ulps of a whole number is taken to be that number; any other value keeps its full precision.
+    if not math.isfinite(x):
+        return x
+
+    whole = round(x)
+    return float(whole) if whole and abs(x - whole) <= ulps * math.ulp(whole) else x
+
+
+def count_leading_zeroes(row: List[float]) -> int:
+    for i in range(len(row)):
+        if row[i] != 0:
+            return i
+
+    return len(row)
+
+
+def dynamic_vector(matrix: MatrixTyping, answer: List[float]) -> DynamicVector:
+    """
+    Builds the solution of a system from its matrix in rref and the matching answer column.
+    """
+    dvec = DynamicVector(len(matrix))
 
-            # If the current value is a zero, try the next column over.
-            elif self.matrix[row][col] == 0:
-                # row -= 1
-                col -= 1
+    for row in range(len(matrix) - 1, -1, -1):
+        num_zeroes = count_leading_zeroes(matrix[row])
+
+        # An entire row of zeroes. Maybe this won't end up mattering?
+        if num_zeroes == len(matrix[row]):
+            pass
+
+        else:
+            dvec.const(num_zeroes, answer[row])
+
+            for nxt in range(num_zeroes + 1, len(matrix[row])):
+                if matrix[row][nxt] != 0:
+                    dvec.set(row, nxt, -matrix[row][nxt])
+
+    dvec.add_missing(range(len(matrix)))
+
+    return dvec
+
+
+class LUDecomposition:
+    """
+    The LU decomposition of a square matrix with partial pivoting, PA = LU. It is computed once in O(n^3) and then
+    gives the determinant, the inverse and the solution of any system with the same matrix.
+    """
+
+    def __init__(self, matrix: MatrixTyping):
+        n = len(matrix)
+
+        if any(len(row) != n for row in matrix):
+            raise EvaluationException('Cannot factor a non-square matrix of dimensions {}'.format((n, len(matrix[0]))))
+
+        # L (without its diagonal of ones) and U are packed into one matrix.
+        self.lu = [[float(cell) for cell in row] for row in matrix]
+        self.perm = list(range(n))
+        self.sign = 1
+        self.singular = False
+
+        # Whole numbers have a whole determinant, so it can be rounded back to what cofactor expansion would give.
+        self.integral = all(float(cell).is_integer() for row in matrix for cell in row)
+        self.ints = all(isinstance(cell, int) for row in matrix for cell in row)
+
+        lu = self.lu
+        # Each pivot is chosen and judged relative to the largest entry of its own row (scaled partial pivoting), so a
+        # badly scaled matrix like [0.000001, 0 | 0, 1000000] isn't mistaken for a singular one.
+        scales = [max((abs(cell) for cell in row), default=0) for row in lu]
+
+        for k in range(n):
+            pivot = max(range(k, n), key=lambda r: abs(lu[r][k]) / scales[r] if scales[r] else 0)
+
+            if pivot != k:
+                lu[k], lu[pivot] = lu[pivot], lu[k]
+                scales[k], scales[pivot] = scales[pivot], scales[k]
+                self.perm[k], self.perm[pivot] = self.perm[pivot], self.perm[k]
+                self.sign = -self.sign
+
+            pivot_row = lu[k]
+
+            if abs(pivot_row[k]) <= tolerance * scales[k]:
+                self.singular = True
+
+                # Every entry left in the column is zero, so there is nothing to eliminate.
+                if not pivot_row[k]:
+                    continue
+
+            for r in range(k + 1, n):
+                row = lu[r]
+                multiplier = row[k] / pivot_row[k]
+                row[k] = multiplier
+
+                if multiplier:
+                    for c in range(k + 1, n):
+                        row[c] -= multiplier * pivot_row[c]
+
+    def det(self) -> float:
+        det = float(self.sign)
+
+        for k in range(len(self.lu)):
+            det *= self.lu[k][k]
+
+        # A determinant too large for a float is inf, which has no whole number to round to.
+        if self.integral and math.isfinite(det):
+            det = float(round(det))
+
+        return int(det) if self.ints and math.isfinite(det) else det
+
+    def solve(self, b: List[float]) -> List[float]:
+        """
+        Solves Ax = b by forward and back substitution.
+        """
+        if self.singular:
+            raise EvaluationException('Cannot invert matrix with determinant of 0.')
+
+        lu = self.lu
+        n = len(lu)
+        x = [float(b[self.perm[row]]) for row in range(n)]
+
+        for row in range(n):
+            x[row] -= sum(lu[row][col] * x[col] for col in range(row))
+
+        for row in range(n - 1, -1, -1):
+            x[row] = (x[row] - sum(lu[row][col] * x[col] for col in range(row + 1, n))) / lu[row][row]
+
+        return x
+
+    def inv(self) -> MatrixTyping:
+        n = len(self.lu)
+        columns = [self.solve([1 if row == col else 0 for row in range(n)]) for col in range(n)]
+        return [list(row) for row in zip(*columns)]
+
+
+class HouseholderQR:
+    """
+    The QR decomposition of an m x n matrix by Householder reflections, A = QR. The reflections are applied in place to
+    a single copy of the matrix, which is left holding R, and are kept so that Q^T b can be found without forming Q.
+    """
+
+    def __init__(self, matrix: MatrixTyping):
+        self.m = len(matrix)
+        self.n = len(matrix[0])
+        self.r = [[float(cell) for cell in row] for row in matrix]
+        # The reflection for column j is I - 2 v v^T / (v^T v) on rows j and below, or None if there was nothing to do.
+        self.reflectors = []
+
+        r = self.r
+
+        for j in range(min(self.m, self.n)):
+            v = [r[row][j] for row in range(j, self.m)]
+            norm = math.sqrt(sum(cell * cell for cell in v))
+
+            # Nothing below the diagonal to clear.
+            if norm == abs(v[0]):
+                self.reflectors.append(None)
                 continue
 
-            # Only add back up if the element above the pivot is zero
-            for i in range(row - 1, -1, -1):
-                if self.matrix[i][row] != 0: # The `row` is not a typo, we care about the pivot element, not the current element.
-                    self._add_rows(row, i, col)
+            # Reflect onto -sign(x_0) * |x| e_0 so that nothing cancels in v_0.
+            v[0] += math.copysign(norm, v[0])
+            self.reflectors.append(v)
+            self._reflect(v, j, r, range(j, self.n))
 
-            row -= 1
-            col -= 1
+            for row in range(j + 1, self.m):
+                r[row][j] = 0.0
 
-        # Replace negative zeroes with positive zeroes.
-        for row in range(len(self.matrix)):
-            for col in range(len(self.matrix[row])):
-                if self.matrix[row][col] == -0.0:
-                    self.matrix[row][col] = 0.0
+        # Gram-Schmidt gives a positive diagonal, so flip the signs to match: the rows of R and the columns of Q.
+        self.signs = [-1.0 if r[j][j] < 0 else 1.0 for j in range(min(self.m, self.n))]
 
-        for cell in range(len(self.answer)):
-            if self.answer[cell] == -0.0:
-                self.answer[cell] = 0.0
+        for j, sign in enumerate(self.signs):
+            if sign < 0:
+                r[j] = [-cell + 0.0 for cell in r[j]]
 
-        dvec = DynamicVector(len(self.matrix))
+    def q(self) -> MatrixTyping:
+        """
+        Q as an m x m matrix whose columns past min(m, n) are zero, like Gram-Schmidt gives.
+        """
+        k = len(self.signs)
+        q = [[1.0 if col == row else 0.0 for col in range(k)] for row in range(self.m)]
 
-        for row in range(len(self.matrix) - 1, -1, -1):
-            num_zeroes = self._count_leading_zeroes(row)
+        # Q = H_0 H_1 ... H_{k-1}, applied to the first k columns of the identity from the right-most reflection.
+        for j in range(k - 1, -1, -1):
+            if self.reflectors[j] is not None:
+                self._reflect(self.reflectors[j], j, q, range(j, k))
 
-            # An entire row of zeroes. Maybe this won't end up mattering?
-            if num_zeroes == len(self.matrix[row]):
-                pass
+        return [[q[row][col] * self.signs[col] + 0.0 for col in range(k)] + [0] * (self.m - k) for row in range(self.m)]
 
-            else:
-                dvec.const(num_zeroes, self.answer[row])
+    def r_matrix(self) -> MatrixTyping:
+        """
+        R as an n x n upper triangular matrix whose rows past min(m, n) are zero.
+        """
+        return [[0.0] * row + self.r[row][row:] if row < self.m else [0.0] * self.n for row in range(self.n)]
 
-                for nxt in range(num_zeroes + 1, len(self.matrix[row])):
-                    if self.matrix[row][nxt] != 0:
-                        dvec.set(row, nxt, -self.matrix[row][nxt])
+    def solve(self, b: List[float]) -> List[float]:
+        """
+        The least squares solution of Ax = b, which solves Rx = Q^T b by back substitution.
+        """
+        r = self.r
+        n = self.n
+        eps = tolerance * max((abs(r[j][j]) for j in range(len(self.signs))), default=0)
 
-        dvec.add_missing(range(len(self.matrix)))
+        # Without full column rank there is no unique solution, just like A^T A would have no inverse.
+        if self.m < n or any(abs(r[j][j]) <= eps for j in range(n)):
+            raise EvaluationException('Cannot invert matrix with determinant of 0.')
 
-        return self.matrix, self.transformation, dvec
+        y = [[float(cell)] for cell in b]
 
-    @property
-    def identity(self) -> MatrixTyping:
-        # Returns a new identity matrix of the same size as self.matrix.
-        return [[1 if col is row else 0 for col in range(len(self.matrix))] for row in range(len(self.matrix))]
+        for j, v in enumerate(self.reflectors):
+            if v is not None:
+                self._reflect(v, j, y, range(1))
 
-    def _swap_rows(self, a, b):
-        self.matrix[a], self.matrix[b] = self.matrix[b], self.matrix[a]
-        self.transformation[a], self.transformation[b] = self.transformation[b], self.transformation[a]
-        self.answer[a], self.answer[b] = self.answer[b], self.answer[a]
+        x = [y[row][0] * self.signs[row] for row in range(n)]
 
-    def _divide_row(self, row, col):
-        self.transformation[row] = [cell / self.matrix[row][col] for cell in self.transformation[row]]
-        self.answer[row] /= self.matrix[row][col]
-        self.matrix[row] = [cell / self.matrix[row][col] for cell in self.matrix[row]]
+        for row in range(n - 1, -1, -1):
+            x[row] = (x[row] - sum(r[row][col] * x[col] for col in range(row + 1, n))) / r[row][row]
 
-    def _add_rows(self, row_to_use, row_to_change, col):
-        multiplier = -self.matrix[row_to_change][col] / self.matrix[row_to_use][col]
-        self.matrix[row_to_change] = [cell + (self.matrix[row_to_use][c] * multiplier) for c, cell in enumerate(self.matrix[row_to_change])]
-        self.transformation[row_to_change] = [cell + multiplier * self.transformation[row_to_use][c] for c, cell in enumerate(self.transformation[row_to_change])]
-        self.answer[row_to_change] += multiplier * self.answer[row_to_use]
+        return x
+
+    @staticmethod
+    def _reflect(v: List[float], j: int, a: MatrixTyping, columns: range):
+        # Applies I - 2 v v^T / (v^T v) to rows j and below of the given columns of a, in place.
+        scale = 2 / sum(cell * cell for cell in v)
+
+        for col in columns:
+            factor = scale * sum(v[i] * a[j + i][col] for i in range(len(v)))
+
+            if factor:
+                for i in range(len(v)):
+                    a[j + i][col] -= factor * v[i]
+
+
+def null_vector(matrix: MatrixTyping) -> Tuple[int, List[float]]:
+    """
+    Returns the rank of a matrix and, when exactly one column is free, the vector that spans its null space (None
+    otherwise).
+    """
+    a = [[float(cell) for cell in row] for row in matrix]
+    m = len(a)
+    n = len(a[0])
+    eps = tolerance * max((abs(cell) for row in a for cell in row), default=0)
+    pivots = []
+
+    for col in range(n):
+        row = len(pivots)
+
+        if row == m:
+            break
+
+        pivot = max(range(row, m), key=lambda r: abs(a[r][col]))
+
+        if abs(a[pivot][col]) <= eps:
+            continue
+
+        a[row], a[pivot] = a[pivot], a[row]
+        pivot_row = a[row]
+        divisor = pivot_row[col]
+
+        for c in range(col, n):
+            pivot_row[c] /= divisor
+
+        for r in range(m):
+            multiplier = a[r][col]
+
+            if r != row and multiplier:
+                other = a[r]
+
+                for c in range(col, n):
+                    other[c] -= multiplier * pivot_row[c]
+
+        pivots.append(col)
+
+    free = [col for col in range(n) if col not in pivots]
+
+    if len(free) != 1:
+        return len(pivots), None
+
+    vector = [0.0] * n
+    vector[free[0]] = 1.0
+
+    for row, col in enumerate(pivots):
+        vector[col] = -a[row][free[0]]
+
+    return len(pivots), vector
+
+
+def singular_cofactors(matrix: MatrixTyping) -> MatrixTyping:
+    """
+    The cofactor matrix of a singular square matrix. Every minor of a matrix with rank below n - 1 is singular too, so
+    its cofactors are all zero. With rank n - 1 the cofactor matrix is k * y x^T, where A x = 0 and A^T y = 0, so a
+    single minor gives k.
+    """
+    n = len(matrix)
+    rank, x = null_vector(matrix)
+    _, y = null_vector(list(map(list, zip(*matrix))))
+
+    if rank < n - 1 or x is None or y is None:
+        return [[0.0 for _ in range(n)] for _ in range(n)]
+
+    i = max(range(n), key=lambda r: abs(y[r]))
+    j = max(range(n), key=lambda c: abs(x[c]))
+    minor = [matrix[row][:j] + matrix[row][j + 1:] for row in range(n) if row != i]
+    k = LUDecomposition(minor).det() * (1 if (i + j) % 2 == 0 else -1) / (y[i] * x[j])
+
+    return [[k * y[row] * x[col] for col in range(n)] for row in range(n)]
 
-    def _arrange_by_leading_zeroes(self):
-        swapped = False
-        r = 0
 
-        while r < len(self.matrix) - 1:
-            if self._count_leading_zeroes(r) > self._count_leading_zeroes(r + 1):
-                swapped = True
-                self._swap_rows(r, r + 1)
-                r = 0
+class PythonBackend:
+    """
+    The pure-Python matrix kernels, which work on lists of rows. Every kernel returns new data and leaves its
+    arguments alone.
+    """
+    name = 'python'
+
+    @staticmethod
+    def array(data) -> MatrixTyping:
+        return data.tolist() if hasattr(data, 'tolist') else data
+
+    @staticmethod
+    def mul(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+        return multiply_matrices(a, b)
+
+    @staticmethod
+    def scale(a: MatrixTyping, k: float) -> MatrixTyping:
+        return [[cell * k for cell in row] for row in a]
+
+    @staticmethod
+    def divide(a: MatrixTyping, k: float) -> MatrixTyping:
+        return [[cell / k for cell in row] for row in a]
+
+    @staticmethod
+    def sub(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+        return [[a[row][col] - b[row][col] for col in range(len(a[row]))] for row in range(len(a))]
+
+    @staticmethod
+    def trans(a: MatrixTyping) -> MatrixTyping:
+        return list(map(list, zip(*a)))
+
+    @staticmethod
+    def det(a: MatrixTyping) -> float:
+        return LUDecomposition(a).det()
+
+    @staticmethod
+    def cof(a: MatrixTyping) -> MatrixTyping:
+        n = len(a)
+        lu = LUDecomposition(a)
 
-            else:
-                r += 1
+        if n == 1:
+            return [[1]]
 
-        return swapped
+        det = lu.det()
 
-    def _count_leading_zeroes(self, r):
-        row = self.matrix[r]
+        if not lu.singular and math.isfinite(det):
+            # C = det(A) * inv(A)^T, which is one factorization instead of n^2 determinants.
+            inv = lu.inv()
+            cofactor_matrix = [[det * inv[col][row] for col in range(n)] for row in range(n)]
 
-        for i in range(len(row)):
-            if row[i] != 0:
-                return i
+        elif not lu.singular:
+            # The determinant overflowed, so each cofactor is the determinant of its minor, which may still fit.
+            cofactor_matrix = [[(-1) ** (row + col) * LUDecomposition([r[:col] + r[col + 1:] for r in a[:row] + a[row + 1:]]).det()
+                                for col in range(n)] for row in range(n)]
 
-        return len(row)
+        else:
+            cofactor_matrix = singular_cofactors(a)
+
+        if lu.integral:
+            # The cofactors of whole numbers are whole numbers, like the determinant.
+            cofactor_matrix = [[float(round(cell)) + 0.0 if math.isfinite(cell) else cell for cell in row] for row in cofactor_matrix]
+
+        return [[int(cell) if math.isfinite(cell) else cell for cell in row] for row in cofactor_matrix] if lu.ints else cofactor_matrix
+
+    @staticmethod
+    def inv(a: MatrixTyping) -> MatrixTyping:
+        return LUDecomposition(a).inv()
+
+    @staticmethod
+    def rref(a: MatrixTyping, answer: List[float] = None) -> Tuple[MatrixTyping, MatrixTyping, DynamicVector]:
+        return MatrixTransformer(copy.deepcopy(a)).rref(None if answer is None else list(answer))
+
+    @staticmethod
+    def solve(a: MatrixTyping, answer: List[float]) -> DynamicVector:
+        if len(a) == len(a[0]) == len(answer):
+            lu = LUDecomposition(a)
+
+            if not lu.singular:
+                # A unique solution, so the rref is the identity and there are no free variables.
+                identity = [[1 if col == row else 0 for col in range(len(a))] for row in range(len(a))]
+                return dynamic_vector(identity, [snap(x) for x in lu.solve(answer)])
+
+        return PythonBackend.rref(a, answer)[2]
+
+    @staticmethod
+    def qr(a: MatrixTyping) -> Tuple[MatrixTyping, MatrixTyping]:
+        qr = HouseholderQR(a)
+        return qr.q(), qr.r_matrix()
+
+    @staticmethod
+    def ls(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+        # The least squares solution solves Rx = Q^T b, which avoids squaring the condition number like A^T A would.
+        qr = HouseholderQR(a)
+        return PythonBackend.trans([qr.solve(column) for column in PythonBackend.trans(b)])
 
 
 def multiply_matrices(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
-    result = [[0 for _ in range(len(a))] for _ in range(len(a))]
+    """
+    Multiplies an m x k matrix by a k x n one. Large products are split with Strassen's algorithm and the rest are
+    computed in blocks of columns.
+    """
+    if min(len(a), len(b), len(b[0])) >= strassen_threshold:
+        return _strassen(a, b)
+
+    return _blocked(a, b)
+
+
+def _blocked(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+    # The columns of b are transposed into rows once, so every cell of the result is a dot product of two rows.
+    columns = list(zip(*b))
+    result = [[0] * len(columns) for _ in range(len(a))]
+
+    for start in range(0, len(columns), block_size):
+        block = columns[start:start + block_size]
 
-    for i in range(len(result)):
-        for j in range(len(result)):
-            for k in range(len(result)):
-                result[i][j] += a[i][k] * b[k][j]
+        for row, result_row in zip(a, result):
+            for col, column in enumerate(block, start):
+                result_row[col] = sum(map(operator.mul, row, column))
 
     return result
 
 
+def _strassen(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+    m, k, n = len(a), len(b), len(b[0])
+
+    # A 1 x 1 block can't be split any further.
+    if min(m, k, n) < max(strassen_threshold, 2):
+        return _blocked(a, b)
+
+    # Odd dimensions are padded with a row or column of zeroes, which the result is cropped back from.
+    h_m, h_k, h_n = (m + 1) // 2, (k + 1) // 2, (n + 1) // 2
+    a11, a12, a21, a22 = _quadrants(a, h_m, h_k)
+    b11, b12, b21, b22 = _quadrants(b, h_k, h_n)
+
+    p1 = _strassen(_add(a11, a22), _add(b11, b22))
+    p2 = _strassen(_add(a21, a22), b11)
+    p3 = _strassen(a11, _sub(b12, b22))
+    p4 = _strassen(a22, _sub(b21, b11))
+    p5 = _strassen(_add(a11, a12), b22)
+    p6 = _strassen(_sub(a21, a11), _add(b11, b12))
+    p7 = _strassen(_sub(a12, a22), _add(b21, b22))
+
+    c11 = _add(_sub(_add(p1, p4), p5), p7)
+    c12 = _add(p3, p5)
+    c21 = _add(p2, p4)
+    c22 = _add(_add(_sub(p1, p2), p3), p6)
+
+    top = [left + right for left, right in zip(c11, c12)]
+    bottom = [left + right for left, right in zip(c21, c22)]
+
+    return [row[:n] for row in (top + bottom)[:m]]
+
+
+def _quadrants(a: MatrixTyping, rows: int, cols: int) -> Tuple[MatrixTyping, MatrixTyping, MatrixTyping, MatrixTyping]:
+    # Splits a matrix into four rows x cols blocks, padding the bottom and right ones with zeroes.
+    padded = [list(row) + [0] * (2 * cols - len(row)) for row in a]
+    padded += [[0] * (2 * cols) for _ in range(2 * rows - len(a))]
+
+    return ([row[:cols] for row in padded[:rows]], [row[cols:] for row in padded[:rows]],
+            [row[:cols] for row in padded[rows:]], [row[cols:] for row in padded[rows:]])
+
+
+def _add(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+    return [list(map(operator.add, x, y)) for x, y in zip(a, b)]
+
+
+def _sub(a: MatrixTyping, b: MatrixTyping) -> MatrixTyping:
+    return [list(map(operator.sub, x, y)) for x, y in zip(a, b)]
+
+
 if __name__ == '__main__':
     # matrix = [[1, 2, 3, 4], [4, 2, 3, 7], [1, 2, 3, 8], [9, 2, 3, 3]]
     matrix = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
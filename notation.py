@@ -0,0 +1,137 @@
+"""
+This file contains the StackMachine class, which evaluates prefix and postfix tokens in a single linear pass.
+"""
+from typing import Callable, Dict, List
+
+from ast import Ast
+from common import Token, RuleMatch
+from rules import num, opb, rule_value_operation_map
+from vartypes import Value
+
+# The rule for each operator token. OPR takes one argument plus one for every comma, the others are binary.
+operator_rules = {
+    'ADD': 'add',
+    'MUL': 'mul',
+    'POW': 'pow',
+    'OPR': 'opr',
+}
+
+
+class StackMachine:
+    """
+    Postfix tokens are read left to right and prefix tokens right to left, so in both cases the operands of an operator
+    are already on the stack when the operator is reached. A comma marks the operand next to it as one of several
+    arguments, like the A in `solve , A b` or `A b , solve`.
+    """
+
+    def __init__(self, reverse: bool):
+        self.reverse = reverse
+
+    def evaluate(self, tokens: List[Token], vrs: Dict[str, RuleMatch]) -> Value:
+        """
+        Evaluates tokens straight to a Value without building a tree. Assignments need a tree, so use tree() for them.
+        """
+        def leaf(token):
+            if token.name == 'NUM':
+                return num(None, [token])
+
+            return Ast(RuleMatch('var', [token]), fixed=True).evaluate(vrs)
+
+        def node(operator, operands):
+            if operator.name == 'OPR':
+                operands = [opb(operands, None)]
+
+            return rule_value_operation_map[operator_rules[operator.name]](operands, operator)
+
+        return self._run(tokens, leaf, node)
+
+    def tree(self, tokens: List[Token]) -> RuleMatch:
+        """
+        Builds the same fixed tree that Ast#_fixed produces for these tokens.
+        """
+        if not self.reverse or not tokens or tokens[0].name != 'EQL':
+            return self._run(tokens, self._leaf_node, self._operator_node)
+
+        # An assignment looks like `= , a b expr`, where the identifiers come first.
+        i = 1
+        idts = []
+
+        while i + 1 < len(tokens) and tokens[i].name == 'CMA' and tokens[i + 1].name == 'IDT':
+            idts.append(tokens[i + 1])
+            i += 2
+
+        if i >= len(tokens) or tokens[i].name != 'IDT':
+            raise Exception('Invalid equation (bad format)')
+
+        idts.append(tokens[i])
+        return RuleMatch('asn', [RuleMatch('asb', idts), self._run(tokens[i + 1:], self._leaf_node, self._operator_node)])
+
+    @staticmethod
+    def _leaf_node(token: Token) -> RuleMatch:
+        return RuleMatch('num' if token.name == 'NUM' else 'var', [token])
+
+    @staticmethod
+    def _operator_node(operator: Token, operands: List[RuleMatch]) -> RuleMatch:
+        if operator.name == 'OPR':
+            return RuleMatch('opr', [operator, RuleMatch('opb', operands)])
+
+        return RuleMatch(operator_rules[operator.name], [operator] + operands)
+
+    def _run(self, tokens: List[Token], leaf: Callable, node: Callable):
+        stack = []
+        commas = []  # Whether each entry on the stack has a comma next to it.
+
+        def pop():
+            if not stack:
+                raise Exception('Invalid equation (bad format)')
+
+            return stack.pop(), commas.pop()
+
+        for token in (reversed(tokens) if self.reverse else tokens):
+            if token.name in ('NUM', 'IDT'):
+                stack.append(leaf(token))
+                commas.append(False)
+
+            elif token.name == 'CMA':
+                if not stack or commas[-1]:
+                    raise Exception('Invalid equation (bad format)')
+
+                commas[-1] = True
+
+            elif token.name in operator_rules:
+                operands = []
+
+                if token.name == 'OPR':
+                    operand, comma = pop()
+                    operands.append(operand)
+
+                    while comma:
+                        operand, comma = pop()
+                        operands.append(operand)
+
+                else:
+                    for _ in range(2):
+                        operand, comma = pop()
+
+                        if comma:
+                            raise Exception('Invalid equation (bad format)')
+
+                        operands.append(operand)
+
+                if not self.reverse:
+                    operands.reverse()
+
+                stack.append(node(token, operands))
+                commas.append(False)
+
+            else:
+                raise Exception('Invalid equation (bad format)')
+
+        if len(stack) != 1 or commas[0]:
+            raise Exception('Invalid equation (bad format)')
+
+        return stack[0]
+
+
+prefix = StackMachine(reverse=True)
+postfix = StackMachine(reverse=False)
@@ -0,0 +1,206 @@
+"""
+This file contains the NumpyBackend class, which implements the matrix kernels with NumPy arrays.
+"""
+from typing import Tuple
+
+import math
+
+import numpy
+
+from common import EvaluationException
+from matrix import DynamicVector, PythonBackend, dynamic_vector, snap
+
+# Entries smaller than this (relative to the largest entry) are treated as zero when eliminating.
+tolerance = 1e-12
+
+
+class NumpyBackend:
+    """
+    The same kernels as PythonBackend, but MatrixValue#value is a 2D NumPy array. The results are rounded to 5 places
+    when printed, so they read the same as the pure-Python ones.
+    """
+    name = 'numpy'
+
+    @staticmethod
+    def array(data) -> numpy.ndarray:
+        array = numpy.asarray(data)
+
+        # Keep whole numbers as integers (like identity(3)) so they print the same as the lists would.
+        if array.dtype.kind not in 'if':
+            array = array.astype(float)
+
+        return numpy.ascontiguousarray(array)
+
+    @staticmethod
+    def mul(a, b) -> numpy.ndarray:
+        return numpy.asarray(a) @ numpy.asarray(b)
+
+    @staticmethod
+    def scale(a, k: float) -> numpy.ndarray:
+        return numpy.asarray(a) * k
+
+    @staticmethod
+    def divide(a, k: float) -> numpy.ndarray:
+        return numpy.asarray(a) / k
+
+    @staticmethod
+    def sub(a, b) -> numpy.ndarray:
+        return numpy.asarray(a) - numpy.asarray(b)
+
+    @staticmethod
+    def trans(a) -> numpy.ndarray:
+        return numpy.ascontiguousarray(numpy.asarray(a).T)
+
+    @staticmethod
+    def det(a) -> float:
+        a = numpy.asarray(a)
+
+        with numpy.errstate(over='ignore'):
+            det = float(numpy.linalg.det(a.astype(float)))
+
+        # Rounded like LUDecomposition#det, so both backends print the same determinant.
+        if _is_integral(a) and math.isfinite(det):
+            det = float(round(det))
+
+        return int(det) if a.dtype.kind == 'i' and math.isfinite(det) else det
+
+    @staticmethod
+    def cof(a) -> numpy.ndarray:
+        a = numpy.asarray(a)
+        cofactors = NumpyBackend._cofactors(a.astype(float))
+
+        if not _is_integral(a):
+            return cofactors
+
+        # Rounded like PythonBackend#cof, since the cofactors of whole numbers are whole numbers.
+        finite = numpy.isfinite(cofactors)
+        cofactors = numpy.where(finite, numpy.round(cofactors), cofactors) + 0.0
+
+        if a.dtype.kind == 'i' and finite.all() and (numpy.abs(cofactors) < 2.0 ** 63).all():
+            return cofactors.astype(numpy.int64)
+
+        return cofactors
+
+    @staticmethod
+    def _cofactors(a: numpy.ndarray) -> numpy.ndarray:
+        n = len(a)
+
+        if n == 1:
+            return numpy.ones((1, 1))
+
+        with numpy.errstate(over='ignore'):
+            det = numpy.linalg.det(a)
+
+        if not NumpyBackend._is_singular(a, det):
+            if numpy.isfinite(det):
+                # C = det(A) * inv(A)^T, which is one factorization instead of n^2 determinants.
+                return det * numpy.linalg.inv(a).T
+
+            # The determinant overflowed, so each cofactor is the determinant of its minor, which may still fit. This is
+            # rare enough for PythonBackend#cof, which finds them exactly for small minors, to do it.
+            return numpy.array(PythonBackend.cof(a.tolist()), dtype=float)
+
+        # A singular matrix has no inverse. See matrix.singular_cofactors, which this follows with the SVD's null vectors.
+        if numpy.linalg.matrix_rank(a) < n - 1:
+            return numpy.zeros((n, n))
+
+        u, _, vt = numpy.linalg.svd(a)
+        x = vt[-1]
+        y = u[:, -1]
+        i = int(numpy.argmax(numpy.abs(y)))
+        j = int(numpy.argmax(numpy.abs(x)))
+        minor = numpy.delete(numpy.delete(a, i, axis=0), j, axis=1)
+        k = numpy.linalg.det(minor) * (1 if (i + j) % 2 == 0 else -1) / (y[i] * x[j])
+
+        return k * numpy.outer(y, x) + 0.0
+
+    @staticmethod
+    def inv(a) -> numpy.ndarray:
+        a = numpy.asarray(a, dtype=float)
+
+        if NumpyBackend._is_singular(a, numpy.linalg.det(a)):
+            raise EvaluationException('Cannot invert matrix with determinant of 0.')
+
+        return numpy.linalg.inv(a)
+
+    @staticmethod
+    def rref(a, answer=None) -> Tuple[numpy.ndarray, numpy.ndarray, DynamicVector]:
+        # Gauss-Jordan elimination with partial pivoting on the augmented matrix [A | I | answer], so the transformation
+        # and the answer column are updated by the same row operations.
+        a = numpy.asarray(a, dtype=float)
+        m, n = a.shape
+        augmented = numpy.hstack((a, numpy.eye(m), numpy.asarray([0] * m if answer is None else answer, dtype=float).reshape(m, 1)))
+        eps = tolerance * max(1, numpy.abs(a).max(initial=0))
+        row = 0
+
+        for col in range(n):
+            if row == m:
+                break
+
+            pivot = row + int(numpy.argmax(numpy.abs(augmented[row:, col])))
+
+            if abs(augmented[pivot, col]) <= eps:
+                augmented[row:, col] = 0
+                continue
+
+            if pivot != row:
+                augmented[[row, pivot]] = augmented[[pivot, row]]
+
+            augmented[row] /= augmented[row, col]
+            others = numpy.arange(m) != row
+            augmented[others] -= numpy.outer(augmented[others, col], augmented[row])
+            row += 1
+
+        matrix = augmented[:, :n]
+        matrix[numpy.abs(matrix) <= eps] = 0
+        # Adding 0.0 turns negative zeroes into positive ones.
+        augmented += 0.0
+
+        return matrix, augmented[:, n:n + m], dynamic_vector(matrix.tolist(), augmented[:, -1].tolist())
+
+    @staticmethod
+    def solve(a, answer) -> DynamicVector:
+        a = numpy.asarray(a, dtype=float)
+
+        if a.ndim == 2 and a.shape[0] == a.shape[1] == len(answer) and not NumpyBackend._is_singular(a, numpy.linalg.det(a)):
+            x = numpy.linalg.solve(a, numpy.asarray(answer, dtype=float)) + 0.0
+            return dynamic_vector(numpy.eye(len(a)).tolist(), [snap(float(cell)) for cell in x])
+
+        return NumpyBackend.rref(a, answer)[2]
+
+    @staticmethod
+    def qr(a) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        a = numpy.asarray(a, dtype=float)
+        m, n = a.shape
+        q, r = numpy.linalg.qr(a)
+
+        # Flip signs so the diagonal of R is positive, like Gram-Schmidt gives, then pad Q to m x m and R to n x n with
+        # zeroes so the shapes match PythonBackend#qr.
+        signs = numpy.where(numpy.diag(r) < 0, -1.0, 1.0)
+        k = len(signs)
+        padded_q = numpy.zeros((m, m))
+        padded_r = numpy.zeros((n, n))
+        padded_q[:, :k] = q * signs
+        padded_r[:k, :] = r * signs[:, None]
+
+        return padded_q + 0.0, padded_r + 0.0
+
+    @staticmethod
+    def ls(a, b) -> numpy.ndarray:
+        a = numpy.asarray(a, dtype=float)
+        solution, _, rank, _ = numpy.linalg.lstsq(a, numpy.asarray(b, dtype=float), rcond=None)
+
+        # The normal equations have no unique solution without full column rank, which the Python kernels report as a
+        # singular A^T A.
+        if rank < a.shape[1]:
+            raise EvaluationException('Cannot invert matrix with determinant of 0.')
+
+        return solution
+
+    @staticmethod
+    def _is_singular(a: numpy.ndarray, det: float) -> bool:
+        return a.size == 0 or det == 0 or numpy.linalg.matrix_rank(a) < len(a)
+
+
+def _is_integral(a: numpy.ndarray) -> bool:
+    return a.dtype.kind == 'i' or bool(numpy.all(numpy.mod(a, 1) == 0))
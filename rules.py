@@ -4,7 +4,7 @@ This file contains methods to handle Valueing RuleMatches
 from typing import List
 
 from common import Token
-from vartypes import VariableValue, NumberValue, MatrixRowValue, MatrixValue, Value, TupleValue
+from vartypes import VariableValue, NumberValue, MatrixRowValue, MatrixValue, Value, TupleValue, DynamicVectorValue
 
 
 def flatten(l):
@@ -40,15 +40,15 @@ def opb(values: List[Value], _) -> TupleValue:
 
 
 def add(operands: List[Value], operator: Token) -> Value:
-    return {'+': operands[0].add, '-': operands[0].sub}[operator.value](*operands[1:])
+    return binary_operation(operator.value, operands[0], operands[1])
 
 
 def mul(operands: List[Value], operator: Token) -> Value:
-    return {'*': operands[0].mul, '/': operands[0].div, '%': operands[0].mod}[operator.value](*operands[1:])
+    return binary_operation(operator.value, operands[0], operands[1])
 
 
-def pow(operands: List[Value], _) -> Value:
-    return operands[0].pow(*operands[1:])
+def pow(operands: List[Value], operator: Token) -> Value:
+    return binary_operation(operator.value, operands[0], operands[1])
 
 
 def opr(operands: List[Value], operator: Token) -> Value:
@@ -57,9 +57,73 @@ def opr(operands: List[Value], operator: Token) -> Value:
 
 
 def neg(operands: List[Value], operator: Token) -> Value:
-    return {'+': operands[0].pos, '-': operands[0].neg}[operator.value](*operands[1:])
+    return unary_operation(operator.value, operands[0])
 
 
+def binary_operation(symbol: str, left: Value, right: Value) -> Value:
+    operation = operation_table.get((symbol, type(left), type(right)))
+
+    # A Value type the table doesn't know about resolves the method itself.
+    if operation is None:
+        return getattr(left, binary_operations[symbol])(right)
+
+    return operation(left, right)
+
+
+def unary_operation(symbol: str, operand: Value) -> Value:
+    operation = operation_table.get((symbol, type(operand), None))
+
+    if operation is None:
+        return getattr(operand, unary_operations[symbol])()
+
+    return operation(operand)
+
+
+# The Value method for each operator, for binary and unary (neg) operations.
+binary_operations = {
+    '+': 'add',
+    '-': 'sub',
+    '*': 'mul',
+    '/': 'div',
+    '%': 'mod',
+    '^': 'pow',
+    '**': 'pow',
+}
+
+unary_operations = {
+    '+': 'pos',
+    '-': 'neg',
+}
+
+value_types = (VariableValue, NumberValue, MatrixRowValue, MatrixValue, TupleValue, DynamicVectorValue)
+
+# The function for each (operator, left type, right type), and (operator, operand type, None) for unary operations.
+# Most are the Value methods themselves, so unsupported combinations raise the same exceptions, but arithmetic on
+# numbers skips the method's type checks.
+operation_table = {}
+
+for symbol, method in binary_operations.items():
+    for left_type in value_types:
+        for right_type in value_types:
+            operation_table[symbol, left_type, right_type] = getattr(left_type, method)
+
+for symbol, method in unary_operations.items():
+    for operand_type in value_types:
+        operation_table[symbol, operand_type, None] = getattr(operand_type, method)
+
+operation_table.update({
+    ('+', NumberValue, NumberValue): lambda left, right: NumberValue(left.value + right.value),
+    ('-', NumberValue, NumberValue): lambda left, right: NumberValue(left.value - right.value),
+    ('*', NumberValue, NumberValue): lambda left, right: NumberValue(left.value * right.value),
+    ('/', NumberValue, NumberValue): lambda left, right: NumberValue(left.value / right.value),
+    ('%', NumberValue, NumberValue): lambda left, right: NumberValue(left.value % right.value),
+    ('^', NumberValue, NumberValue): lambda left, right: NumberValue(left.value ** right.value),
+    ('**', NumberValue, NumberValue): lambda left, right: NumberValue(left.value ** right.value),
+    ('*', NumberValue, MatrixValue): lambda left, right: right.mul(left),
+    ('+', NumberValue, None): lambda operand: NumberValue(operand.value),
+    ('-', NumberValue, None): lambda operand: NumberValue(-operand.value),
+})
+
 # The mapping for num, mrw, mbd.
 rule_value_map = {
     'var': var,
@@ -0,0 +1,621 @@
+"""
+This file contains the EvaluationServer class, which evaluates equations sent as JSON Lines over TCP or a Unix socket.
+
+Each line a client sends is a request like {"id": 1, "eqtn": "a = 2; a * 3", "tpe": "infix", "session": "shared"}, and
+each request gets one line back, in the order the requests were sent, like {"id": 1, "value": 6.0, "error": null}. Only
+eqtn is required: tpe defaults to infix, and a request without a session uses the variables of its own connection,
+while requests naming a session share its variables with every connection that names it.
+
+    python server.py --port 7878 --workers 4
+    python server.py --unix /tmp/calculator.sock
+"""
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Deque, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+import argparse
+import json
+import itertools
+import os
+import pickle
+import selectors
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+
+from calculator import Calculator
+from common import Token
+from main import plain
+from variables import Variables
+
+# The operators which don't take matrices. An equation using any other operator, a matrix, or a variable defined with
+# either is evaluated by a worker process, so a large matrix never holds up the other connections.
+scalar_operators = ('sqrt', 'exp')
+
+notations = ('prefix', 'postfix', 'infix')
+
+# The number of sessions whose variables each worker process keeps.
+worker_sessions = 64
+
+_session_keys = itertools.count()
+
+
+class Session:
+    """
+    The variables of a connection, or of every connection naming the same session. The requests of a session are
+    evaluated one at a time, in the order they arrived, so each one sees the variables the ones before it assigned.
+    """
+
+    def __init__(self, store=None):
+        self.calc = Calculator(store=store)
+        # The variables whose definitions use matrices. Equations using them, or variables which depend on them, go to the
+        # worker processes.
+        self.heavy = set()  # type: Set[str]
+        self.queue = deque()  # type: Deque[Tuple[_Pending, str, str]]
+        # True while one of the requests is being evaluated by a worker process.
+        self.busy = False
+        # Workers keep the variables of a session, with their values, until version changes, which it does whenever a
+        # variable is assigned. key tells the sessions apart in the workers.
+        self.key = next(_session_keys)
+        self.version = 0
+        self._snapshot = None  # type: Optional[Tuple[int, bytes]]
+
+    def snapshot(self) -> bytes:
+        # The pickled definitions of the variables, which are only pickled again after they change.
+        if self._snapshot is None or self._snapshot[0] != self.version:
+            self._snapshot = (self.version, pickle.dumps(self.calc.vrs.entries(), pickle.HIGHEST_PROTOCOL))
+
+        return self._snapshot[1]
+
+    def is_heavy(self, tokens: Iterable[Token]) -> bool:
+        names = []
+
+        for token in tokens:
+            if token.name == 'LBR' or token.name == 'OPR' and token.value not in scalar_operators:
+                return True
+
+            if token.name == 'IDT':
+                names.append(token.value)
+
+        return self._uses_heavy(names)
+
+    def _uses_heavy(self, names: List[str]) -> bool:
+        # Variables are looked up when they are used, so y = z + 1 becomes heavy once z is defined with a matrix, even
+        # if that happens after y is defined. The dependencies are followed each time instead of being marked ahead.
+        vrs = self.calc.vrs
+        seen = set()
+        stack = list(names)
+
+        while stack:
+            name = stack.pop()
+
+            if name in seen:
+                continue
+
+            seen.add(name)
+
+            if name in self.heavy:
+                return True
+
+            if name in vrs:
+                stack.extend(vrs.dependencies(name))
+
+        return False
+
+
+class _Pending:
+    # A request waiting for its response. line is the encoded response once there is one.
+    __slots__ = ('connection', 'id', 'line')
+
+    def __init__(self, connection: '_Connection', ident=None):
+        self.connection = connection
+        self.id = ident
+        self.line = None  # type: Optional[bytes]
+
+
+class _Connection:
+    def __init__(self, sock: socket.socket, session: Session):
+        self.sock = sock
+        self.session = session
+        self.received = bytearray()
+        self.outgoing = bytearray()
+        # Every request which hasn't been sent its response yet, in the order they arrived.
+        self.pending = deque()  # type: Deque[_Pending]
+        # False once the client has closed its side, sent a line that is too long, or the server is shutting down.
+        self.reading = True
+        self.events = 0
+        self.closed = False
+
+
+class EvaluationServer:
+    """
+    Serves Calculator sessions over a TCP address (a (host, port) pair) or a Unix socket (a path) from a single event
+    loop. Equations using matrices are evaluated by a pool of worker processes, or in the event loop when workers is 0.
+
+    A client can send any number of requests without waiting for their responses. A connection stops being read while
+    max_pending of its requests are waiting, or while max_pending lines of responses haven't been read by the client,
+    so a client that sends faster than it is answered is slowed down by TCP instead of filling the server's memory.
+    """
+
+    def __init__(self, address: Union[Tuple[str, int], str] = ('127.0.0.1', 0), workers=None, max_pending=64, max_line=1 << 20, store=None):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.max_pending = max_pending
+        # A request longer than this (in bytes) is answered with an error and its connection is closed.
+        self.max_line = max_line
+        self.store = store
+        # The named sessions. They are kept until the server stops.
+        self.sessions = {}  # type: Dict[str, Session]
+        self._path = None
+
+        if isinstance(address, str):
+            # A socket file left behind by a server that didn't stop cleanly is replaced; any other file is not.
+            if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+                os.unlink(address)
+
+            self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._listener.bind(address)
+            self._path = address
+
+        else:
+            self._listener = socket.socket(socket.AF_INET6 if ':' in address[0] else socket.AF_INET, socket.SOCK_STREAM)
+            self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._listener.bind(address)
+
+        self._listener.listen(128)
+        self._listener.setblocking(False)
+        self.address = self._listener.getsockname()
+
+        self._selector = selectors.DefaultSelector()
+        # Worker threads and signal handlers write a byte here to wake the event loop up.
+        self._wakeup, self._waker = socket.socketpair()
+        self._wakeup.setblocking(False)
+        self._waker.setblocking(False)
+        self._connections = set()  # type: Set[_Connection]
+        # Connections with responses ready to send.
+        self._ready = set()  # type: Set[_Connection]
+        # Requests whose worker process has finished, as (session, pending, future), appended by the pool's thread.
+        self._finished = deque()  # type: Deque[Tuple[Session, _Pending, Future]]
+        self._pool = None
+        self._stopping = threading.Event()
+        self._deadline = None
+        self._started = threading.Event()
+
+    def serve_forever(self, grace=10.0):
+        """
+        Serves until shutdown() is called. The server then stops accepting connections and reading requests, and waits
+        up to grace seconds for the requests it has already read to be answered before closing every connection.
+        """
+        if self.workers:
+            self._pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.store.path if self.store else None,))
+
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wakeup, selectors.EVENT_READ)
+        self._started.set()
+
+        try:
+            while self._connections or self._deadline is None:
+                timeout = None if self._deadline is None else max(0.0, self._deadline - time.monotonic())
+
+                for key, events in self._selector.select(timeout):
+                    if key.fileobj is self._listener:
+                        self._accept()
+
+                    elif key.fileobj is self._wakeup:
+                        self._drain_wakeup()
+
+                    else:
+                        self._handle(key.data, events)
+
+                self._complete()
+
+                if self._stopping.is_set() and self._deadline is None:
+                    self._begin_shutdown(grace)
+
+                for connection in list(self._ready):
+                    self._flush(connection)
+
+                self._ready.clear()
+
+                if self._deadline is not None and time.monotonic() >= self._deadline:
+                    break
+
+        finally:
+            for connection in list(self._connections):
+                self._close(connection)
+
+            if self._deadline is None:
+                self._selector.unregister(self._listener)
+                self._close_listener()
+
+            self._selector.close()
+            self._wakeup.close()
+            self._waker.close()
+
+            if self._pool is not None:
+                self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def shutdown(self):
+        """
+        Stops serve_forever gracefully. It can be called from any thread, and from signal handlers.
+        """
+        self._stopping.set()
+        self._wake()
+
+    def wait_started(self, timeout=None) -> bool:
+        # serve_forever is often run in another thread, which has started once this returns True.
+        return self._started.wait(timeout)
+
+    def _wake(self):
+        try:
+            self._waker.send(b'\0')
+
+        except (BlockingIOError, OSError):
+            # A full buffer already wakes the loop up, and a closed one means it has stopped.
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup.recv(4096):
+                pass
+
+        except BlockingIOError:
+            pass
+
+    def _begin_shutdown(self, grace: float):
+        self._deadline = time.monotonic() + grace
+        self._selector.unregister(self._listener)
+        self._close_listener()
+
+        for connection in list(self._connections):
+            connection.reading = False
+            self._ready.add(connection)
+
+    def _close_listener(self):
+        self._listener.close()
+
+        if self._path is not None and os.path.exists(self._path):
+            os.unlink(self._path)
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+
+            except (BlockingIOError, InterruptedError):
+                return
+
+            sock.setblocking(False)
+
+            if sock.family != socket.AF_UNIX:
+                # Responses are small and sent as soon as they are ready, so they shouldn't wait for more data.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            connection = _Connection(sock, Session(self.store))
+            self._connections.add(connection)
+            self._update_events(connection)
+
+    def _handle(self, connection: _Connection, events: int):
+        if events & selectors.EVENT_WRITE:
+            self._send(connection)
+
+        if events & selectors.EVENT_READ and not connection.closed:
+            self._receive(connection)
+
+        self._ready.add(connection)
+
+    def _receive(self, connection: _Connection):
+        try:
+            data = connection.sock.recv(65536)
+
+        except (BlockingIOError, InterruptedError):
+            return
+
+        except OSError:
+            self._close(connection)
+            return
+
+        if not data:
+            # The client won't send anything else, but still gets the responses to what it sent before.
+            connection.reading = False
+
+            if connection.received.strip():
+                self._request(connection, bytes(connection.received))
+
+            connection.received.clear()
+            return
+
+        received = connection.received
+        received += data
+        start = 0
+
+        while True:
+            end = received.find(b'\n', start)
+
+            if end < 0:
+                break
+
+            if end - start > self.max_line:
+                self._reject(connection)
+                return
+
+            if end > start:
+                self._request(connection, bytes(received[start:end]))
+
+            start = end + 1
+
+        del received[:start]
+
+        if len(received) > self.max_line:
+            self._reject(connection)
+
+    def _reject(self, connection: _Connection):
+        pending = _Pending(connection)
+        connection.pending.append(pending)
+        self._respond(pending, error='The request is longer than {} bytes'.format(self.max_line))
+        connection.reading = False
+        connection.received.clear()
+
+    def _request(self, connection: _Connection, line: bytes):
+        if not line.strip():
+            return
+
+        pending = _Pending(connection)
+        connection.pending.append(pending)
+
+        try:
+            request = json.loads(line)
+
+        except ValueError as e:
+            self._respond(pending, error='Invalid JSON: {}'.format(e))
+            return
+
+        if not isinstance(request, dict):
+            self._respond(pending, error='A request must be a JSON object')
+            return
+
+        pending.id = request.get('id')
+        eqtn = request.get('eqtn')
+        tpe = request.get('tpe', 'infix')
+        name = request.get('session')
+
+        if not isinstance(eqtn, str):
+            self._respond(pending, error='A request must have an eqtn string')
+
+        elif tpe not in notations:
+            self._respond(pending, error='tpe must be one of {}'.format(', '.join(notations)))
+
+        elif name is not None and not isinstance(name, str):
+            self._respond(pending, error='session must be a string')
+
+        else:
+            if name is None:
+                session = connection.session
+
+            else:
+                session = self.sessions.get(name)
+
+                if session is None:
+                    session = self.sessions[name] = Session(self.store)
+
+            session.queue.append((pending, eqtn, tpe))
+            self._advance(session)
+
+    def _advance(self, session: Session):
+        # Evaluates the session's requests in order until one of them has to wait for a worker process.
+        while session.queue and not session.busy:
+            pending, eqtn, tpe = session.queue.popleft()
+
+            try:
+                result = self._start(session, eqtn, tpe)
+
+            except Exception as e:
+                self._respond(pending, error=e)
+                continue
+
+            if isinstance(result, Future):
+                session.busy = True
+                result.add_done_callback(lambda future, session=session, pending=pending: self._done(session, pending, future))
+
+            else:
+                self._respond(pending, result)
+
+    def _start(self, session: Session, eqtn: str, tpe: str):
+        """
+        Evaluates eqtn like Calculator#evaluate, and returns its value, or the Future of its value when a worker process
+        evaluates it. Assignments only store their definitions, so they are always made here; only the part which
+        produces the value is sent to a worker, along with the session's definitions.
+        """
+        calc = session.calc
+
+        for e in eqtn.split(';'):
+            heavy = session.is_heavy(calc._tokenize(e))
+            ast = calc._compile(e, tpe)
+
+            if ast.root.name == 'asn':
+                res = ast.run(calc.vrs)
+                calc.vrs.update(res)
+                session.version += 1
+
+                if heavy:
+                    session.heavy.update(res)
+
+                else:
+                    session.heavy.difference_update(res)
+
+            elif heavy and self._pool is not None:
+                return self._pool.submit(_evaluate_remote, session.key, session.version, session.snapshot(), e, tpe)
+
+            else:
+                return ast.run(calc.vrs)
+
+    def _done(self, session: Session, pending: _Pending, future: Future):
+        # Called on the pool's thread, so the result is handed to the event loop.
+        self._finished.append((session, pending, future))
+        self._wake()
+
+    def _complete(self):
+        while self._finished:
+            session, pending, future = self._finished.popleft()
+            session.busy = False
+
+            if future.cancelled():
+                self._respond(pending, error='The server is shutting down')
+
+            elif future.exception() is not None:
+                self._respond(pending, error=future.exception())
+
+            else:
+                self._respond(pending, future.result())
+
+            self._advance(session)
+
+    def _respond(self, pending: _Pending, value=None, error=None):
+        try:
+            response = {'id': pending.id, 'value': plain(value), 'error': None if error is None else str(error) or type(error).__name__}
+            pending.line = (json.dumps(response) + '\n').encode()
+
+        except (TypeError, ValueError) as e:
+            # An id that json can't write back, or a value it can't write.
+            pending.line = (json.dumps({'id': None, 'value': None, 'error': str(e)}) + '\n').encode()
+
+        self._ready.add(pending.connection)
+
+    def _flush(self, connection: _Connection):
+        if connection.closed:
+            return
+
+        pending = connection.pending
+
+        while pending and pending[0].line is not None:
+            connection.outgoing += pending.popleft().line
+
+        if connection.outgoing:
+            self._send(connection)
+
+        if not connection.closed:
+            self._update_events(connection)
+
+    def _send(self, connection: _Connection):
+        try:
+            sent = connection.sock.send(connection.outgoing)
+
+        except (BlockingIOError, InterruptedError):
+            return
+
+        except OSError:
+            self._close(connection)
+            return
+
+        del connection.outgoing[:sent]
+
+    def _update_events(self, connection: _Connection):
+        if not connection.reading and not connection.pending and not connection.outgoing:
+            self._close(connection)
+            return
+
+        events = 0
+
+        # Reading stops while too many requests are waiting or too many responses haven't been read by the client.
+        if connection.reading and len(connection.pending) < self.max_pending and len(connection.outgoing) < self.max_pending * 1024:
+            events |= selectors.EVENT_READ
+
+        if connection.outgoing:
+            events |= selectors.EVENT_WRITE
+
+        if events != connection.events:
+            if not connection.events:
+                self._selector.register(connection.sock, events, connection)
+
+            elif not events:
+                self._selector.unregister(connection.sock)
+
+            else:
+                self._selector.modify(connection.sock, events, connection)
+
+            connection.events = events
+
+    def _close(self, connection: _Connection):
+        if connection.closed:
+            return
+
+        connection.closed = True
+
+        if connection.events:
+            self._selector.unregister(connection.sock)
+            connection.events = 0
+
+        # Nobody will read the responses, so the connection's own requests aren't evaluated. Requests in named sessions
+        # still are, since they may assign variables other connections use.
+        connection.session.queue.clear()
+        connection.pending.clear()
+        connection.sock.close()
+        self._connections.discard(connection)
+
+
+# The calculator of each worker process of an EvaluationServer, and the variables of the sessions it evaluated last, as
+# (version, Variables) by session key.
+_worker_calculator = None
+_worker_sessions = OrderedDict()  # type: OrderedDict[int, Tuple[int, Variables]]
+
+
+def _init_worker(store_path: str):
+    global _worker_calculator
+    _worker_calculator = Calculator()
+
+    if store_path is not None:
+        from store import ExpressionStore
+        _worker_calculator.store = ExpressionStore(store_path)
+
+
+def _evaluate_remote(key: int, version: int, snapshot: bytes, eqtn: str, tpe: str):
+    # Values computed for a session, like a matrix built from a long literal, are kept for its next requests until its
+    # variables change. Only equations which don't assign are sent here, so they never change the variables themselves.
+    calc = _worker_calculator
+    cached = _worker_sessions.pop(key, None)
+
+    if cached is None or cached[0] != version:
+        vrs = Variables()
+        vrs.update(pickle.loads(snapshot))
+        cached = (version, vrs)
+
+    _worker_sessions[key] = cached
+
+    if len(_worker_sessions) > worker_sessions:
+        _worker_sessions.popitem(last=False)
+
+    calc.vrs = cached[1]
+    return calc._compile(eqtn, tpe).run(calc.vrs)
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description='Evaluates equations sent as JSON Lines over TCP or a Unix socket.')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=7878, help='the TCP port to listen on')
+    parser.add_argument('-u', '--unix', help='listen on this Unix socket instead of TCP')
+    parser.add_argument('-w', '--workers', type=int, help='the number of processes evaluating matrices (0 evaluates them in the server); defaults to the number of CPUs')
+    parser.add_argument('--max-pending', type=int, default=64, help='the number of requests a connection can have waiting before it stops being read')
+    parser.add_argument('--grace', type=float, default=10.0, help='the seconds to wait for requests to finish when stopping')
+    parser.add_argument('--store', help='an ExpressionStore file of equations parsed ahead of time')
+    args = parser.parse_args(argv)
+
+    store = None
+
+    if args.store:
+        from store import ExpressionStore
+        store = ExpressionStore(args.store)
+
+    server = EvaluationServer(args.unix or (args.host, args.port), args.workers, args.max_pending, store=store)
+
+    # Both signals stop the server gracefully, so requests already read are still answered.
+    signal.signal(signal.SIGINT, lambda *_: server.shutdown())
+    signal.signal(signal.SIGTERM, lambda *_: server.shutdown())
+
+    print('Serving on {} with {} workers'.format(server.address, server.workers), file=sys.stderr)
+    server.serve_forever(args.grace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+This file contains the Stats class, which records how long each phase of Calculator#evaluate takes.
+"""
+from contextlib import contextmanager
+from typing import Callable, Dict
+
+import cProfile
+
+# The phases of an evaluation. total is the whole Calculator#evaluate call; the others are parts of it. Infix, prefix
+# and postfix equations are parsed into fixed trees directly, so fix is only timed for the reference parser, and load
+# is only timed for equations found in an ExpressionStore.
+phases = ('total', 'tokenize', 'parse', 'fix', 'load', 'evaluate', 'render')
+
+# calls to Calculator#evaluate, tokens scanned, patterns the reference parser gave up on after matching part of them,
+# and Values built.
+counters = ('calls', 'tokens', 'backtracks', 'values')
+
+# Histogram bucket i counts the times under 2^i microseconds (and at least 2^(i-1)); the last one also counts the rest.
+buckets = 32
+
+
+class PhaseStats:
+    """
+    The number of times a phase ran, how long it took in total and at most (in seconds), and a histogram of the times.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * buckets
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+
+        if seconds > self.max:
+            self.max = seconds
+
+        self.histogram[min(int(seconds * 1e6).bit_length(), buckets - 1)] += 1
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """
+        An upper bound on the q-th percentile (0 to 100) of the times, from the histogram. It is at most twice the true
+        percentile, and never more than the slowest time.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = q / 100 * self.count
+        seen = 0
+
+        for i, n in enumerate(self.histogram):
+            seen += n
+
+            if n and seen >= rank:
+                return min(2 ** i / 1e6, self.max)
+
+        return self.max
+
+    def as_dict(self) -> Dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'histogram': list(self.histogram),
+        }
+
+
+class Stats:
+    """
+    The timings of every phase and the counters of an instrumented Calculator, since it was built or last reset.
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.reset()
+
+    def reset(self):
+        self.phases = {phase: PhaseStats() for phase in phases}
+        self.counters = dict.fromkeys(counters, 0)
+
+    def record(self, phase: str, seconds: float):
+        self.phases[phase].add(seconds)
+
+    def count(self, counter: str, n=1):
+        self.counters[counter] += n
+
+    def __getitem__(self, key):
+        # Phases and counters have different names, so stats['parse'] is a PhaseStats and stats['tokens'] is a number.
+        return self.phases[key] if key in self.phases else self.counters[key]
+
+    def as_dict(self) -> Dict:
+        return {'phases': {phase: timing.as_dict() for phase, timing in self.phases.items()}, 'counters': dict(self.counters)}
+
+    def __str__(self):
+        lines = ['{:<10}{:>10}{:>12}{:>12}{:>12}{:>12}'.format('phase', 'count', 'total ms', 'mean us', 'p99 us', 'max us')]
+
+        for phase, timing in self.phases.items():
+            if timing.count:
+                lines.append('{:<10}{:>10}{:>12.3f}{:>12.1f}{:>12.1f}{:>12.1f}'.format(phase, timing.count, timing.total * 1e3, timing.mean * 1e6, timing.percentile(99) * 1e6, timing.max * 1e6))
+
+        lines.extend('{:<10}{:>10}'.format(counter, n) for counter, n in self.counters.items())
+        return '\n'.join(lines)
+
+
+def profile_calls(sink: Callable[[str, str, cProfile.Profile], None]):
+    """
+    A hook for Calculator#profile which runs every evaluate call under cProfile and passes the equation, its notation
+    and the finished profile to sink, like profile_calls(lambda eqtn, tpe, profile: profile.dump_stats('calc.prof')).
+    """
+    @contextmanager
+    def hook(eqtn: str, tpe: str):
+        profile = cProfile.Profile()
+        profile.enable()
+
+        try:
+            yield
+
+        finally:
+            profile.disable()
+            sink(eqtn, tpe, profile)
+
+    return hook
+
@@ -0,0 +1,308 @@
+"""
+This file contains the ExpressionStore class, which keeps fixed trees on disk so new processes don't parse them again.
+"""
+from typing import Iterable, List, Optional, Tuple
+
+import hashlib
+import mmap
+import os
+import struct
+import sys
+
+from ast import Ast
+from cache import ExpressionCache
+from calculator import Calculator
+from common import RuleMatch, Token, left_assoc, remove, rules_map, token_map
+
+# Bumped whenever the layout below changes, so older stores are ignored instead of misread.
+version = 1
+magic = b'ASTSTORE'
+
+# magic, version, grammar fingerprint, then the number of constants, index entries and instructions.
+header = struct.Struct('<8sI32sIII')
+# The length of a constant, which is followed by its UTF-8 bytes.
+constant = struct.Struct('<I')
+# The hash of a key, the constant holding the key itself, and the first instruction and number of instructions of its tree.
+entry = struct.Struct('<QIII')
+# An opcode and two operands, which are indices into the constants except for the number of children of a node.
+instruction = struct.Struct('<BII')
+
+# A Token(name, value), where both operands are constants.
+op_token = 0
+# A RuleMatch(name, children), which takes the last children trees built.
+op_node = 1
+
+
+def grammar_fingerprint() -> bytes:
+    """
+    A digest of everything the stored trees depend on: the tokens, the rules of every notation and the way trees are
+    fixed. A store built with a different grammar has a different fingerprint and is ignored.
+    """
+    grammar = [version, list(token_map.items()), remove, sorted(left_assoc.items())]
+
+    for tpe in sorted(rules_map):
+        grammar.append((tpe, list(rules_map[tpe].items())))
+
+    return hashlib.sha256(repr(grammar).encode()).digest()
+
+
+def key_hash(key: Tuple[str, str]) -> int:
+    # hash() is salted per process, so the stored hashes use a fixed digest of the cache key instead.
+    return int.from_bytes(hashlib.blake2b(_key_string(key).encode(), digest_size=8).digest(), 'little')
+
+
+def _key_string(key: Tuple[str, str]) -> str:
+    eqtn, tpe = key
+    return tpe + '\0' + eqtn
+
+
+class ExpressionStore:
+    """
+    A read-only mapping from ExpressionCache keys to fixed Asts, backed by a memory-mapped store file. Only the
+    constants are decoded when the store is opened; each tree is decoded from its instructions when it is looked up.
+    A missing store, or one built for another grammar, is stale and has no trees.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stale = True
+        self._map = None
+        self._constants = []
+        self._tokens = {}
+        self._entries = 0
+        self._index_start = 0
+        self._code_start = 0
+
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < header.size:
+                    return
+
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except FileNotFoundError:
+            return
+
+        file_magic, file_version, fingerprint, constants, self._entries, instructions = header.unpack_from(self._map, 0)
+
+        if file_magic != magic or file_version != version or fingerprint != grammar_fingerprint():
+            self.close()
+            return
+
+        offset = self._read_constants(constants)
+
+        # A truncated or corrupt store doesn't end where its header says, so it is stale instead of being misread.
+        if offset is None or offset + self._entries * entry.size + instructions * instruction.size != len(self._map):
+            self.close()
+            return
+
+        self._index_start = offset
+        self._code_start = offset + self._entries * entry.size
+        self.stale = False
+
+    def _read_constants(self, count: int) -> Optional[int]:
+        # Returns the offset after the constants, or None if they run past the end of the file or aren't UTF-8.
+        offset = header.size
+        size = len(self._map)
+
+        for _ in range(count):
+            if offset + constant.size > size:
+                return None
+
+            length, = constant.unpack_from(self._map, offset)
+            offset += constant.size
+
+            if offset + length > size:
+                return None
+
+            try:
+                self._constants.append(self._map[offset:offset + length].decode())
+
+            except UnicodeDecodeError:
+                return None
+
+            offset += length
+
+        return offset
+
+    def get(self, key: Tuple[str, str]) -> Optional[Ast]:
+        i = self._find(key)
+
+        if i is None:
+            return None
+
+        _, _, start, count = entry.unpack_from(self._map, self._index_start + i * entry.size)
+        return Ast(self._decode(start, count), fixed=True)
+
+    def _find(self, key: Tuple[str, str]) -> Optional[int]:
+        # The index is sorted by hash, so a key is found by a binary search over the mapped entries.
+        target = key_hash(key)
+        lo, hi = 0, self._entries
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if entry.unpack_from(self._map, self._index_start + mid * entry.size)[0] < target:
+                lo = mid + 1
+
+            else:
+                hi = mid
+
+        string = _key_string(key)
+
+        # Keys whose hashes collide are next to each other, so the stored key tells them apart.
+        while lo < self._entries:
+            h, k, _, _ = entry.unpack_from(self._map, self._index_start + lo * entry.size)
+
+            if h != target:
+                break
+
+            if self._constants[k] == string:
+                return lo
+
+            lo += 1
+
+        return None
+
+    def _decode(self, start: int, count: int) -> RuleMatch:
+        constants = self._constants
+        tokens = self._tokens
+        offset = self._code_start + start * instruction.size
+        stack = []
+
+        for opcode, a, b in instruction.iter_unpack(self._map[offset:offset + count * instruction.size]):
+            if opcode == op_token:
+                # Tokens are immutable, so every tree shares one Token for each name and value.
+                token = tokens.get((a, b))
+
+                if token is None:
+                    token = tokens[a, b] = Token(constants[a], constants[b])
+
+                stack.append(token)
+
+            else:
+                children = stack[len(stack) - b:]
+                del stack[len(stack) - b:]
+                stack.append(RuleMatch(constants[a], children))
+
+        return stack[0]
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __len__(self):
+        return self._entries
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._constants = []
+        self._tokens = {}
+        self._entries = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def build(path: str, eqtns: Iterable[Tuple[str, str]]) -> int:
+        """
+        Parses every (equation, notation) pair and writes the fixed trees to a new store at path, replacing any store
+        already there. Equations separated by ; are stored separately, like Calculator#evaluate compiles them. Returns
+        the number of trees stored.
+        """
+        calc = Calculator(cache=None)
+        constants = []
+        constant_indices = {}
+        entries = {}
+        code = []
+
+        def index(string):
+            if string not in constant_indices:
+                constant_indices[string] = len(constants)
+                constants.append(string)
+
+            return constant_indices[string]
+
+        for eqtn, tpe in eqtns:
+            for e in eqtn.split(';'):
+                key = ExpressionCache.key(e, tpe)
+
+                if not key[0] or key in entries:
+                    continue
+
+                try:
+                    root = calc._parse(calc._tokenize(e), tpe).root
+
+                except Exception as error:
+                    raise ValueError('Cannot store {!r}: {}'.format(e, error)) from error
+
+                start = len(code)
+                code.extend(_encode(root, index))
+                entries[key] = (key_hash(key), index(_key_string(key)), start, len(code) - start)
+
+        encoded = [string.encode() for string in constants]
+        index_entries = sorted(entries.values())
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+
+        # The store is written next to its final path and then renamed, so readers never map a half-written file.
+        try:
+            with open(temporary, 'wb') as f:
+                f.write(header.pack(magic, version, grammar_fingerprint(), len(encoded), len(index_entries), len(code)))
+
+                for string in encoded:
+                    f.write(constant.pack(len(string)))
+                    f.write(string)
+
+                f.write(b''.join(entry.pack(*e) for e in index_entries))
+                f.write(b''.join(instruction.pack(*i) for i in code))
+
+            os.replace(temporary, path)
+
+        finally:
+            # Only left behind if writing or renaming failed.
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+        return len(index_entries)
+
+
+def _encode(root: RuleMatch, index) -> List[Tuple[int, int, int]]:
+    # The tree is written in post-order, so decoding it is a single pass with a stack of finished children.
+    code = []
+    stack = [(root, False)]
+
+    while stack:
+        node, visited = stack.pop()
+
+        if isinstance(node, Token):
+            code.append((op_token, index(node.name), index(node.value)))
+
+        elif visited:
+            code.append((op_node, index(node.name), len(node.matched)))
+
+        else:
+            stack.append((node, True))
+            stack.extend((child, False) for child in reversed(node.matched))
+
+    return code
+
+
+if __name__ == '__main__':
+    # python store.py <store> <prefix|postfix|infix> <file>... stores every line of the files.
+    if len(sys.argv) < 4:
+        print('Usage: python store.py <store> <prefix|postfix|infix> <file>...')
+        sys.exit(1)
+
+    def lines():
+        for name in sys.argv[3:]:
+            with open(name) as f:
+                for line in f:
+                    if line.strip():
+                        yield line, sys.argv[2]
+
+    print('Stored {} expressions in {}'.format(ExpressionStore.build(sys.argv[1], lines()), sys.argv[1]))
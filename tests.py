@@ -2,13 +2,22 @@
 Unit tests for the AST calculator.
 """
 import decimal
+import math
 import random
+import time
 import unittest
 
 import sympy
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from benchmarks import run as benchmark
+from cache import ExpressionCache
 from calculator import Calculator
-from common import EvaluationException
+from common import EvaluationException, Token, rules_map
 
 
 def evaluate(eqtn: str, tpe='infix', verbose=True):
@@ -24,6 +33,20 @@ def evaluate(eqtn: str, tpe='infix', verbose=True):
     return res.value
 
 
+def growth_exponent(setup, sizes, repeat=5, min_time=0.01) -> float:
+    """
+    The empirical exponent k of an operation which takes about c * n^k seconds at size n: the slope of the least squares
+    line through log(time) against log(n). setup(n) builds an input of size n and returns the function to time, which
+    is timed by benchmarks.run.measure. CPU time is used, since a busy machine preempting the large sizes more often
+    than the small ones would otherwise look like faster growth.
+    """
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(benchmark.measure(setup(n), min_time, repeat, time.process_time)['seconds']) for n in sizes]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / sum((x - mean_x) ** 2 for x in xs)
+
+
 class InvalidEquationTests(unittest.TestCase):
     def runTest(self):
         with self.assertRaises(Exception):
@@ -36,6 +59,29 @@ class InvalidEquationTests(unittest.TestCase):
             evaluate('1 * / 2')
 
 
+class TokenizerTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator()
+        self.assertEqual(calc._tokenize('sqrt(x1.5)'), [Token('OPR', 'sqrt'), Token('LPA', '('), Token('IDT', 'x'), Token('NUM', '1.5'), Token('RPA', ')')])
+        self.assertEqual(calc._tokenize('2 ** 3 ^ 4'), [Token('NUM', '2'), Token('POW', '**'), Token('NUM', '3'), Token('POW', '^'), Token('NUM', '4')])
+
+        with self.assertRaises(Exception):
+            calc._tokenize('1 + $')
+
+
+class ParserTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator()
+
+        root, remaining = calc._match(calc._tokenize(' + '.join(['1'] * 500)), 'asn', rules_map['infix'])
+        self.assertEqual(root.name, 'add')
+        self.assertEqual(remaining, [])
+
+        root, remaining = calc._match(calc._tokenize('1 +'), 'asn', rules_map['infix'])
+        self.assertEqual(root.name, 'num')
+        self.assertEqual(remaining, [Token('ADD', '+')])
+
+
 class AdditionTests(unittest.TestCase):
     def runTest(self):
         self.assertEqual(evaluate('1 + 2'), 3.0)
@@ -89,6 +135,39 @@ class IdentifierTests(unittest.TestCase):
         self.assertEqual(round(evaluate('area = pi * r^2; r = 5.2 * (3 + 2 / (1 + 1/6)); pi = 3.14159; area'), 5), 1887.93915)
 
 
+class VariableTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator()
+
+        self.assertEqual(calc.evaluate('r = 2; d = 2 * r; area = 3 * r ^ 2; c = d + area; c', 'infix', False).value, 16.0)
+        self.assertIs(calc.vrs['area'], calc.vrs['area'])
+
+        area = calc.vrs['area']
+        self.assertEqual(calc.evaluate('d = 3 * r; c', 'infix', False).value, 18.0)
+        self.assertIs(calc.vrs['area'], area)
+        self.assertEqual(calc.evaluate('r = 1; c', 'infix', False).value, 6.0)
+
+        calc.evaluate('q, r = qr([1, 2 | 3, 4])', 'infix', False)
+        self.assertIs(calc.vrs['q'], calc.vrs['q'])
+        self.assertIs(calc.vrs.rule('q'), calc.vrs.rule('r'))
+        self.assertEqual(calc.vrs['r'].type, 'MatrixValue')
+
+        with self.assertRaises(EvaluationException):
+            calc.evaluate('x = y + 1; y = 2 * x', 'infix', False)
+
+        with self.assertRaises(EvaluationException):
+            calc.evaluate('n = n + 1', 'infix', False)
+
+        self.assertNotIn('y', calc.vrs)
+        self.assertEqual(calc.evaluate('y = 1; x', 'infix', False).value, 2.0)
+
+        # Dependencies are evaluated in order instead of recursively, so a long chain doesn't hit the recursion limit.
+        names = [benchmark.variable(i) for i in range(1000)]
+        calc.evaluate('; '.join(['{} = 1'.format(names[0])] + ['{} = {} + 1'.format(name, before) for before, name in zip(names, names[1:])]), 'infix', False)
+        self.assertEqual(calc.evaluate(names[-1], 'infix', False).value, 1000.0)
+        self.assertEqual(calc.evaluate('{} = 5; {}'.format(names[0], names[-1]), 'infix', False).value, 1004.0)
+
+
 class OperationTests(unittest.TestCase):
     def runTest(self):
         self.assertEqual(evaluate('sqrt(4)'), 2.0)
@@ -96,6 +175,17 @@ class OperationTests(unittest.TestCase):
         self.assertEqual(evaluate('sqrt((4 * 5 - 1) % 10)'), 3.0)
         self.assertEqual(round(evaluate('exp(3)'), 5), 20.08554)
 
+        for eqtn in ('det(3)', '[1, 2] + 3', '[1, 2 | 3, 4] % 2', 'sqrt([1, 2])'):
+            with self.assertRaises(EvaluationException):
+                evaluate(eqtn)
+
+        for eqtn, message in (('2 - [1]', 'Cannot sub NumberValue and MatrixValue'), ('-[1, 2]', 'MatrixValue does not have operation neg')):
+            with self.assertRaisesRegex(EvaluationException, message):
+                evaluate(eqtn)
+
+        self.assertEqual(evaluate('2 * [1, 2] * 3'), [[6.0, 12.0]])
+        self.assertEqual(evaluate('2 ** 3 % 5 - -1'), 4.0)
+
 
 class CombinationTests(unittest.TestCase):
     def runTest(self):
@@ -114,7 +204,7 @@ class MatrixTests(unittest.TestCase):
         for r_dim in range(3, 4):
             print(r_dim)
 
-            self.assertTrue(sympy.Matrix(evaluate('identity({})'.format(r_dim), False)).equals(sympy.Identity(r_dim)))
+            self.assertTrue(sympy.Matrix(evaluate('identity({})'.format(r_dim), verbose=False)).equals(sympy.Identity(r_dim)))
 
             for _ in range(5):
                 print(_)
@@ -129,15 +219,15 @@ class MatrixTests(unittest.TestCase):
                     print('rref not identity!', rref)
 
                 try:
-                    self.assertTrue(decimal.Context(prec=10).create_decimal(float(evaluate('det({})'.format(mat_str), False))) == decimal.Context(prec=10).create_decimal(float(sym_mat.det())))
+                    self.assertTrue(decimal.Context(prec=10).create_decimal(float(evaluate('det({})'.format(mat_str), verbose=False))) == decimal.Context(prec=10).create_decimal(float(sym_mat.det())))
                     self.assertTrue(
-                        sympy.Matrix(evaluate('trans({})'.format(mat_str), False)).equals(sym_mat.transpose()))
-                    self.assertTrue(sympy.Matrix(evaluate('inv({})'.format(mat_str), False)).applyfunc(rnd).equals(
+                        sympy.Matrix(evaluate('trans({})'.format(mat_str), verbose=False)).equals(sym_mat.transpose()))
+                    self.assertTrue(sympy.Matrix(evaluate('inv({})'.format(mat_str), verbose=False)).applyfunc(rnd).equals(
                         sym_mat.inv().evalf().applyfunc(rnd)))
                     self.assertTrue(
-                        sympy.Matrix(evaluate('cof({})'.format(mat_str), False)).equals(sym_mat.cofactor_matrix()))
-                    self.assertTrue(sympy.Matrix(evaluate('rref({})'.format(mat_str), False)).equals(rref))
-                    self.assertTrue(sympy.Matrix(evaluate('trnsform({})'.format(mat_str), False)).multiply(sym_mat).evalf().applyfunc(rnd).equals(rref.evalf().applyfunc(rnd)))
+                        sympy.Matrix(evaluate('cof({})'.format(mat_str), verbose=False)).equals(sym_mat.cofactor_matrix()))
+                    self.assertTrue(sympy.Matrix(evaluate('rref({})'.format(mat_str), verbose=False)).equals(rref))
+                    self.assertTrue(sympy.Matrix(evaluate('trnsform({})'.format(mat_str), verbose=False)).multiply(sym_mat).evalf().applyfunc(rnd).equals(rref.evalf().applyfunc(rnd)))
                     # TODO: trnsform doesn't work.
                 except AssertionError:
                     print('FAILED')
@@ -148,15 +238,15 @@ class MatrixTests(unittest.TestCase):
                     print('cof', sym_mat.cofactor_matrix())
                     print('rref', rref)
                     print('----')
-                    print('det', evaluate('det({})'.format(mat_str), False))
-                    print('trans', evaluate('trans({})'.format(mat_str), False))
-                    print('inv', evaluate('inv({})'.format(mat_str), False))
-                    print('cof', evaluate('cof({})'.format(mat_str), False))
-                    print('rref', evaluate('rref({})'.format(mat_str), False))
-                    print('trnsform', evaluate('trnsform({})'.format(mat_str), False))
-                    print('trnsform * matrix', sympy.Matrix(evaluate('trnsform({})'.format(mat_str), False)).multiply(sym_mat))
+                    print('det', evaluate('det({})'.format(mat_str), verbose=False))
+                    print('trans', evaluate('trans({})'.format(mat_str), verbose=False))
+                    print('inv', evaluate('inv({})'.format(mat_str), verbose=False))
+                    print('cof', evaluate('cof({})'.format(mat_str), verbose=False))
+                    print('rref', evaluate('rref({})'.format(mat_str), verbose=False))
+                    print('trnsform', evaluate('trnsform({})'.format(mat_str), verbose=False))
+                    print('trnsform * matrix', sympy.Matrix(evaluate('trnsform({})'.format(mat_str), verbose=False)).multiply(sym_mat))
                     print('trnsform * matrix with rounding',
-                          sympy.Matrix(evaluate('trnsform({})'.format(mat_str), False)).multiply(sym_mat).evalf().applyfunc(rnd))
+                          sympy.Matrix(evaluate('trnsform({})'.format(mat_str), verbose=False)).multiply(sym_mat).evalf().applyfunc(rnd))
                     raise
                 except EvaluationException as e:
                     print(e)
@@ -176,5 +266,856 @@ class RandomTests(unittest.TestCase):
             self.assertEqual(evaluate(eqtn), eval(eqtn))
 
 
+class ScalingTests(unittest.TestCase):
+    # The declared exponent of every operation, which it may not exceed by more than slack. The slack absorbs noise, and
+    # the constant overheads which make small inputs look cheaper than they are only lower the measured exponents.
+    slack = 0.5
+    # Constant overheads hide the growth of small inputs, so the sizes are as large as the test can afford.
+    sizes = (1000, 2000, 4000)
+    # The reference parser is recursive descent, so it can't take equations as long as the others.
+    reference_sizes = (100, 200, 400)
+    # Sessions can hold hundreds of interdependent variables, which is more than the recursion limit allows a recursive
+    # lookup to handle.
+    chain_sizes = (100, 200, 400)
+
+    def runTest(self):
+        calc = Calculator(cache=None)
+        reference = Calculator(reference=True)
+        eqtns = {}
+
+        def eqtn(n):
+            # Like RandomTests, but with n terms and without % (whose float results eval can round differently).
+            if n not in eqtns:
+                rng = random.Random(n)
+                eqtns[n] = ' '.join(['{} {}'.format(rng.randint(1, 100), rng.choice(('+', '-', '*', '/'))) for _ in range(n)])[:-2]
+
+            return eqtns[n]
+
+        def ast(n):
+            return calc._compile(eqtn(n), 'infix')
+
+        def chain(n):
+            # n variables which each depend on the one before, all recomputed after the first is assigned again.
+            variable = benchmark.variable
+            chained = Calculator()
+            chained.evaluate('; '.join(['{} = 1'.format(variable(0))] + ['{} = {} + 1'.format(variable(i), variable(i - 1)) for i in range(1, n)]), 'infix', False)
+            self.assertEqual(chained.evaluate(variable(n - 1), 'infix', False).value, n)
+            return lambda: chained.evaluate('{} = 1; {}'.format(variable(0), variable(n - 1)), 'infix', False)
+
+        for n in self.sizes + self.reference_sizes:
+            expected = eval(eqtn(n))
+            self.assertTrue(math.isclose(calc.evaluate(eqtn(n), 'infix', False).value, expected, rel_tol=1e-9, abs_tol=1e-9))
+            self.assertTrue(math.isclose(calc.evaluate(ast(n).postfix(), 'postfix', False).value, expected, rel_tol=1e-9, abs_tol=1e-9))
+
+            if n in self.reference_sizes:
+                self.assertTrue(math.isclose(reference.evaluate(eqtn(n), 'infix', False).value, expected, rel_tol=1e-9, abs_tol=1e-9))
+
+        operations = {
+            'tokenize': (1, self.sizes, lambda n: lambda: calc._tokenize(eqtn(n))),
+            'parse': (1, self.sizes, lambda n: lambda tokens=calc._tokenize(eqtn(n)): calc._parse(tokens, 'infix')),
+            'reference parse': (1, self.reference_sizes, lambda n: lambda tokens=calc._tokenize(eqtn(n)): reference._parse(tokens, 'infix')),
+            'prefix': (1, self.sizes, lambda n: lambda prefix=ast(n).prefix(): calc.evaluate(prefix, 'prefix', False)),
+            'postfix': (1, self.sizes, lambda n: lambda postfix=ast(n).postfix(): calc.evaluate(postfix, 'postfix', False)),
+            'evaluate': (1, self.sizes, lambda n: lambda tree=ast(n): tree.evaluate(calc.vrs)),
+            # Numbers alone would be folded into a single constant, so the odd ones are replaced by a variable.
+            'compiled': (1, self.sizes, lambda n: lambda f=calc.compile(' '.join('x' if part.isdigit() and int(part) % 2 else part for part in eqtn(n).split()), 'infix'): f({'x': 3.0})),
+            # A constant matrix doesn't fold into a number, but each subtree is still only evaluated once.
+            'fold': (1, self.chain_sizes, lambda n: lambda: calc._compile('[1, 2 | 3, 4]' + ' * [1, 0 | 0, 1]' * n + ' * x', 'infix').compile()),
+            'render': (1, self.sizes, lambda n: lambda tree=ast(n): tree.infix()),
+            'variables': (1, self.chain_sizes, chain),
+        }
+
+        for name, (bound, sizes, setup) in operations.items():
+            exponent = growth_exponent(setup, sizes)
+            self.assertLessEqual(exponent, bound + self.slack, '{} grows like n^{:.2f}, not n^{}'.format(name, exponent, bound))
+
+
+class MatrixScalingTests(unittest.TestCase):
+    # Every kernel is O(n^3) at these sizes; multiplication only switches to Strassen above matrix.strassen_threshold.
+    bound = 3
+    slack = 0.5
+    sizes = (16, 32, 64)
+
+    def runTest(self):
+        from vartypes import MatrixValue
+
+        matrix = benchmark.matrix
+
+        for n in self.sizes:
+            # A^-1 A = I and adj(A) A = det(A) I, where adj(A) is the transposed cofactor matrix.
+            a = MatrixValue(matrix(n, n))
+            det = a.det().value
+            identity = a.inv().mul(a).value
+            adjugate = a.adj().mul(a).value
+            self.assertTrue(all(abs(identity[i][j] - (i == j)) < 1e-9 for i in range(n) for j in range(n)))
+            self.assertTrue(all(abs(adjugate[i][j] - det * (i == j)) < 1e-9 * abs(det) for i in range(n) for j in range(n)))
+
+            if n <= 16:
+                sym_mat = sympy.Matrix(matrix(n, n))
+                product = (sym_mat * sympy.Matrix(matrix(n, n, 1))).tolist()
+                self.assertTrue(math.isclose(det, float(sym_mat.det()), rel_tol=1e-9))
+                self.assertTrue(all(math.isclose(cell, float(expected), rel_tol=1e-9, abs_tol=1e-9)
+                                    for row, expected_row in zip(a.mul(MatrixValue(matrix(n, n, 1))).value, product) for cell, expected in zip(row, expected_row)))
+
+        for name in ('mul', 'det', 'inv', 'cof', 'rref', 'solve', 'ls', 'qr'):
+            exponent = growth_exponent(lambda n: benchmark.matrix_operation(name, n), self.sizes)
+            self.assertLessEqual(exponent, self.bound + self.slack, '{} grows like n^{:.2f}, not n^{}'.format(name, exponent, self.bound))
+
+
+class InfixParserTests(unittest.TestCase):
+    """
+    Checks InfixParser against the reference _match and Ast#_fixed path.
+    """
+    def runTest(self):
+        fast = Calculator()
+        reference = Calculator(reference=True)
+
+        def tree(calc, eqtn):
+            try:
+                return str(calc._parse(calc._tokenize(eqtn), 'infix'))
+
+            except Exception as e:
+                return str(e)
+
+        def expression(depth=0):
+            if depth > 3 or random.random() < 0.3:
+                return random.choice(('1', '2.5', 'x', 'y'))
+
+            choice = random.randint(0, 9)
+
+            if choice == 0:
+                return '({})'.format(expression(depth + 1))
+
+            elif choice == 1:
+                return '-' + expression(depth + 1)
+
+            elif choice == 2:
+                return 'sqrt({})'.format(', '.join(expression(depth + 1) for _ in range(random.randint(1, 2))))
+
+            elif choice == 3:
+                return '[{}]'.format(' | '.join(', '.join(expression(depth + 1) for _ in range(2)) for _ in range(random.randint(1, 2))))
+
+            elif choice == 4:
+                return '{} {}'.format(expression(depth + 1), expression(depth + 1))
+
+            return '{} {} {}'.format(expression(depth + 1), random.choice(('+', '-', '*', '/', '%', '^')), expression(depth + 1))
+
+        for eqtn in ('2 3 * 4', '2 * 3 4', '2 3 4', 'a, b, c = 1', '-2 ^ 2', '1 - (2 + 3)', 'x = ', '[1'):
+            self.assertEqual(tree(fast, eqtn), tree(reference, eqtn))
+
+        for _ in range(500):
+            eqtn = random.choice(('', 'a = ', 'a, b = ')) + expression()
+            self.assertEqual(tree(fast, eqtn), tree(reference, eqtn))
+
+        # Nesting is parsed with explicit stacks, so it isn't limited by the recursion limit.
+        self.assertEqual(fast.evaluate('(' * 2000 + '1' + ')' * 2000, 'infix', False).value, 1.0)
+        self.assertEqual(fast.evaluate('- ' * 2001 + '1', 'infix', False).value, -1.0)
+        self.assertEqual(fast.evaluate('sqrt(' * 2000 + '1' + ')' * 2000, 'infix', False).value, 1.0)
+
+
+class NotationTests(unittest.TestCase):
+    def runTest(self):
+        self.assertEqual(evaluate('+ 1 2', 'prefix', False), 3.0)
+        self.assertEqual(evaluate('- 10 * 2 3', 'prefix', False), 4.0)
+        self.assertEqual(evaluate('= x 4; + sqrt x x', 'prefix', False), 6.0)
+        self.assertEqual(evaluate('3 4 + 2 *', 'postfix', False), 14.0)
+        self.assertEqual(evaluate('10 2 / 3 -', 'postfix', False), 2.0)
+        self.assertEqual(evaluate('2 3 ^; 1 2 +', 'postfix', False), 8.0)
+        self.assertEqual(evaluate('4 sqrt 1 +', 'postfix', False), 3.0)
+        self.assertEqual(evaluate('42', 'postfix', False), 42.0)
+
+        with self.assertRaises(Exception):
+            evaluate('1 2 3 +', 'postfix', False)
+
+        with self.assertRaises(Exception):
+            evaluate('+ 1', 'prefix', False)
+
+        fast = Calculator()
+        reference = Calculator(reference=True)
+
+        def expression(tpe, depth=0):
+            if depth > 4 or (depth and random.random() < 0.3):
+                return str(random.randint(1, 10))
+
+            operands = (expression(tpe, depth + 1), expression(tpe, depth + 1))
+            operator = random.choice(('+', '-', '*', '/', '^'))
+
+            return '{} {} {}'.format(operator, *operands) if tpe == 'prefix' else '{} {} {}'.format(*operands, operator)
+
+        for _ in range(200):
+            for tpe in ('prefix', 'postfix'):
+                eqtn = expression(tpe)
+                self.assertEqual(str(fast._parse(fast._tokenize(eqtn), tpe)), str(reference._parse(reference._tokenize(eqtn), tpe)))
+
+                try:
+                    expected = reference.evaluate(eqtn, tpe, False).value
+
+                except (ZeroDivisionError, OverflowError):
+                    continue
+
+                # A negative number to a fractional power is complex and may hold nan, which never equals itself, so
+                # the exact reprs are compared instead.
+                self.assertEqual(repr(fast.evaluate(eqtn, tpe, False).value), repr(expected), eqtn)
+
+
+class CacheTests(unittest.TestCase):
+    def runTest(self):
+        cache = ExpressionCache(2)
+        calc = Calculator(cache=cache)
+
+        calc.evaluate('r = 2', 'infix', False)
+        self.assertEqual(calc.evaluate('3 * r ^ 2', 'infix', False).value, 12.0)
+        calc.evaluate('r = 3', 'infix', False)
+        self.assertEqual(calc.evaluate('3  *  r ^ 2', 'infix', False).value, 27.0)
+        self.assertEqual(cache.info(), (1, 3, 1, 2, 2))
+
+        self.assertEqual(calc.evaluate('+ 1 2', 'prefix', False).value, 3.0)
+        self.assertEqual(cache.evictions, 2)
+        self.assertNotIn(ExpressionCache.key('r = 2', 'infix'), cache)
+
+        cache.resize(1)
+        self.assertEqual(len(cache), 1)
+        self.assertIn(ExpressionCache.key('+ 1 2', 'prefix'), cache)
+
+        # A maxsize of 0 disables the cache, and a negative one is rejected before it can break eviction.
+        cache.resize(0)
+        self.assertEqual(calc.evaluate('+ 1 2', 'prefix', False).value, 3.0)
+        self.assertEqual((len(cache), cache.evictions), (0, 4))
+
+        for maxsize in (-1, -5):
+            with self.assertRaises(ValueError):
+                ExpressionCache(maxsize)
+
+            with self.assertRaises(ValueError):
+                cache.resize(maxsize)
+
+        self.assertEqual(cache.maxsize, 0)
+
+
+class StoreTests(unittest.TestCase):
+    def runTest(self):
+        import os
+        import tempfile
+
+        from common import ImmutableIndexedDict
+        from store import ExpressionStore, header
+
+        eqtns = [('a = 2; b = a + 1', 'infix'), ('3*(2 + a + 5*b*2 + 3)', 'infix'), ('det([a, 1 | 1, b])', 'infix'), ('* + a b a', 'prefix'), ('a b ^ 1 -', 'postfix')]
+        calc = Calculator(cache=None)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'expressions.store')
+            self.assertTrue(ExpressionStore(path).stale)
+            self.assertEqual(ExpressionStore.build(path, eqtns), 6)
+
+            with ExpressionStore(path) as store:
+                self.assertFalse(store.stale)
+                self.assertEqual(len(store), 6)
+                self.assertIn(ExpressionCache.key(' 3*(2 + a  +  5*b*2 + 3)', 'infix'), store)
+                self.assertNotIn(ExpressionCache.key('3*(2 + a + 5*b*2 + 3)', 'prefix'), store)
+                self.assertIsNone(store.get(ExpressionCache.key('1 + 1', 'infix')))
+
+                for eqtn, tpe in eqtns:
+                    for e in eqtn.split(';'):
+                        self.assertEqual(str(store.get(ExpressionCache.key(e, tpe)).root), str(calc._parse(calc._tokenize(e), tpe).root))
+
+                # Every equation in the store is evaluated without being parsed.
+                stored = Calculator(cache=ExpressionCache(), store=store)
+                stored._parse = None
+                stored.evaluate('a = 2; b = a + 1', 'infix', False)
+                self.assertEqual(stored.evaluate('3*(2 + a + 5*b*2 + 3)', 'infix', False).value, 111.0)
+                self.assertEqual(stored.evaluate('* + a b a', 'prefix', False).value, 10.0)
+                self.assertEqual(stored.evaluate('a b ^ 1 -', 'postfix', False).value, 7.0)
+
+            grammar = rules_map['prefix']
+
+            try:
+                rules_map['prefix'] = ImmutableIndexedDict(list(grammar.items()) + [('^extra', ('NUM',))])
+
+                with ExpressionStore(path) as store:
+                    self.assertTrue(store.stale)
+                    self.assertNotIn(ExpressionCache.key('* + a b a', 'prefix'), store)
+
+            finally:
+                rules_map['prefix'] = grammar
+
+            with self.assertRaises(ValueError):
+                ExpressionStore.build(path, [('1 +', 'infix')])
+
+            # A truncated or corrupt store is stale, however much of it is left.
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            for corrupt in (data[:len(data) // 3], data[:-1], data + b'\0', data[:header.size] + b'\xff' * (len(data) - header.size)):
+                with open(path, 'wb') as f:
+                    f.write(corrupt)
+
+                with ExpressionStore(path) as store:
+                    self.assertTrue(store.stale)
+                    self.assertIsNone(store.get(ExpressionCache.key('* + a b a', 'prefix')))
+
+            # A store which can't be written leaves no temporary file behind.
+            blocked = os.path.join(directory, 'blocked')
+            os.mkdir(blocked)
+
+            with self.assertRaises(OSError):
+                ExpressionStore.build(blocked, eqtns)
+
+            self.assertEqual(sorted(os.listdir(directory)), ['blocked', 'expressions.store'])
+
+
+class CompileTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator()
+        area = calc.compile('pi * r ^ 2', 'infix')
+
+        self.assertEqual(area({'pi': 3.0, 'r': 2}).value, 12.0)
+        self.assertEqual(area({'pi': 3.0, 'r': 3}).value, 27.0)
+
+        calc.evaluate('a = 2; b = a + 1', 'infix', False)
+
+        for eqtn in ('3*(2 + a + 5*b*2 + 3)', '-sqrt(b + 1) ^ a', '[a, b | 1, 2] * [1 | 1]', 'det([a, 1 | 1, b])', '* + a b a'):
+            tpe = 'prefix' if eqtn.startswith('*') else 'infix'
+            ast = calc._compile(eqtn, tpe)
+            self.assertEqual(str(ast.compile()(calc.vrs)), str(ast.evaluate(calc.vrs)))
+
+        with self.assertRaises(EvaluationException):
+            calc.compile('sqrt([1, 2])', 'infix')({})
+
+
+class OptimizationTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator(cache=ExpressionCache())
+        calc.evaluate('x = 3', 'infix', False)
+
+        # 2 * 3 and det([1, 2 | 3, 4]) are folded, and the repeated x + 6 is merged.
+        ast = calc._compile('(x + 2 * 3) * (x + 2 * 3) - det([1, 2 | 3, 4])', 'infix')
+        prefix = ast.prefix()
+        root, shared = ast._optimized()
+        left, right = root.matched[1], root.matched[2]
+
+        self.assertEqual(right.name, 'cst')
+        self.assertEqual(right.value.value, -2.0)
+        self.assertIs(left.matched[1], left.matched[2])
+        self.assertEqual(shared, {id(left.matched[1])})
+
+        # The cached tree is rendered as it was written.
+        ast.compile()
+        self.assertEqual(ast.prefix(), prefix)
+
+        self.assertEqual(calc.evaluate('(x + 2 * 3) * (x + 2 * 3) - det([1, 2 | 3, 4])', 'infix', False).value, 83.0)
+
+        # Merged subtrees are evaluated again once the variables change.
+        calc.evaluate('x = 4', 'infix', False)
+        self.assertEqual(calc.evaluate('(x + 2 * 3) * (x + 2 * 3) - det([1, 2 | 3, 4])', 'infix', False).value, 102.0)
+
+        calc.evaluate('y = (x + 1) * (x + 1)', 'infix', False)
+        self.assertEqual(calc.evaluate('y', 'infix', False).value, 25.0)
+        calc.evaluate('x = 1', 'infix', False)
+        self.assertEqual(calc.evaluate('y', 'infix', False).value, 4.0)
+
+        # Identical rows still become separate rows.
+        matrix = calc.evaluate('[1 + 1, 2 | 1 + 1, 2]', 'infix', False).value
+        self.assertIsNot(matrix[0], matrix[1])
+
+        with self.assertRaises(ZeroDivisionError):
+            calc.compile('1 / (2 - 2)', 'infix')({})
+
+
+class DeepExpressionTests(unittest.TestCase):
+    def runTest(self):
+        import sys
+
+        calc = Calculator()
+        calc.evaluate('a = 2', 'infix', False)
+        n = 4 * sys.getrecursionlimit()
+
+        self.assertEqual(calc.evaluate(' ^ '.join(['1'] * n), 'infix', False).value, 1.0)
+        self.assertEqual(calc.evaluate(' + '.join(['1'] * n), 'infix', False).value, n)
+        self.assertEqual(calc.evaluate(' - '.join(['a'] * n), 'infix', False).value, 2 - 2 * (n - 1))
+        self.assertEqual(calc.evaluate(' '.join(['+'] * (n - 1) + ['a'] * n), 'prefix', False).value, 2 * n)
+        self.assertEqual(calc.evaluate(' '.join(['1'] * n + ['+'] * (n - 1)), 'postfix', False).value, n)
+
+        ast = calc._compile(' - '.join(['a'] * n), 'infix')
+        self.assertEqual(ast.evaluate(calc.vrs).value, 2 - 2 * (n - 1))
+        self.assertEqual(ast.infix(), ' - '.join(['a'] * n))
+        self.assertEqual(ast.prefix(), ' '.join(['-'] * (n - 1) + ['a'] * n))
+        self.assertEqual(ast.postfix(), ' '.join(['a', 'a'] + ['-', 'a'] * (n - 2) + ['-']))
+        self.assertEqual(len(str(ast).splitlines()), 4 * n - 2)
+
+
+class BatchTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator()
+        calc.evaluate('k = 2; j = 10 * k', 'infix', False)
+        eqtns = ['j + 1', '1 +', 'k = 5; j', 'j', 'inv([1, 2 | 2, 4])', 'sqrt(16)'] * 5
+
+        streamed = calc.evaluate_stream(iter(eqtns), 'infix', workers=2, chunksize=4)
+        self.assertNotIsInstance(streamed, list)
+
+        for results in (calc.evaluate_many(eqtns, 'infix'), calc.evaluate_many(eqtns, 'infix', workers=2, chunksize=4), list(calc.evaluate_stream(iter(eqtns), 'infix', chunksize=4)), list(streamed)):
+            self.assertEqual(len(results), len(eqtns))
+            self.assertEqual([result.value.value for result in results[:6] if result.value], [21.0, 50.0, 20.0, 4.0])
+            self.assertIsInstance(results[1].error, Exception)
+            self.assertIsInstance(results[4].error, EvaluationException)
+            self.assertEqual([str(result.value) for result in results[:6]] * 5, [str(result.value) for result in results])
+
+        self.assertEqual(calc.evaluate('j', 'infix', False).value, 20.0)
+
+
+class CommandLineTests(unittest.TestCase):
+    def runTest(self):
+        import io
+        import json
+
+        import main
+
+        lines = io.StringIO('a = 2; 3 * a + 1\n1 / 0\n[1, 2 | 3, 4] * 2\nx = 1\nqr([1, 0 | 0, 1])\nsqrt(16)\n')
+        text = io.StringIO()
+        main.stream(Calculator(), 'infix', lines, text, chunksize=2)
+        self.assertEqual(text.getvalue().splitlines(), ['7.0', 'error: float division by zero', '[[2.0, 4.0], [6.0, 8.0]]', '', '[[[1.0, 0.0], [0.0, 1.0]], [[1.0, 0.0], [0.0, 1.0]]]', '4.0'])
+
+        lines.seek(0)
+        jsonl = io.StringIO()
+        main.stream(Calculator(), 'infix', lines, jsonl, 'jsonl', jobs=2, chunksize=2)
+        results = [json.loads(line) for line in jsonl.getvalue().splitlines()]
+        self.assertEqual([result['value'] for result in results], [7.0, None, [[2.0, 4.0], [6.0, 8.0]], None, [[[1.0, 0.0], [0.0, 1.0]], [[1.0, 0.0], [0.0, 1.0]]], 4.0])
+        self.assertEqual([result['error'] is None for result in results], [True, False, True, True, True, True])
+
+        # Lines are isolated from each other with or without jobs, but see the variables the calculator already has.
+        calc = Calculator()
+        calc.evaluate('k = 5', 'infix', False)
+
+        for jobs in (1, 2):
+            text = io.StringIO()
+            main.stream(calc, 'infix', io.StringIO('x = 3\nx + 1\nk + 1\n'), text, jobs=jobs)
+            self.assertEqual(text.getvalue().splitlines(), ['', "error: 'x'", '6.0'])
+
+
+class StatsTests(unittest.TestCase):
+    def runTest(self):
+        import vartypes
+        from stats import profile_calls
+
+        calc = Calculator(cache=ExpressionCache(), instrumented=True)
+
+        try:
+            calc.evaluate('a = 2', 'infix', False)
+            self.assertEqual(calc.evaluate('3 * a + sqrt(4)', 'infix', False).value, 8.0)
+            self.assertEqual(calc.evaluate('3 * a + sqrt(4)', 'infix', False).value, 8.0)
+
+            with self.assertRaises(Exception):
+                calc.evaluate('1 +', 'infix', False)
+
+            stats = calc.stats()
+            self.assertEqual(stats['calls'], 4)
+            self.assertEqual(stats['tokens'], 3 + 8 + 2)
+            self.assertEqual(stats['tokenize'].count, 3)
+            self.assertEqual(stats['evaluate'].count, 3)
+            self.assertEqual(stats['total'].count, 4)
+            self.assertEqual(sum(stats['total'].histogram), 4)
+            self.assertGreaterEqual(stats['total'].total, stats['evaluate'].total)
+            self.assertLessEqual(stats['total'].percentile(50), stats['total'].max)
+            self.assertGreater(stats['values'], 0)
+            self.assertEqual(stats['fix'].count, 0)
+
+            stats.reset()
+            self.assertEqual(calc.stats()['calls'], 0)
+            self.assertEqual(calc.stats()['total'].count, 0)
+
+            reference = Calculator(reference=True, instrumented=True)
+            reference.evaluate('1 + 2 * 3', 'infix', False)
+            self.assertEqual(reference.stats()['fix'].count, 1)
+            self.assertGreater(reference.stats()['backtracks'], 0)
+            reference.instrument(False)
+
+            profiles = []
+            calc.profile = profile_calls(lambda eqtn, tpe, profile: profiles.append((eqtn, tpe, profile)))
+            calc.evaluate('1 + 1', 'infix', False)
+            self.assertEqual([(eqtn, tpe) for eqtn, tpe, _ in profiles], [('1 + 1', 'infix')])
+            self.assertTrue(profiles[0][2].getstats())
+
+        finally:
+            calc.instrument(False)
+
+        self.assertEqual(vartypes._trackers, 0)
+        self.assertNotIn('counted', vartypes.NumberValue.__init__.__qualname__)
+
+        # Only the profiled call since the reset was recorded.
+        calc.evaluate('2 + 2', 'infix', False)
+        self.assertEqual(calc.stats()['calls'], 1)
+
+
+class BenchmarkTests(unittest.TestCase):
+    def runTest(self):
+        from benchmarks import run
+
+        # Every benchmark sets up and runs, so none of them break unnoticed.
+        for name, setup in run.benchmarks.items():
+            setup()()
+
+        results = run.run(['tokenize/10', 'matrix/det/4'], min_time=0.001, repeat=2)
+        self.assertEqual(list(results['results']), ['tokenize/10', 'matrix/det/4'])
+        self.assertGreater(results['results']['tokenize/10']['seconds'], 0)
+        self.assertEqual(results['backend'], 'python')
+
+        baseline = {'version': run.version, 'results': {'tokenize/10': {'seconds': 2.0}, 'matrix/det/4': {'seconds': 1.0}, 'parse/infix/10': {'seconds': 1.0}}}
+        current = {'version': run.version, 'results': {'tokenize/10': {'seconds': 2.2}, 'matrix/det/4': {'seconds': 1.5}, 'matrix/qr/4': {'seconds': 1.0}}}
+        comparison = run.compare(current, baseline)
+        self.assertEqual([(name, ratio) for name, _, _, ratio in comparison], [('tokenize/10', 1.1), ('matrix/det/4', 1.5)])
+        self.assertEqual([row[0] for row in run.regressions(comparison, 0.25)], ['matrix/det/4'])
+        self.assertEqual(run.regressions(comparison, 0.5), [])
+
+        with self.assertRaises(ValueError):
+            run.compare(current, {'version': run.version + 1, 'results': {}})
+
+        # Values have __slots__, so one takes far less memory than an object with a __dict__.
+        results = run.run(['values/construct'], min_time=0.001, repeat=2)
+        self.assertGreater(results['results']['values/construct']['bytes'], 0)
+        self.assertLess(results['results']['values/construct']['bytes'], 64)
+
+        baseline = {'version': run.version, 'results': {'values/construct': {'seconds': 1e-6, 'bytes': 32}}}
+        self.assertEqual([row[0] for row in run.compare(results, baseline)], ['values/construct', 'values/construct bytes'])
+
+        # The documented invocation puts this repository's ast.py on sys.path, and the NumPy kernels still load.
+        if numpy is not None:
+            import json
+            import os
+            import subprocess
+            import sys
+            import tempfile
+
+            with tempfile.TemporaryDirectory() as directory:
+                output = os.path.join(directory, 'results.json')
+                command = [sys.executable, '-m', 'benchmarks.run', '--backend', 'numpy', '-k', 'matrix/det/4', '--min-time', '0.001', '--repeat', '1', '-o', output]
+                result = subprocess.run(command, cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+                self.assertEqual(result.stderr, '')
+
+                with open(output) as f:
+                    self.assertEqual(json.load(f)['backend'], 'numpy')
+
+
+class ServerTests(unittest.TestCase):
+    def runTest(self):
+        import json
+        import os
+        import socket
+        import tempfile
+        import threading
+        from benchmarks import loadtest
+        from server import EvaluationServer, Session
+
+        def serve(address, **kwargs):
+            server = EvaluationServer(address, **kwargs)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            server.wait_started()
+            return server, thread
+
+        def send(sock, *requests):
+            sock.sendall(b''.join(((r if isinstance(r, str) else json.dumps(r)) + '\n').encode() for r in requests))
+
+        def read(lines, n=1):
+            return [json.loads(lines.readline()) for _ in range(n)]
+
+        session = Session()
+        session.heavy.add('M')
+        self.assertTrue(session.is_heavy(session.calc._tokenize('det(a)')))
+        self.assertTrue(session.is_heavy(session.calc._tokenize('[1, 2] * a')))
+        self.assertTrue(session.is_heavy(session.calc._tokenize('M + 1')))
+        self.assertFalse(session.is_heavy(session.calc._tokenize('sqrt(a) + exp(b) * c')))
+
+        # Heaviness follows dependencies, whichever order the variables were defined in.
+        session.calc.evaluate('y = z + 1; w = y * 2; z = 3', 'infix', False)
+        self.assertFalse(session.is_heavy(session.calc._tokenize('w')))
+        session.heavy.add('z')
+        self.assertTrue(session.is_heavy(session.calc._tokenize('w + 1')))
+
+        server, thread = serve(('127.0.0.1', 0), workers=1, max_pending=4)
+
+        try:
+            with socket.create_connection(server.address) as a, socket.create_connection(server.address) as b:
+                lines_a, lines_b = a.makefile('rb'), b.makefile('rb')
+
+                # Pipelined requests are answered in order, even though the matrices are evaluated by a worker process.
+                send(a, {'id': 1, 'eqtn': 'x = 2; M = [1, 2 | 3, 4]'}, {'id': 2, 'eqtn': 'det(M) * x'}, {'id': 3, 'eqtn': 'x + 1'},
+                     {'id': 'four', 'eqtn': 'N = M; inv(N)'}, {'id': 5, 'eqtn': '+ x 1', 'tpe': 'prefix'}, {'id': 6, 'eqtn': 'x 1 -', 'tpe': 'postfix'})
+                self.assertEqual(read(lines_a, 6), [
+                    {'id': 1, 'value': None, 'error': None},
+                    {'id': 2, 'value': -4.0, 'error': None},
+                    {'id': 3, 'value': 3.0, 'error': None},
+                    {'id': 'four', 'value': [[-2.0, 1.0], [1.5, -0.5]], 'error': None},
+                    {'id': 5, 'value': 3.0, 'error': None},
+                    {'id': 6, 'value': 1.0, 'error': None},
+                ])
+
+                # More requests than max_pending only slow the connection down.
+                send(a, *({'id': i, 'eqtn': 'det(M) + {}'.format(i) if i % 3 else 'x + {}'.format(i)} for i in range(50)))
+                self.assertEqual([(r['id'], r['value']) for r in read(lines_a, 50)], [(i, i - 2.0 if i % 3 else i + 2.0) for i in range(50)])
+
+                send(a, 'not json', '[1]', {'id': 7}, {'id': 8, 'eqtn': '1', 'tpe': 'roman'}, {'id': 9, 'eqtn': 'y'}, {'id': 10, 'eqtn': '1 +'}, {'id': 11, 'eqtn': 'det(M, M)'})
+                responses = read(lines_a, 7)
+                self.assertEqual([r['id'] for r in responses], [None, None, 7, 8, 9, 10, 11])
+                self.assertTrue(all(r['value'] is None and r['error'] for r in responses))
+
+                # Each connection has its own variables, and named sessions are shared.
+                send(b, {'eqtn': 'x'}, {'eqtn': 's = 5', 'session': 'shared'})
+                self.assertEqual([r['error'] is None for r in read(lines_b, 2)], [False, True])
+                send(a, {'eqtn': 's * x', 'session': 'shared'}, {'eqtn': 't = s - 1; t', 'session': 'shared'})
+                self.assertEqual([r['value'] for r in read(lines_a, 2)], [None, 4.0])
+                send(b, {'eqtn': 't * 2', 'session': 'shared'})
+                self.assertEqual(read(lines_b), [{'id': None, 'value': 8.0, 'error': None}])
+
+                # y is defined before z uses a matrix, and is still evaluated by the worker process.
+                send(b, {'eqtn': 'y = z + 1'}, {'eqtn': 'z = det([1, 2 | 3, 4])'}, {'eqtn': 'y'})
+                self.assertEqual([r['value'] for r in read(lines_b, 3)], [None, None, -1.0])
+                self.assertEqual(len(server._connections), 2)
+                self.assertTrue(any(connection.session.is_heavy(connection.session.calc._tokenize('y')) for connection in server._connections))
+
+            results = loadtest.run(server.address, 2, 20, 4, 'mixed', 4)
+            self.assertEqual((results['requests'], results['errors']), (40, 0))
+            self.assertGreaterEqual(results['p99'], results['p50'])
+
+        finally:
+            server.shutdown()
+            thread.join(30)
+
+        self.assertFalse(thread.is_alive())
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'calculator.sock')
+            server, thread = serve(path, workers=0, max_line=64)
+
+            try:
+                with socket.socket(socket.AF_UNIX) as c:
+                    c.connect(path)
+                    lines = c.makefile('rb')
+                    send(c, {'eqtn': '1 + ' * 20 + '1'})
+                    self.assertEqual(read(lines)[0]['error'], 'The request is longer than 64 bytes')
+                    self.assertEqual(lines.readline(), b'')
+
+                # Requests which were read before the server stopped are still answered.
+                with socket.socket(socket.AF_UNIX) as c:
+                    c.connect(path)
+                    lines = c.makefile('rb')
+                    send(c, {'eqtn': 'det([1, 2 | 3, 4])'}, {'eqtn': 'inv([2])'})
+                    self.assertEqual(read(lines)[0]['value'], -2.0)
+                    server.shutdown()
+                    self.assertEqual(read(lines)[0]['value'], [[0.5]])
+                    self.assertEqual(lines.readline(), b'')
+
+            finally:
+                server.shutdown()
+                thread.join(30)
+
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(os.path.exists(path))
+
+
+class LUTests(unittest.TestCase):
+    def runTest(self):
+        # Cofactor expansion never finishes on a 12x12 matrix, so these only pass with the LU decomposition.
+        rnd = lambda e: round(e, 5)
+        n = 12
+        mat = [[(row * 7 + col * 3) % 11 + (n if row == col else 0) for col in range(n)] for row in range(n)]
+        mat_str = ' | '.join(', '.join(map(str, row)) for row in mat)
+
+        self.assertAlmostEqual(float(evaluate('det([{}])'.format(mat_str), verbose=False)) / float(sympy.Matrix(mat).det()), 1)
+        self.assertTrue(sympy.Matrix(evaluate('inv([{}]) * [{}]'.format(mat_str, mat_str), verbose=False)).applyfunc(rnd).equals(sympy.eye(n)))
+
+        for x, expected in zip(evaluate('solve([1, 2 | 3, 4], [5, 6])', verbose=False).vectors['const'], (-4, 4.5)):
+            self.assertAlmostEqual(x, expected)
+
+        self.assertEqual(evaluate('solve([3, 0 | 0, 7], [1, 1])', verbose=False).vectors['const'], [1 / 3, 1 / 7])
+        self.assertEqual(evaluate('det([1, 2 | 2, 4])', verbose=False), 0)
+
+        # A determinant too large for a float overflows to inf instead of failing to round.
+        self.assertEqual(evaluate('det([10^200, 0 | 0, 10^200])', verbose=False), float('inf'))
+        self.assertEqual(evaluate('cof([10^200, 1 | 1, 10^200])', verbose=False), [[1e200, -1.0], [-1.0, 1e200]])
+
+        # Badly scaled but far from singular, since each pivot is judged against its own row.
+        self.assertEqual(evaluate('det([0.000001, 0 | 0, 1000000])', verbose=False), 1.0)
+        self.assertEqual(evaluate('inv([0.000001, 0 | 0, 1000000])', verbose=False), [[1000000.0, 0.0], [0.0, 1e-06]])
+
+        # Singular matrices of rank n - 1 and below, which have no inverse to build the cofactors from.
+        for sym_mat in (sympy.Matrix([[1, 2, 3], [4, 5, 6], [7, 8, 9]]), sympy.Matrix([[1, 2, 3], [2, 4, 6], [3, 6, 9]]), sympy.Matrix(mat)):
+            mat_str = ' | '.join(', '.join(map(str, row)) for row in sym_mat.tolist())
+            self.assertTrue(sympy.Matrix(evaluate('cof([{}])'.format(mat_str), verbose=False)).equals(sym_mat.cofactor_matrix()))
+            self.assertTrue(sympy.Matrix(evaluate('adj([{}])'.format(mat_str), verbose=False)).equals(sym_mat.adjugate()))
+
+        for eqtn in ('inv([1, 2, 3 | 4, 5, 6 | 7, 8, 9])', 'ls([1, 2 | 2, 4], [1 | 2])', 'det([1, 2 | 3, 4 | 5, 6])'):
+            with self.assertRaises(EvaluationException):
+                evaluate(eqtn, verbose=False)
+
+
+class MatrixMultiplicationTests(unittest.TestCase):
+    def runTest(self):
+        import matrix
+
+        rng = random.Random(0)
+        threshold = matrix.strassen_threshold
+
+        try:
+            for strassen_threshold in (threshold, 2):
+                matrix.strassen_threshold = strassen_threshold
+
+                for m, k, n in ((1, 1, 1), (2, 3, 4), (5, 1, 3), (7, 6, 9), (16, 16, 16)):
+                    a = [[rng.randint(-9, 9) for _ in range(k)] for _ in range(m)]
+                    b = [[rng.randint(-9, 9) for _ in range(n)] for _ in range(k)]
+                    a_str = ' | '.join(', '.join(map(str, row)) for row in a)
+                    b_str = ' | '.join(', '.join(map(str, row)) for row in b)
+
+                    self.assertTrue(sympy.Matrix(evaluate('[{}] * [{}]'.format(a_str, b_str), verbose=False)).equals(sympy.Matrix(a) * sympy.Matrix(b)))
+                    self.assertEqual(matrix.multiply_matrices(a, b), (sympy.Matrix(a) * sympy.Matrix(b)).tolist())
+
+        finally:
+            matrix.strassen_threshold = threshold
+
+
+class QRTests(unittest.TestCase):
+    def runTest(self):
+        rnd = lambda e: round(e, 5)
+        rng = random.Random(0)
+
+        for m, n in ((2, 2), (5, 3), (3, 3), (2, 3)):
+            mat = [[rng.randint(-9, 9) for _ in range(n)] for _ in range(m)]
+            mat_str = ' | '.join(', '.join(map(str, row)) for row in mat)
+            q, r = (sympy.Matrix(value.value) for value in Calculator().evaluate('qr([{}])'.format(mat_str), 'infix', False).value)
+            k = min(m, n)
+
+            self.assertEqual((q.shape, r.shape), ((m, m), (n, n)))
+            self.assertTrue(r.is_upper)
+            self.assertTrue((q[:, :k] * r[:k, :]).applyfunc(rnd).equals(sympy.Matrix(mat)))
+            self.assertTrue((q[:, :k].T * q[:, :k]).applyfunc(rnd).equals(sympy.eye(k)))
+            self.assertTrue(all(r[j, j] >= 0 for j in range(k)))
+
+        # Fit a line through noisy points, which has the same solution as the normal equations.
+        xs = list(range(20))
+        ys = [3 * x - 2 + rng.uniform(-1, 1) for x in xs]
+        a = sympy.Matrix([[1, x] for x in xs])
+        b = sympy.Matrix([[y] for y in ys])
+        fit = evaluate('ls([{}], [{}])'.format(' | '.join('1, {}'.format(x) for x in xs), ' | '.join(map(str, ys))), verbose=False)
+        self.assertLess((sympy.Matrix(fit) - (a.T * a).inv() * a.T * b).norm(), 1e-9)
+
+        for eqtn in ('ls([1, 2 | 2, 4 | 3, 6], [1 | 2 | 3])', 'ls([1, 2, 3 | 4, 5, 6], [1 | 2])'):
+            with self.assertRaises(EvaluationException):
+                evaluate(eqtn, verbose=False)
+
+
+class RrefTests(unittest.TestCase):
+    def runTest(self):
+        for mat in ([[1, -1, 0], [-1, 0, -1]], [[0, 0, 1], [0, 2, 0], [3, 0, 0]], [[1, 2, 3], [2, 4, 6], [1, 0, 1]]):
+            mat_str = ' | '.join(', '.join(map(str, row)) for row in mat)
+            self.assertTrue(sympy.Matrix(evaluate('rref([{}])'.format(mat_str), verbose=False)).equals(sympy.Matrix(mat).rref()[0]))
+
+        # A large system, with a zero in most cells so that pivots have to be searched for.
+        n = 100
+        rng = random.Random(0)
+        mat = [[rng.choice([0, 0, 0, 1, 2, 3]) + (1 if row == col else 0) for col in range(n)] for row in range(n)]
+        mat_str = ' | '.join(', '.join(map(str, row)) for row in mat)
+        answer = [rng.randint(-5, 5) for _ in range(n)]
+
+        solution = evaluate('solve([{}], [{}])'.format(mat_str, ', '.join(map(str, answer))), verbose=False).vectors['const']
+        self.assertTrue(all(abs(sum(mat[row][col] * solution[col] for col in range(n)) - answer[row]) < 1e-6 for row in range(n)))
+
+        transformation = sympy.Matrix(evaluate('trnsform([{}])'.format(mat_str), verbose=False))
+        self.assertTrue((transformation * sympy.Matrix(mat)).applyfunc(lambda e: round(e, 5)).equals(sympy.eye(n)))
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class VectorizedTests(unittest.TestCase):
+    def runTest(self):
+        calc = Calculator()
+        calc.evaluate('pi = 3.14159; area = pi * r ^ 2', 'infix', False)
+
+        radii = numpy.arange(100.0)
+        areas = calc.evaluate_vectorized('area', 'infix', {'r': radii})
+        self.assertEqual(areas.shape, (100,))
+        self.assertTrue(numpy.allclose(areas, 3.14159 * radii ** 2))
+        self.assertNotIn('r', calc.vrs)
+
+        self.assertTrue(numpy.allclose(calc.evaluate_vectorized('sqrt(a) + exp(b) % 2 - a / 2', 'infix', {'a': [1, 4], 'b': [0, 1]}), [1.5, numpy.e % 2]))
+        self.assertEqual(list(calc.evaluate_vectorized('2 + 3', 'infix', {'a': [1, 2, 3]})), [5.0, 5.0, 5.0])
+
+        for eqtn in ('[a, 1]', '[1, 2] * a', 'a * [1, 2]', 'identity(a)'):
+            with self.assertRaises(EvaluationException):
+                calc.evaluate_vectorized(eqtn, 'infix', {'a': [1, 2]})
+
+        with self.assertRaises(EvaluationException):
+            calc.evaluate_vectorized('a + b', 'infix', {'a': [1, 2], 'b': [1, 2, 3]})
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class MatrixBackendTests(unittest.TestCase):
+    def runTest(self):
+        import vartypes
+
+        eqtns = [
+            'identity(3)',
+            '[1, 2 | 3, 4] * [5 | 6]',
+            '[1, 2 | 3, 4] - [1, 1 | 1, 1]',
+            '[2, 4 | 6, 8] / 2',
+            'det([1, 2, 3 | 4, 5, 6 | 7, 8, 10])',
+            'det([1, 2 | 3, 4])',
+            'det(identity(3))',
+            'det(identity(3) * 2.0)',
+            'det([0.5, 1 | 2, 3])',
+            'trans([1, 2, 3 | 4, 5, 6])',
+            'cof([1, 2, 3 | 0, 4, 5 | 1, 0, 6])',
+            'cof([1, 2 | 2, 4])',
+            'cof([1, 2, 3 | 4, 5, 6 | 7, 8, 9])',
+            'cof([1, 2, 3 | 2, 4, 6 | 3, 6, 9])',
+            'cof([0.5, 1 | 2, 3])',
+            'cof([10^200, 1 | 1, 10^200])',
+            'adj([1, 2 | 3, 4])',
+            'inv([2, 1 | 1, 3])',
+            'inv([1, 2 | 3, 4])',
+            'rref([1, 2, 3 | 4, 5, 6 | 7, 8, 10])',
+            'rref([1, 2 | 2, 4])',
+            'ls([1, 0 | 1, 1 | 1, 2], [1 | 2 | 4])',
+            'qr([1, 2 | 3, 4])',
+            'solve([1, 2 | 3, 4], [5, 6])',
+            'solve([1, 2 | 2, 4], [1, 2])',
+        ]
+
+        calc = Calculator()
+        expected = [calc.evaluate(eqtn, 'infix', False) for eqtn in eqtns]
+
+        vartypes.set_matrix_backend('numpy')
+
+        try:
+            for eqtn, res in zip(eqtns, expected):
+                value = calc.evaluate(eqtn, 'infix', False)
+
+                # Both backends print the same, down to whole determinants and cofactors being rounded.
+                if isinstance(res, vartypes.TupleValue):
+                    self.assertEqual([str(v) for v in value.value], [str(r) for r in res.value], eqtn)
+
+                else:
+                    self.assertEqual(str(value), str(res), eqtn)
+
+            self.assertIsInstance(calc.evaluate('[1, 2 | 3, 4]', 'infix', False).value, numpy.ndarray)
+
+            for eqtn in ('inv([1, 2 | 2, 4])', 'ls([1, 2 | 2, 4], [1 | 2])', '[1, 2] * [3, 4]'):
+                with self.assertRaises(EvaluationException):
+                    calc.evaluate(eqtn, 'infix', False)
+
+        finally:
+            vartypes.set_matrix_backend('python')
+
+        with self.assertRaises(ValueError):
+            vartypes.set_matrix_backend('fortran')
+
+        # This repository's ast.py shadows the standard library's whenever it is on sys.path, as it is for scripts run
+        # from here, and NumPy still imports.
+        import os
+        import subprocess
+        import sys
+
+        script = "import calculator, vartypes; vartypes.set_matrix_backend('numpy'); print(calculator.Calculator().evaluate_vectorized('2 * r', 'infix', {'r': [1, 2]}))"
+        result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+        self.assertEqual((result.returncode, result.stdout.strip()), (0, '[2. 4.]'), result.stderr)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,219 @@
+"""
+This file contains the Variables class, which stores the variables of a Calculator and caches their values.
+"""
+from typing import Dict, Iterator, Set, Tuple
+
+from ast import Ast
+from common import EvaluationException, RuleMatch
+from vartypes import NumberValue, TupleValue, Value
+
+
+class Assignment:
+    """
+    A single assignment, like q, r = qr(M). Every name it assigns shares it, so the right side is evaluated only once.
+    """
+
+    def __init__(self, rule: RuleMatch = None, result: Value = None):
+        self.rule = rule
+        self.result = result
+        self.dependencies = self._dependencies(rule) if rule else set()
+        self._ast = Ast(rule, fixed=True) if rule else None
+
+    def fresh(self) -> 'Assignment':
+        # The same assignment without its cached result. Assignments can be shared by copies of Variables, so a cached
+        # result is never cleared in place.
+        assignment = Assignment.__new__(Assignment)
+        assignment.rule = self.rule
+        assignment.result = None
+        assignment.dependencies = self.dependencies
+        assignment._ast = self._ast
+        return assignment
+
+    def evaluate(self, vrs) -> Value:
+        if self.result is None:
+            self.result = self._ast.compile()(vrs)
+
+        return self.result
+
+    @staticmethod
+    def _dependencies(rule: RuleMatch) -> Set[str]:
+        # These are the names of all of the variables used in rule.
+        names = set()
+        stack = [rule]
+
+        while stack:
+            node = stack.pop()
+
+            for child in node.matched:
+                if isinstance(child, RuleMatch):
+                    stack.append(child)
+
+                elif child.name == 'IDT':
+                    names.add(child.value)
+
+        return names
+
+
+class Variables:
+    """
+    A mapping from variable names to their values. Each value is computed the first time it is needed and then kept
+    until the variable, or any variable it depends on, is redefined.
+    """
+
+    def __init__(self):
+        self._assignments = {}  # type: Dict[str, Tuple[int, Assignment]]
+        self._dependents = {}  # type: Dict[str, Set[str]]
+
+    def __getitem__(self, name: str) -> Value:
+        i, assignment = self._assignments[name]
+
+        if assignment.result is None:
+            self._evaluate_dependencies(assignment)
+
+        result = assignment.evaluate(self)
+
+        if isinstance(result, TupleValue) and assignment.rule is not None:
+            return result.value[i]
+
+        return result
+
+    def __setitem__(self, name: str, entry):
+        self.update({name: entry})
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._assignments
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._assignments)
+
+    def __len__(self):
+        return len(self._assignments)
+
+    def rule(self, name: str) -> RuleMatch:
+        return self._assignments[name][1].rule
+
+    def dependencies(self, name: str) -> Set[str]:
+        # The names the definition of name uses, which may not be defined yet.
+        return self._assignments[name][1].dependencies
+
+    def entries(self) -> Dict[str, object]:
+        """
+        Returns the definitions in the form update() accepts, without any cached values or compiled code.
+        """
+        return {name: assignment.result if assignment.rule is None else (i, assignment.rule) for name, (i, assignment) in self._assignments.items()}
+
+    def copy(self) -> 'Variables':
+        # The copy shares the assignments (and so their cached values) until either one redefines a variable.
+        vrs = Variables()
+        vrs._assignments = dict(self._assignments)
+        vrs._dependents = {name: set(dependents) for name, dependents in self._dependents.items()}
+        return vrs
+
+    def update(self, entries: Dict[str, object]):
+        """
+        Defines variables. An entry is either an (index, rule) pair from an assignment or a Value (or number) to bind
+        the name to directly. Entries which share a rule are evaluated together.
+        """
+        assignments = {}
+        defined = {}
+
+        for name, entry in entries.items():
+            if isinstance(entry, (int, float)):
+                entry = NumberValue(float(entry))
+
+            if isinstance(entry, Value):
+                defined[name] = (0, Assignment(result=entry))
+
+            else:
+                i, rule = entry
+
+                if id(rule) not in assignments:
+                    assignments[id(rule)] = Assignment(rule)
+
+                defined[name] = (i, assignments[id(rule)])
+
+        for name, (_, assignment) in defined.items():
+            self._check_cycle(name, assignment.dependencies, defined)
+
+        self._invalidate(defined)
+
+        for name, (i, assignment) in defined.items():
+            if name in self._assignments:
+                for dependency in self._assignments[name][1].dependencies:
+                    self._dependents[dependency].discard(name)
+
+            for dependency in assignment.dependencies:
+                self._dependents.setdefault(dependency, set()).add(name)
+
+            self._assignments[name] = (i, assignment)
+
+    def _check_cycle(self, name: str, dependencies: Set[str], defined: Dict[str, Tuple[int, Assignment]]):
+        # Defining name creates a cycle if name can be reached from its own dependencies.
+        seen = set()
+        stack = list(dependencies)
+
+        while stack:
+            dependency = stack.pop()
+
+            if dependency == name:
+                raise EvaluationException('Circular definition of {}'.format(name))
+
+            if dependency in seen:
+                continue
+
+            seen.add(dependency)
+
+            if dependency in defined:
+                stack.extend(defined[dependency][1].dependencies)
+
+            elif dependency in self._assignments:
+                stack.extend(self._assignments[dependency][1].dependencies)
+
+    def _evaluate_dependencies(self, assignment: Assignment):
+        # Evaluating an assignment looks up its dependencies, which would recurse once for every link in a chain of
+        # variables. Instead, the uncached dependencies are evaluated first, in topological order, so that every lookup
+        # finds a cached value.
+        order = []
+        seen = set()
+        stack = [(dependency, False) for dependency in assignment.dependencies]
+
+        while stack:
+            name, finished = stack.pop()
+
+            if finished:
+                order.append(name)
+                continue
+
+            if name in seen or name not in self._assignments:
+                continue
+
+            seen.add(name)
+            dependency = self._assignments[name][1]
+
+            if dependency.result is None:
+                stack.append((name, True))
+                stack.extend((child, False) for child in dependency.dependencies)
+
+        for name in order:
+            self._assignments[name][1].evaluate(self)
+
+    def _invalidate(self, names):
+        # Forgets the cached values of everything that depends on names, directly or not.
+        seen = set()
+        fresh = {}
+        stack = [dependent for name in names for dependent in self._dependents.get(name, ())]
+
+        while stack:
+            dependent = stack.pop()
+
+            if dependent in seen:
+                continue
+
+            seen.add(dependent)
+            i, assignment = self._assignments[dependent]
+
+            if id(assignment) not in fresh:
+                fresh[id(assignment)] = assignment.fresh()
+
+            self._assignments[dependent] = (i, fresh[id(assignment)])
+            stack.extend(self._dependents.get(dependent, ()))
@@ -1,35 +1,120 @@
 import copy
-import functools
 import math
+import sys
 from abc import ABCMeta
 from typing import List
 
-from common import EvaluationException, operations
-from matrix import MatrixTransformer, DynamicVector
+from common import EvaluationException, import_numpy, operations
+from matrix import DynamicVector, PythonBackend
+
+
+# The kernels every MatrixValue uses, and which type MatrixValue#value is. See set_matrix_backend.
+matrix_backend = PythonBackend
+
+# Every subclass of Value, in the order they are defined.
+value_types = []
+
+# The number of Values built while allocations are tracked, and how many trackers there are. See track_allocations.
+allocations = 0
+_trackers = 0
+
+
+def set_matrix_backend(name: str):
+    """
+    Chooses the matrix kernels: 'python' for the pure-Python lists (the default) or 'numpy' for NumPy arrays. NumPy is
+    only imported once it is chosen. Matrices built before the switch keep their old storage.
+    """
+    global matrix_backend
+
+    if name == 'python':
+        matrix_backend = PythonBackend
+
+    elif name == 'numpy':
+        import_numpy()
+        from numpy_matrix import NumpyBackend
+        matrix_backend = NumpyBackend
+
+    else:
+        raise ValueError('Unknown matrix backend {}'.format(name))
+
+
+def track_allocations(enabled: bool):
+    """
+    Starts (or stops) counting every Value built in allocations. The constructors are only wrapped while there is at
+    least one tracker, so Values cost nothing extra the rest of the time.
+    """
+    global _trackers
+
+    _trackers += 1 if enabled else -1
+
+    # Only the classes which define a constructor are wrapped, so inherited constructors aren't counted twice.
+    if enabled and _trackers == 1:
+        for cls in value_types:
+            if '__init__' in vars(cls):
+                cls.__init__ = counted(cls.__init__)
+
+    elif not enabled and _trackers == 0:
+        for cls in value_types:
+            if '__init__' in vars(cls):
+                cls.__init__ = cls.__init__.__wrapped__
+
+
+def counted(init):
+    def __init__(self, *args):
+        global allocations
+        allocations += 1
+        init(self, *args)
+
+    __init__.__wrapped__ = init
+    return __init__
 
 
 def raise_exception(tpe, op):
     raise EvaluationException('{} does not have operation {}'.format(tpe, op))
 
 
+def unsupported(op):
+    # The method a Value subclass gets for an operation it doesn't define.
+    def operation(self, *args):
+        raise_exception(self.type, op)
+
+    operation.__name__ = op
+    return operation
+
+
+def is_vector(value) -> bool:
+    # A NumberValue holds a NumPy array instead of a float during vectorized evaluation. NumPy is optional and only
+    # imported by Calculator#evaluate_vectorized, so if it hasn't been imported there can't be any arrays.
+    numpy = sys.modules.get('numpy')
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+
+def check_scalar(value, action):
+    if is_vector(value.value):
+        raise EvaluationException('Cannot {} with a vector of numbers, matrices do not broadcast'.format(action))
+
+
 class Value(metaclass=ABCMeta):
-    __slots__ = ('type', 'value')
+    __slots__ = ('value',)
 
-    def __init__(self):
-        self.type = self.__class__.__name__
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Operations a subclass doesn't define are filled in once here rather than on every instance.
+        cls.type = cls.__name__
+        value_types.append(cls)
 
         for op in operations:
-            if not hasattr(self, op):
-                setattr(self, op, functools.partial(raise_exception, tpe=self.type, op=op))
+            if not hasattr(cls, op):
+                setattr(cls, op, unsupported(op))
 
     def __str__(self):
         return str(self.value)
 
 
 class VariableValue(Value):
+    __slots__ = ()
+
     def __init__(self, data):
-        super().__init__()
-        
         if isinstance(data, list):
             self.value = data[0].value
             
@@ -38,9 +123,9 @@ class VariableValue(Value):
 
 
 class NumberValue(Value):
+    __slots__ = ()
+
     def __init__(self, data):
-        super().__init__()
-        
         if isinstance(data, list):
             self.value = float(data[0].value)
         
@@ -99,12 +184,19 @@ class NumberValue(Value):
             raise EvaluationException('Cannot pow {} and {}'.format(self.type, other.type))
 
     def sqrt(self):
+        if is_vector(self.value):
+            return NumberValue(sys.modules['numpy'].sqrt(self.value))
+
         return NumberValue(math.sqrt(self.value))
 
     def exp(self):
+        if is_vector(self.value):
+            return NumberValue(sys.modules['numpy'].exp(self.value))
+
         return NumberValue(math.exp(self.value))
 
     def identity(self):
+        check_scalar(self, 'build an identity matrix')
         return MatrixValue([[1 if col is row else 0 for col in range(int(self.value))] for row in range(int(self.value))])
 
     def zeroes(self, other):
@@ -112,14 +204,14 @@ class NumberValue(Value):
 
 
 class MatrixValue(Value):
+    __slots__ = ('_rref_cache',)
+
     def __init__(self, data):
-        super().__init__()
-        
         if isinstance(data[0], Value):
-            self.value = list(map(lambda t: t.value, data))
+            self.value = matrix_backend.array(list(map(lambda t: t.value, data)))
         
         else:
-            self.value = data
+            self.value = matrix_backend.array(data)
 
         self._rref_cache = None
 
@@ -131,28 +223,22 @@ class MatrixValue(Value):
             if len(self.value) != len(other.value) or len(self.value[0]) != len(other.value[0]):
                 raise EvaluationException('Attempted to subtract two matrices of different dimensions')
 
-            return MatrixValue([[self.value[row][col] - other.value[row][col] for col in range(len(self.value[row]))] for row in range(len(self.value))])
+            return MatrixValue(matrix_backend.sub(self.value, other.value))
 
         raise EvaluationException('Cannot sub {} and {}'.format(self.type, other.type))
 
     def mul(self, other):
         if isinstance(other, NumberValue):
             # Matrix * Number
-            return MatrixValue([[cell * other.value for cell in row] for row in self.value])
+            check_scalar(other, 'multiply a matrix')
+            return MatrixValue(matrix_backend.scale(self.value, other.value))
 
         elif isinstance(other, MatrixValue):
             # Matrix * Matrix
             if len(self.value[0]) != len(other.value):
                 raise EvaluationException('Cannot multiply matrices of dimensions {} and {}'.format((len(self.value), len(self.value[0])), (len(other.value), len(other.value[0]))))
 
-            result = [[0 for _ in range(len(other.value[0]))] for _ in range(len(self.value))]
-
-            for i in range(len(self.value)):
-                for j in range(len(other.value[0])):
-                    for k in range(len(other.value)):
-                        result[i][j] += self.value[i][k] * other.value[k][j]
-
-            return MatrixValue(result)
+            return MatrixValue(matrix_backend.mul(self.value, other.value))
 
         else:
             raise EvaluationException('Cannot mul {} and {}'.format(self.type, other.type))
@@ -160,61 +246,30 @@ class MatrixValue(Value):
     def div(self, other):
         if isinstance(other, NumberValue):
             # Matrix / Number
-            return MatrixValue([[cell / other.value for cell in row] for row in self.value])
+            check_scalar(other, 'divide a matrix')
+            return MatrixValue(matrix_backend.divide(self.value, other.value))
 
         else:
             raise EvaluationException('Cannot div {} and {}'.format(self.type, other.type))
 
     def det(self):
-        return NumberValue(self._det(self.value))
-
-    @staticmethod
-    def _det(matrix: List[List[float]]) -> float:
-        if len(matrix) is 1:
-            return matrix[0][0]
-
-        cofactors = []
-
-        for col in range(len(matrix)):
-            cofactors.append(MatrixValue._det([matrix[row][0:col] + matrix[row][col + 1:] for row in range(1, len(matrix))]) * matrix[0][col] * (1 if col % 2 is 0 else -1))
-
-        return sum(cofactors)
+        return NumberValue(matrix_backend.det(self.value))
 
     def trans(self):
-        return MatrixValue(list(map(list, zip(*self.value))))
+        return MatrixValue(matrix_backend.trans(self.value))
 
     def cof(self):
-        cofactor_matrix = []
-
-        for row in range(len(self.value)):
-            cofactor_matrix.append([])
-
-            for col in range(len(self.value[row])):
-                minor = copy.deepcopy(self.value)
-                del minor[row]
-
-                for r in minor:
-                    del r[col]
-
-                cofactor_matrix[row].append(self._det(minor) * (1 if (row + col) % 2 is 0 else -1))
-
-        return MatrixValue(cofactor_matrix)
+        return MatrixValue(matrix_backend.cof(self.value))
 
     def adj(self):
         return self.cof().trans()
 
     def inv(self):
-        det = self._det(self.value)
-
-        if det == 0:
-            raise EvaluationException('Cannot invert matrix with determinant of 0.')
-
-        multiplier = 1 / det
-        return MatrixValue([[cell * multiplier for cell in row] for row in self.adj().value])
+        return MatrixValue(matrix_backend.inv(self.value))
 
     def _rref(self):
         if not self._rref_cache:
-            self._rref_cache = MatrixTransformer(copy.deepcopy(self.value)).rref()
+            self._rref_cache = matrix_backend.rref(self.value)
 
         return self._rref_cache
     
@@ -225,10 +280,16 @@ class MatrixValue(Value):
         return MatrixValue(self._rref()[1])
 
     def solve(self, other):
-        return DynamicVectorValue(MatrixTransformer(copy.deepcopy(self.value)).rref(other.value[0])[2])
+        return DynamicVectorValue(matrix_backend.solve(self.value, other.value[0]))
 
     def ls(self, other):
-        return (self.trans().mul(self)).inv().mul(self.trans()).mul(other)
+        if not isinstance(other, MatrixValue):
+            raise EvaluationException('Cannot mul {} and {}'.format(self.type, other.type))
+
+        if len(self.value) != len(other.value):
+            raise EvaluationException('Cannot multiply matrices of dimensions {} and {}'.format((len(self.value[0]), len(self.value)), (len(other.value), len(other.value[0]))))
+
+        return MatrixValue(matrix_backend.ls(self.value, other.value))
 
     def norm(self):
         return NumberValue(math.sqrt(sum([sum([col * col for col in row]) for row in self.value])))
@@ -241,33 +302,17 @@ class MatrixValue(Value):
         return MatrixValue([[row[col]] for row in self.value])
 
     def qr(self):
-        m = NumberValue(len(self.value))
-        n = NumberValue(len(self.value[0]))
-
-        Q = m.zeroes(m).value
-        R = n.zeroes(n).value
-
-        for j in range(n.value):
-            v = self._col(j)
-
-            for i in range(j):
-                R[i][j] = MatrixValue(Q)._col(i).trans().mul(self._col(j)).value[0][0]
-                v = v.squeeze().sub(MatrixValue(Q)._col(i).trans().mul(NumberValue(R[i][j])))
-
-            R[j][j] = v.norm().value
-
-            val = v.div(NumberValue(R[j][j])).squeeze().value[0]
-            for row in range(len(Q)):
-                Q[row][j] = val[row]
-
-        return TupleValue([MatrixValue(Q), MatrixValue(R)])
+        return TupleValue(list(map(MatrixValue, matrix_backend.qr(self.value))))
 
 
 class MatrixRowValue(Value):
-    def __init__(self, data):
-        super().__init__()
+    __slots__ = ()
 
+    def __init__(self, data):
         if isinstance(data[0], Value):
+            for cell in data:
+                check_scalar(cell, 'build a matrix')
+
             self.value = list(map(lambda t: t.value, data))
 
         else:
@@ -275,16 +320,16 @@ class MatrixRowValue(Value):
 
 
 class TupleValue(Value):
-    def __init__(self, args: List):
-        super().__init__()
+    __slots__ = ()
 
+    def __init__(self, args: List):
         self.value = args
 
 
 class DynamicVectorValue(Value):
-    def __init__(self, dvec: DynamicVector):
-        super().__init__()
+    __slots__ = ()
 
+    def __init__(self, dvec: DynamicVector):
         self.value = dvec
 
     def eval(self, *args):